@@ -12,5 +12,8 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+# The event loop lives as long as the process, so the llm calls can use
+# the async SDK clients.
+os.environ.setdefault('LLM_ASYNC_CLIENTS', 'True')
 
 application = get_asgi_application()
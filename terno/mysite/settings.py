@@ -54,6 +54,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'terno.middleware.SQLParseStatsMiddleware',
 ]
 
 ROOT_URLCONF = 'mysite.urls'
@@ -101,6 +102,18 @@ else:
     }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND',
+                             'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -158,3 +171,60 @@ if TERNO_LOG_FILE:
         os.path.join(BASE_DIR, TERNO_LOG_FILE)
 
 logging.config.dictConfig(logging_config)
+
+
+# Query execution
+QUERY_JOB_MAX_WORKERS = int(os.getenv('QUERY_JOB_MAX_WORKERS', 4))
+QUERY_JOB_MAX_PENDING = int(os.getenv('QUERY_JOB_MAX_PENDING', 32))
+QUERY_JOB_FETCH_SIZE = int(os.getenv('QUERY_JOB_FETCH_SIZE', 1000))
+QUERY_JOB_TTL = int(os.getenv('QUERY_JOB_TTL', 600))  # seconds
+QUERY_QUEUE_TIMEOUT = int(os.getenv('QUERY_QUEUE_TIMEOUT', 30))  # seconds
+SINGLE_FLIGHT_CACHE_LOCK = os.getenv('SINGLE_FLIGHT_CACHE_LOCK', '') == 'True'
+SINGLE_FLIGHT_LOCK_TIMEOUT = int(os.getenv('SINGLE_FLIGHT_LOCK_TIMEOUT', 300))  # seconds
+SINGLE_FLIGHT_RESULT_TTL = int(os.getenv('SINGLE_FLIGHT_RESULT_TTL', 5))  # seconds
+SINGLE_FLIGHT_POLL_INTERVAL = 0.1  # seconds
+REPLICA_HEALTH_CHECK_INTERVAL = int(os.getenv('REPLICA_HEALTH_CHECK_INTERVAL', 30))  # seconds
+REPLICA_FAILURE_COOLDOWN = int(os.getenv('REPLICA_FAILURE_COOLDOWN', 60))  # seconds
+REPLICA_CONFIG_CHECK_INTERVAL = int(os.getenv('REPLICA_CONFIG_CHECK_INTERVAL', 5))  # seconds
+REPLICA_HEALTH_CHECK_WORKERS = int(os.getenv('REPLICA_HEALTH_CHECK_WORKERS', 2))
+PREVIEW_SAMPLE_PERCENT = float(os.getenv('PREVIEW_SAMPLE_PERCENT', 1))
+PREVIEW_ROW_CAP = int(os.getenv('PREVIEW_ROW_CAP', 10000))
+TRANSLATION_CACHE_SIZE = int(os.getenv('TRANSLATION_CACHE_SIZE', 1024))
+BATCH_SQL_MAX_STATEMENTS = int(os.getenv('BATCH_SQL_MAX_STATEMENTS', 50))
+BATCH_SQL_MAX_WORKERS = int(os.getenv('BATCH_SQL_MAX_WORKERS', 4))
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv('LLM_HTTP_MAX_CONNECTIONS', 20))
+LLM_HTTP_KEEPALIVE_EXPIRY = int(os.getenv('LLM_HTTP_KEEPALIVE_EXPIRY', 60))  # seconds
+LLM_CLIENT_CLOSE_DELAY = float(os.getenv('LLM_CLIENT_CLOSE_DELAY', 300))  # seconds
+LLM_ASYNC_CLIENTS = os.getenv('LLM_ASYNC_CLIENTS', '') == 'True'  # set by mysite/asgi.py
+LLM_CONFIG_CHECK_INTERVAL = int(os.getenv('LLM_CONFIG_CHECK_INTERVAL', 5))  # seconds
+LLM_RESPONSE_CACHE_ENABLED = os.getenv('LLM_RESPONSE_CACHE_ENABLED', 'True') == 'True'
+LLM_RESPONSE_CACHE_TTL = int(os.getenv('LLM_RESPONSE_CACHE_TTL', 86400))  # seconds
+LLM_RESPONSE_CACHE_MAX_BYTES = int(os.getenv('LLM_RESPONSE_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+SIMILAR_QUESTION_REUSE_THRESHOLD = float(os.getenv('SIMILAR_QUESTION_REUSE_THRESHOLD', 0.95))
+SIMILAR_QUESTION_SUGGEST_THRESHOLD = float(os.getenv('SIMILAR_QUESTION_SUGGEST_THRESHOLD', 0.6))
+SIMILAR_QUESTION_LIMIT = int(os.getenv('SIMILAR_QUESTION_LIMIT', 3))
+SIMILAR_QUESTION_REFRESH_INTERVAL = float(os.getenv('SIMILAR_QUESTION_REFRESH_INTERVAL', 10))  # seconds
+SIMILAR_QUESTION_REFRESH_BATCH_SIZE = int(os.getenv('SIMILAR_QUESTION_REFRESH_BATCH_SIZE', 500))
+SIMILAR_QUESTION_INDEX_MAX_SIZE = int(os.getenv('SIMILAR_QUESTION_INDEX_MAX_SIZE', 10000))
+LLM_REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', 60))  # seconds
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 2))
+LLM_RETRY_BACKOFF = float(os.getenv('LLM_RETRY_BACKOFF', 0.5))  # seconds
+LLM_RETRY_BACKOFF_MAX = float(os.getenv('LLM_RETRY_BACKOFF_MAX', 8))  # seconds
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('LLM_CIRCUIT_FAILURE_THRESHOLD', 5))
+LLM_CIRCUIT_RESET_TIMEOUT = int(os.getenv('LLM_CIRCUIT_RESET_TIMEOUT', 30))  # seconds
+LLM_HEDGE_ENABLED = os.getenv('LLM_HEDGE_ENABLED', '') == 'True'
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', 95))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', 20))
+LLM_HEDGE_DELAY = float(os.getenv('LLM_HEDGE_DELAY', 10))  # seconds, until enough samples
+LLM_ROUTER_QUESTION_LENGTH = int(os.getenv('LLM_ROUTER_QUESTION_LENGTH', 300))  # characters
+LLM_ROUTER_SCHEMA_SIZE = int(os.getenv('LLM_ROUTER_SCHEMA_SIZE', 20000))  # characters
+LLM_ROUTER_MIN_SAMPLES = int(os.getenv('LLM_ROUTER_MIN_SAMPLES', 10))
+LLM_ROUTER_MAX_ERROR_RATE = float(os.getenv('LLM_ROUTER_MAX_ERROR_RATE', 0.5))
+LLM_PROMPT_CACHING = os.getenv('LLM_PROMPT_CACHING', 'True') == 'True'
+LLM_CANDIDATES = int(os.getenv('LLM_CANDIDATES', 1))
+LLM_CANDIDATE_TEMPERATURE = float(os.getenv('LLM_CANDIDATE_TEMPERATURE', 0.7))
+LLM_CANDIDATE_TOKEN_BUDGET = int(os.getenv('LLM_CANDIDATE_TOKEN_BUDGET', 60000))
+LLM_CANDIDATE_EXPLAIN = os.getenv('LLM_CANDIDATE_EXPLAIN', '') == 'True'
+BATCH_QUESTIONS_MAX = int(os.getenv('BATCH_QUESTIONS_MAX', 200))
+BATCH_QUESTIONS_MAX_CONCURRENCY = int(os.getenv('BATCH_QUESTIONS_MAX_CONCURRENCY', 8))
+PIPELINE_MAX_WORKERS = int(os.getenv('PIPELINE_MAX_WORKERS', 4))
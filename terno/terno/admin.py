@@ -1,14 +1,16 @@
 from django.contrib import admin
 import terno.models as models
+from terno.llm import response_cache
 
 
 @admin.register(models.LLMConfiguration)
 class LLMConfigurationAdmin(admin.ModelAdmin):
-    list_display = ('llm_type', 'api_key', 'model_name', 'enabled')
+    list_display = ('llm_type', 'api_key', 'model_name', 'role', 'enabled')
     search_fields = ('llm_type', 'model_name')
     fieldsets = (
         ('Basic Configuration', {
-            'fields': ('llm_type', 'api_key', 'enabled'),
+            'fields': ('llm_type', 'api_key', 'role', 'enabled', 'cache_responses',
+                       'fallback'),
         }),
         ('Advanced Configuration (Optional)', {
             'classes': ('collapse',),
@@ -20,11 +22,27 @@ class LLMConfigurationAdmin(admin.ModelAdmin):
 
     def save_model(self, request, obj, form, change):
         if obj.enabled:
-            # Disable all other configurations
-            models.LLMConfiguration.objects.filter(enabled=True).update(enabled=False)
+            # Disable the other configurations of the same role
+            models.LLMConfiguration.objects.filter(enabled=True, role=obj.role) \
+                .exclude(pk=obj.pk).update(enabled=False)
         super().save_model(request, obj, form, change)
 
 
+@admin.register(models.LLMResponseCache)
+class LLMResponseCacheAdmin(admin.ModelAdmin):
+    list_display = ['provider', 'model_name', 'size', 'hits', 'last_used_at', 'expires_at']
+    list_filter = ['provider', 'model_name']
+    search_fields = ['key', 'response']
+    readonly_fields = ['key', 'provider', 'model_name', 'response', 'size',
+                       'hits', 'created_at', 'last_used_at', 'expires_at']
+    actions = ['purge_cache']
+
+    @admin.action(description="Purge the whole LLM response cache")
+    def purge_cache(self, request, queryset):
+        deleted = response_cache.purge()
+        self.message_user(request, f"Purged {deleted} cached responses.")
+
+
 @admin.register(models.DataSource)
 class DataSourceAdmin(admin.ModelAdmin):
     list_display = ['display_name', 'type', 'enabled', 'dialect_name', 'dialect_version', 'connection_str']
@@ -32,6 +50,13 @@ class DataSourceAdmin(admin.ModelAdmin):
     search_fields = ['display_name', 'type']
 
 
+@admin.register(models.DataSourceReplica)
+class DataSourceReplicaAdmin(admin.ModelAdmin):
+    list_display = ['display_name', 'data_source', 'use_for_exports', 'enabled']
+    list_filter = ['data_source', 'enabled']
+    search_fields = ['display_name', 'data_source__display_name']
+
+
 @admin.register(models.Table)
 class TableAdmin(admin.ModelAdmin):
     list_display = ['name', 'public_name', 'data_source']
@@ -113,9 +138,11 @@ class TableRowFilterAdmin(admin.ModelAdmin):
 
 @admin.register(models.QueryHistory)
 class QueryHistoryAdmin(admin.ModelAdmin):
-    list_display = ['user', 'data_source', 'data_type', 'data', 'created_at']
+    list_display = ['user', 'data_source', 'data_type', 'data',
+                    'execution_time', 'row_count', 'created_at']
     list_filter = ['data_source', 'data_type', 'created_at']
-    search_fields = ['user__username', 'data_source__display_name', 'data']
+    search_fields = ['user__username', 'data_source__display_name', 'data',
+                     'fingerprint']
 
 
 @admin.register(models.PromptLog)
@@ -125,6 +152,16 @@ class PromptLogAdmin(admin.ModelAdmin):
     search_fields = ['user__username', 'llm_prompt']
 
 
+@admin.register(models.LLMUsage)
+class LLMUsageAdmin(admin.ModelAdmin):
+    list_display = ['provider', 'model_name', 'data_source', 'user', 'prompt_tokens',
+                    'completion_tokens', 'cached_tokens', 'finish_reason',
+                    'time_to_first_token', 'latency', 'created_at']
+    list_filter = ['provider', 'model_name', 'data_source', 'finish_reason', 'created_at']
+    search_fields = ['user__username', 'model_name']
+    raw_id_fields = ['prompt_log', 'query_history']
+
+
 @admin.register(models.SystemPrompts)
 class SystemPromptsAdmin(admin.ModelAdmin):
     list_display = ['data_source', 'system_prompt']
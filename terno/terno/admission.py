@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from django.conf import settings
+import terno.metrics as metrics
+
+
+class DatasourceBusy(Exception):
+    pass
+
+
+class _Ticket():
+    def __init__(self, user_key):
+        self.user_key = user_key
+        self.granted = False
+
+
+class AdmissionController():
+    '''
+    Limits the number of queries running at the same time against one
+    datasource. Waiting queries are queued per user and slots are handed
+    out round robin across users, so a single user firing many queries
+    cannot starve everybody else.
+    '''
+
+    def __init__(self, name, max_concurrent, queue_timeout):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self._cond = threading.Condition()
+        self._waiting = {}  # user_key -> deque of tickets
+        self._user_order = deque()
+
+    @property
+    def queue_depth(self):
+        return sum(len(tickets) for tickets in self._waiting.values())
+
+    def _update_metrics(self):
+        metrics.set_gauge('admission_queue_depth', self.queue_depth,
+                          datasource=self.name)
+        metrics.set_gauge('admission_running', self.running,
+                          datasource=self.name)
+
+    def _dispatch(self):
+        while self.running < self.max_concurrent and self._user_order:
+            user_key = self._user_order.popleft()
+            tickets = self._waiting[user_key]
+            ticket = tickets.popleft()
+            ticket.granted = True
+            self.running += 1
+            if tickets:
+                self._user_order.append(user_key)
+            else:
+                del self._waiting[user_key]
+        self._cond.notify_all()
+
+    def _remove(self, ticket):
+        tickets = self._waiting.get(ticket.user_key)
+        if tickets is None:
+            return
+        tickets.remove(ticket)
+        if not tickets:
+            del self._waiting[ticket.user_key]
+            self._user_order.remove(ticket.user_key)
+
+    def acquire(self, user_key):
+        start_time = time.monotonic()
+        with self._cond:
+            if self.running < self.max_concurrent and not self._user_order:
+                self.running += 1
+                self._update_metrics()
+                metrics.observe('admission_wait_seconds', 0, datasource=self.name)
+                return
+
+            ticket = _Ticket(user_key)
+            if user_key not in self._waiting:
+                self._waiting[user_key] = deque()
+                self._user_order.append(user_key)
+            self._waiting[user_key].append(ticket)
+            self._update_metrics()
+
+            deadline = start_time + self.queue_timeout
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            wait_time = time.monotonic() - start_time
+            if not ticket.granted:
+                self._remove(ticket)
+                self._update_metrics()
+                metrics.incr('admission_rejected_total', datasource=self.name)
+                raise DatasourceBusy(
+                    'The datasource is busy running other queries, please try again later.')
+            self._update_metrics()
+            metrics.observe('admission_wait_seconds', wait_time, datasource=self.name)
+
+    def set_limit(self, max_concurrent):
+        '''
+        Changes the number of concurrent queries. Running queries keep
+        their slots, so lowering the limit only holds back new ones.
+        '''
+        with self._cond:
+            self.max_concurrent = max_concurrent
+            self._dispatch()
+            self._update_metrics()
+
+    def release(self):
+        with self._cond:
+            self.running -= 1
+            self._dispatch()
+            self._update_metrics()
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(datasource):
+    max_concurrent = datasource.max_concurrent_queries
+    queue_timeout = datasource.queue_timeout
+    if queue_timeout is None:
+        queue_timeout = settings.QUERY_QUEUE_TIMEOUT
+    with _controllers_lock:
+        controller = _controllers.get(datasource.id)
+        if controller is None:
+            controller = AdmissionController(str(datasource.id),
+                                             max_concurrent, queue_timeout)
+            _controllers[datasource.id] = controller
+        elif controller.max_concurrent != max_concurrent:
+            controller.set_limit(max_concurrent)
+        controller.queue_timeout = queue_timeout
+        return controller
+
+
+@contextmanager
+def admit(datasource, user_key=None):
+    '''
+    Waits for a free query slot on the datasource, raising DatasourceBusy
+    when none frees up within the queue timeout.
+    '''
+    if not datasource.max_concurrent_queries:
+        yield
+        return
+    controller = get_controller(datasource)
+    controller.acquire(user_key)
+    try:
+        yield
+    finally:
+        controller.release()
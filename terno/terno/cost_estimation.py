@@ -0,0 +1,141 @@
+import json
+import logging
+import sqlalchemy
+import terno.admission as admission
+import terno.replicas as replicas
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_cost(datasource, native_sql):
+    '''
+    Asks the datasource for its estimate of the query without running it.
+    Returns a dict with the estimated `rows` and `cost` where the dialect
+    reports them. For BigQuery the cost is the number of bytes the query
+    would process.
+    '''
+    dialect_name = datasource.dialect_name
+    if datasource.type == 'bigquery' or dialect_name == 'bigquery':
+        return _estimate_bigquery(datasource, native_sql)
+    if dialect_name == 'postgresql':
+        return _estimate_postgres(datasource, native_sql)
+    if dialect_name == 'mysql':
+        return _estimate_mysql(datasource, native_sql)
+    return {
+        'supported': False,
+        'method': None,
+        'rows': None,
+        'cost': None,
+    }
+
+
+def _explain(datasource, explain_sql):
+    # Explained where the query would run, on the pooled engines.
+    with replicas.connect(datasource) as con:
+        return con.execute(sqlalchemy.text(explain_sql)).scalar()
+
+
+def _load_json(plan):
+    if isinstance(plan, (str, bytes)):
+        return json.loads(plan)
+    return plan
+
+
+def _estimate_postgres(datasource, native_sql):
+    plan = _load_json(_explain(datasource, f'EXPLAIN (FORMAT JSON) {native_sql}'))
+    plan = plan[0]['Plan']
+    return {
+        'supported': True,
+        'method': 'explain',
+        'rows': plan.get('Plan Rows'),
+        'cost': plan.get('Total Cost'),
+    }
+
+
+def _max_rows_examined(node):
+    rows = 0
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'rows_examined_per_scan':
+                rows = max(rows, int(value))
+            else:
+                rows = max(rows, _max_rows_examined(value))
+    elif isinstance(node, list):
+        for value in node:
+            rows = max(rows, _max_rows_examined(value))
+    return rows
+
+
+def _estimate_mysql(datasource, native_sql):
+    plan = _load_json(_explain(datasource, f'EXPLAIN FORMAT=JSON {native_sql}'))
+    query_block = plan['query_block']
+    cost = query_block.get('cost_info', {}).get('query_cost')
+    return {
+        'supported': True,
+        'method': 'explain',
+        'rows': _max_rows_examined(query_block),
+        'cost': float(cost) if cost is not None else None,
+    }
+
+
+def _estimate_bigquery(datasource, native_sql):
+    from google.cloud import bigquery
+
+    url = sqlalchemy.engine.make_url(datasource.connection_str)
+    client = bigquery.Client.from_service_account_info(
+        datasource.connection_json, project=url.host)
+    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    if url.database:
+        job_config.default_dataset = f'{url.host}.{url.database}'
+    query_job = client.query(native_sql, job_config=job_config)
+    return {
+        'supported': True,
+        'method': 'dry_run',
+        'rows': None,
+        'cost': query_job.total_bytes_processed,
+    }
+
+
+def check_query_cost(datasource, native_sql, user=None):
+    '''
+    Estimates the query cost and compares it with the thresholds of the
+    datasource. The query is rejected only when the estimate exceeds the
+    reject threshold, failures to estimate never block execution. The
+    estimate takes a query slot of the datasource like the query would.
+    '''
+    if not datasource.estimate_cost:
+        return {'status': 'success', 'cost_estimate': None}
+
+    try:
+        with admission.admit(datasource, getattr(user, 'id', None)):
+            estimate = estimate_cost(datasource, native_sql)
+    except admission.DatasourceBusy as e:
+        return {'status': 'busy', 'error': str(e), 'cost_estimate': None}
+    except Exception as e:
+        logger.warning(e)
+        estimate = {
+            'supported': False,
+            'method': None,
+            'rows': None,
+            'cost': None,
+            'error': str(e),
+        }
+
+    estimate['warning'] = None
+    cost = estimate['cost']
+    if cost is None:
+        return {'status': 'success', 'cost_estimate': estimate}
+
+    reject_threshold = datasource.cost_reject_threshold
+    if reject_threshold is not None and cost > reject_threshold:
+        return {
+            'status': 'error',
+            'error': f'The query is too expensive to run. Estimated cost {cost} '
+                     f'exceeds the limit of {reject_threshold}.',
+            'cost_estimate': estimate,
+        }
+    warn_threshold = datasource.cost_warn_threshold
+    if warn_threshold is not None and cost > warn_threshold:
+        estimate['warning'] = f'This query is expensive. Estimated cost {cost} ' \
+                              f'exceeds {warn_threshold}.'
+    return {'status': 'success', 'cost_estimate': estimate}
@@ -0,0 +1,76 @@
+import hashlib
+import re
+from sqlglot import exp
+from sqlglot.optimizer.normalize_identifiers import normalize_identifiers
+from django.db.models import Avg, Count, Max, Sum
+import terno.models as models
+import terno.sql_query as sql_query
+
+
+def _replace_literal(node):
+    if isinstance(node, exp.Neg) and isinstance(node.this, exp.Literal):
+        return exp.Placeholder()
+    if isinstance(node, exp.Literal):
+        return exp.Placeholder()
+    return node
+
+
+def normalize_expression(expression, dialect=None):
+    '''
+    Returns the canonical text of the query: literals are replaced by
+    placeholders, IN lists collapse to a single placeholder, identifiers
+    are normalized to the dialect's case and formatting is regenerated.
+    The given expression is left unchanged.
+    '''
+    expression = normalize_identifiers(expression.copy(), dialect=dialect)
+    expression = expression.transform(_replace_literal, copy=False)
+    for in_expression in expression.find_all(exp.In):
+        values = in_expression.expressions
+        if values and all(isinstance(value, exp.Placeholder) for value in values):
+            in_expression.set('expressions', [exp.Placeholder()])
+    return expression.sql(dialect=dialect)
+
+
+def normalize_text(sql):
+    '''Fallback for SQL that does not parse: collapse case and whitespace.'''
+    return re.sub(r'\s+', ' ', sql).strip().rstrip(';').lower()
+
+
+def normalize(query):
+    try:
+        return normalize_expression(query.expression, query.dialect)
+    except Exception:
+        return normalize_text(query.sql)
+
+
+def fingerprint(query, dialect_name=None):
+    '''
+    Returns a stable hash of the normalized query, so that queries that
+    only differ in literal values or formatting share a fingerprint.
+    Accepts a ParsedQuery, whose AST is reused, or plain SQL text.
+    '''
+    if isinstance(query, str):
+        query = sql_query.ParsedQuery(query, dialect_name)
+    return hashlib.sha256(normalize(query).encode('utf-8')).hexdigest()
+
+
+def fingerprint_stats(data_source=None, since=None, data_type='actual_executed_sql'):
+    '''
+    Aggregates QueryHistory per fingerprint: how often the query ran,
+    its latency and the number of rows it returned, most frequent first.
+    '''
+    history = models.QueryHistory.objects.filter(
+        data_type=data_type, fingerprint__isnull=False)
+    if data_source is not None:
+        history = history.filter(data_source=data_source)
+    if since is not None:
+        history = history.filter(created_at__gte=since)
+    return history.values('fingerprint').annotate(
+        count=Count('id'),
+        avg_execution_time=Avg('execution_time'),
+        max_execution_time=Max('execution_time'),
+        total_rows=Sum('row_count'),
+        avg_rows=Avg('row_count'),
+        example=Max('data'),
+        last_seen=Max('created_at'),
+    ).order_by('-count')
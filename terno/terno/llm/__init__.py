@@ -5,6 +5,7 @@ from .fake import FakeLLM
 from .gemini import GeminiLLM
 from .openai import OpenAILLM
 from .ollama import OllamaLLM
+from .resilience import ResilientLLM
 
 __all__ = [
     "AnthropicLLM",
@@ -15,4 +16,5 @@ __all__ = [
     "GeminiLLM",
     "OllamaLLM",
     "OpenAILLM",
+    "ResilientLLM",
 ]
@@ -1,5 +1,7 @@
 import anthropic
 from .base import BaseLLM
+from . import clients
+from django.conf import settings
 
 
 class AnthropicLLM(BaseLLM):
@@ -18,6 +20,10 @@ class AnthropicLLM(BaseLLM):
     """Limits the model to consider only the top k most probable next words.
     A lower value reduces randomness by restricting the choice to fewer words,
     ensuring more deterministic and focused output."""
+    system_message = anthropic.NOT_GIVEN
+    """System prompt. The prompts of terno are sent as messages instead."""
+    prompt_caching_header = {"anthropic-beta": "prompt-caching-2024-07-31"}
+    """Enables the cache_control marks of the messages."""
 
     def __init__(self, api_key: str,
                  model_name: str = None,
@@ -34,20 +40,57 @@ class AnthropicLLM(BaseLLM):
         self.top_k = top_k if top_k is not None else self.top_k
 
     def get_model_instance(self):
-        client = anthropic.Anthropic(api_key=self.api_key)
-        return client
+        return clients.get_client(
+            'anthropic',
+            lambda: anthropic.Anthropic(
+                api_key=self.api_key,
+                timeout=settings.LLM_REQUEST_TIMEOUT,
+                # Retries are done by terno.llm.resilience.
+                max_retries=0,
+                http_client=anthropic.DefaultHttpxClient(limits=clients.http_limits()),
+            ),
+            api_key=self.api_key)
+
+    def get_async_model_instance(self):
+        return clients.get_async_client(
+            'anthropic',
+            lambda: anthropic.AsyncAnthropic(
+                api_key=self.api_key,
+                timeout=settings.LLM_REQUEST_TIMEOUT,
+                # Retries are done by terno.llm.resilience.
+                max_retries=0,
+                http_client=anthropic.DefaultAsyncHttpxClient(limits=clients.http_limits()),
+            ),
+            api_key=self.api_key)
 
     def create_message_for_llm(self, system_prompt, ai_prompt, human_prompt):
+        # The system prompt and schema are the same for every question on
+        # a datasource, marking their end lets Anthropic cache the prefix.
+        schema_content = ai_prompt
+        if settings.LLM_PROMPT_CACHING:
+            schema_content = [{"type": "text", "text": ai_prompt,
+                               "cache_control": {"type": "ephemeral"}}]
         messages = [
                 {"role": "user", "content": system_prompt},
-                {"role": "assistant", "content": ai_prompt},
+                {"role": "assistant", "content": schema_content},
                 {"role": "user", "content": human_prompt},
             ]
         return messages
 
-    def get_response(self, messages) -> str:
-        model = self.get_model_instance()
-        response = model.messages.create(
+    def record_response_usage(self, usage, finish_reason=None):
+        """Records the usage of a response, with the prompt tokens Anthropic cached."""
+        cache_creation_tokens = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        cached_tokens = getattr(usage, 'cache_read_input_tokens', None) or 0
+        # input_tokens only counts the prompt tokens after the cached prefix.
+        prompt_tokens = usage.input_tokens + cache_creation_tokens + cached_tokens
+        self.record_usage(prompt_tokens, usage.output_tokens, cached_tokens, finish_reason)
+
+    def get_request_parameters(self, messages):
+        extra_headers = None
+        if settings.LLM_PROMPT_CACHING:
+            extra_headers = self.prompt_caching_header
+        return dict(
+                extra_headers=extra_headers,
                 model=self.model_name,
                 max_tokens=self.max_tokens,
                 temperature=self.temperature,
@@ -57,5 +100,31 @@ class AnthropicLLM(BaseLLM):
                 top_k=self.top_k,
                 **self.custom_parameters
             )
-        response = response.content.strip().removeprefix("```sql").removesuffix("```")
+
+    def get_response(self, messages) -> str:
+        model = self.get_model_instance()
+        response = model.messages.create(**self.get_request_parameters(messages))
+        self.record_response_usage(response.usage, response.stop_reason)
+        response = ''.join(block.text for block in response.content
+                           if block.type == 'text')
+        response = response.strip().removeprefix("```sql").removesuffix("```")
+        return response
+
+    async def get_response_async(self, messages) -> str:
+        if not clients.async_clients_enabled():
+            return await super().get_response_async(messages)
+        model = self.get_async_model_instance()
+        response = await model.messages.create(**self.get_request_parameters(messages))
+        self.record_response_usage(response.usage, response.stop_reason)
+        response = ''.join(block.text for block in response.content
+                           if block.type == 'text')
+        response = response.strip().removeprefix("```sql").removesuffix("```")
         return response
+
+    def stream_response(self, messages):
+        model = self.get_model_instance()
+        with model.messages.stream(**self.get_request_parameters(messages)) as stream:
+            for text in stream.text_stream:
+                yield text
+            message = stream.get_final_message()
+            self.record_response_usage(message.usage, message.stop_reason)
@@ -1,9 +1,21 @@
+import copy
+import threading
+import time
 from abc import ABC, abstractmethod
-from django.core.exceptions import ObjectDoesNotExist
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Count, Max
 from ..models import LLMConfiguration
+import terno.metrics as metrics
+from . import clients, usage
 
 
 class BaseLLM(ABC):
+    cache_responses: bool = False
+    """Cache responses even when sampling is not deterministic."""
+    role: str = "default"
+    """Role of the configuration the llm was built from, see LLMFactory."""
+
     @abstractmethod
     def __init__(self, api_key: str, **kwargs):
         self.api_key = api_key
@@ -21,14 +33,137 @@ class BaseLLM(ABC):
     def get_response(self, query: str) -> str:
         pass
 
+    async def get_response_async(self, messages) -> str:
+        """
+        Awaitable get_response. Providers with an async SDK client do not
+        hold a thread while waiting for the response, the others run
+        get_response in a worker thread.
+        """
+        return await sync_to_async(self.get_response, thread_sensitive=False)(messages)
+
+    def with_temperature(self, temperature):
+        """Copy of the llm sampling at the given temperature, uncached."""
+        llm = copy.copy(self)
+        llm.temperature = temperature
+        llm.cache_responses = False
+        return llm
+
+    @property
+    def provider_name(self) -> str:
+        return type(self).__name__
+
+    def record_usage(self, prompt_tokens=0, completion_tokens=0, cached_tokens=0,
+                     finish_reason=None):
+        """
+        Records the usage of a response, see terno.llm.usage. cached_tokens
+        are the prompt tokens the provider read from its prompt cache.
+        """
+        usage.record(usage.LLMCallUsage(
+            self.provider_name, getattr(self, 'model_name', None), prompt_tokens,
+            completion_tokens, cached_tokens, finish_reason))
+        provider = self.provider_name
+        metrics.incr('llm_prompt_tokens_total', value=prompt_tokens or 0, provider=provider)
+        metrics.incr('llm_completion_tokens_total', value=completion_tokens or 0,
+                     provider=provider)
+        metrics.incr('llm_cached_prompt_tokens_total', value=cached_tokens or 0,
+                     provider=provider)
+
+    def stream_response(self, messages):
+        """
+        Yields the response in chunks as the provider generates it.
+        Providers that can not stream yield the whole response at once.
+        """
+        yield self.get_response(messages)
+
+    @staticmethod
+    def extract_sql(response: str) -> str:
+        return response.strip().removeprefix("```sql").removesuffix("```").strip()
+
 
 class LLMFactory:
+    # (config version, monotonic time it was checked, llms by role) of this process
+    _cached = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def invalidate(cls):
+        '''Drops the llms of this process, the next request builds them again.'''
+        with cls._lock:
+            cls._cached = None
+
     @staticmethod
-    def create_llm() -> BaseLLM:
-        try:
-            config = LLMConfiguration.objects.get(enabled=True)
-        except ObjectDoesNotExist:
+    def get_config_version():
+        '''
+        Version of the configurations, read from the database so that every
+        worker sees a change made through another one. It moves whenever a
+        configuration is saved or deleted.
+        '''
+        version = LLMConfiguration.objects.aggregate(
+            count=Count('id'), last_id=Max('id'), updated_at=Max('updated_at'))
+        return (version['count'], version['last_id'], version['updated_at'])
+
+    @classmethod
+    def get_llms(cls) -> dict:
+        '''
+        Returns the llms of the enabled configurations keyed by role. They
+        are built once and reused until the configuration version changes,
+        which is checked at most every LLM_CONFIG_CHECK_INTERVAL seconds.
+        '''
+        now = time.monotonic()
+        with cls._lock:
+            cached = cls._cached
+        if cached is not None and now - cached[1] < settings.LLM_CONFIG_CHECK_INTERVAL:
+            return cached[2]
+
+        version = cls.get_config_version()
+        if cached is not None and cached[0] == version:
+            llms = cached[2]
+        else:
+            if cached is not None:
+                # Changed through another worker, whose signal only
+                # dropped the SDK clients of that worker.
+                clients.clear()
+            llms = cls.build_llms()
+        with cls._lock:
+            cls._cached = (version, now, llms)
+        return llms
+
+    @classmethod
+    def create_llm(cls, question=None, db_schema=None, role=None) -> BaseLLM:
+        '''
+        Returns the llm of the given role, or the one the router picks for
+        the question and schema.
+        '''
+        from . import routing
+        llms = cls.get_llms()
+        if role is not None:
+            if role not in llms:
+                raise ValueError(f"No enabled LLM configuration with the {role} role.")
+            return llms[role]
+        return routing.choose(llms, question, db_schema)
+
+    @staticmethod
+    def build_llms() -> dict:
+        configs = LLMConfiguration.objects.filter(enabled=True) \
+            .select_related('fallback').order_by('id')
+        llms = {config.role: LLMFactory.build_llm(config) for config in configs}
+        if not llms:
             raise ValueError("No enabled LLM configuration found.")
+        return llms
+
+    @staticmethod
+    def build_llm(config) -> BaseLLM:
+        from .resilience import ResilientLLM
+        fallback = None
+        if config.fallback is not None:
+            fallback = LLMFactory.llm_from_config(config.fallback)
+        llm = ResilientLLM(LLMFactory.llm_from_config(config), fallback)
+        llm.cache_responses = config.cache_responses
+        llm.role = config.role
+        return llm
+
+    @staticmethod
+    def llm_from_config(config) -> BaseLLM:
         common_params = {
                 'api_key': config.api_key,
                 'model_name': config.model_name,
@@ -51,6 +186,9 @@ class LLMFactory:
         elif config.llm_type == "ollama":
             from .ollama import OllamaLLM
             return OllamaLLM(**custom_params)
+        elif config.llm_type == "fake":
+            from .fake import FakeLLM
+            return FakeLLM(**common_params, **custom_params)
         elif config.llm_type == "custom":
             from .custom_llm import CustomLLM
             return CustomLLM(
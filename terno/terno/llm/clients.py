@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import logging
+import threading
+import weakref
+import httpx
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_clients = {}
+_clients_lock = threading.Lock()
+# Async clients are bound to the event loop they were created on.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _client_key(provider, api_key, host):
+    api_key_hash = None
+    if api_key:
+        api_key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+    return (provider, api_key_hash, host)
+
+
+def http_limits():
+    '''Connection pool limits of the HTTP clients given to the SDKs.'''
+    return httpx.Limits(
+        max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+        keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY)
+
+
+def get_client(provider, create, api_key=None, host=None):
+    '''
+    Returns the SDK client of the provider for this API key and host,
+    calling `create` to build it the first time. Clients are shared by
+    all requests of the process so their connections are kept alive.
+    '''
+    key = _client_key(provider, api_key, host)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = create()
+            _clients[key] = client
+        return client
+
+
+def async_clients_enabled():
+    '''
+    Whether providers call their async SDK clients. Those are bound to an
+    event loop, which only lives as long as the process under ASGI. Under
+    WSGI every async view runs on a loop of its own, so the async calls
+    use the shared sync clients in a thread instead, see
+    BaseLLM.get_response_async.
+    '''
+    return settings.LLM_ASYNC_CLIENTS
+
+
+def get_async_client(provider, create, api_key=None, host=None):
+    '''get_client for async SDK clients, cached per running event loop.'''
+    key = _client_key(provider, api_key, host)
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        loop_clients = _async_clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is None:
+            client = create()
+            loop_clients[key] = client
+        return client
+
+
+def _close(clients):
+    '''Closes the connection pools of clients that are no longer used.'''
+    for client in clients:
+        try:
+            if hasattr(client, 'close'):
+                client.close()
+            elif hasattr(client, 'transport'):
+                # Google API clients close through their transport.
+                client.transport.close()
+            # The ollama client can not be closed, the garbage collector
+            # closes its connections.
+        except Exception as e:
+            logger.warning(e)
+
+
+async def _aclose(async_clients):
+    for client in async_clients:
+        close = getattr(client, 'close', None)
+        if close is None and hasattr(client, 'transport'):
+            close = client.transport.close
+        if close is None:
+            continue
+        try:
+            await close()
+        except Exception as e:
+            logger.warning(e)
+
+
+def clear():
+    '''
+    Drops all clients, the next request builds new ones. Requests of
+    other threads may still be using the dropped clients, so they are
+    closed LLM_CLIENT_CLOSE_DELAY seconds later.
+    '''
+    with _clients_lock:
+        sync_clients = list(_clients.values())
+        _clients.clear()
+        loops = list(_async_clients.items())
+        _async_clients.clear()
+    delay = settings.LLM_CLIENT_CLOSE_DELAY
+    if sync_clients:
+        timer = threading.Timer(delay, _close, [sync_clients])
+        timer.daemon = True
+        timer.start()
+    for loop, loop_clients in loops:
+        # Async clients are closed on their own loop, if it still runs.
+        if not loop.is_closed():
+            async_clients = list(loop_clients.values())
+            loop.call_soon_threadsafe(
+                loop.call_later, delay,
+                lambda loop=loop, async_clients=async_clients:
+                    loop.create_task(_aclose(async_clients)))
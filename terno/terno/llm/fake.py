@@ -1,17 +1,147 @@
+import asyncio
+import functools
+import json
+import math
+import random
+import re
+import time
 from .base import BaseLLM
 
+LATENCY_DISTRIBUTIONS = ('constant', 'uniform', 'normal', 'lognormal', 'exponential')
+
+
+class FakeLLMError(Exception):
+    '''Error the fake llm raises at its error rate, like a provider would.'''
+
+    def __init__(self, status_code):
+        super().__init__(f'Fake llm error {status_code}')
+        self.status_code = status_code
+
+
+@functools.lru_cache(maxsize=16)
+def load_fixtures(path):
+    '''Reads a JSON object mapping questions to the SQL answering them.'''
+    with open(path) as fixtures_file:
+        fixtures = json.load(fixtures_file)
+    if not isinstance(fixtures, dict):
+        raise ValueError('Fixtures must be a JSON object mapping questions to SQL.')
+    return {normalize_question(question): sql for question, sql in fixtures.items()}
+
+
+def normalize_question(question):
+    return ' '.join(question.lower().split()).rstrip('?.!')
+
 
 class FakeLLM(BaseLLM):
+    '''
+    Llm answering without calling a provider, to load test and benchmark
+    a deployment offline. Known questions are answered with the SQL of
+    the fixtures, a JSON object mapping questions to SQL given inline or
+    as the path of a file, the others with default_sql.
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
+    latency, in seconds, is sampled from latency_distribution, one of
+    constant, uniform, normal, lognormal and exponential, with mean
+    latency and standard deviation latency_stddev. A share error_rate of
+    the calls fail with error_status. Streamed responses are sent
+    chunk_size words at a time, chunk_interval seconds apart.
+    '''
+    model_name: str = "fake"
+
+    def __init__(self,
+                 api_key: str = None,
+                 model_name: str = None,
+                 temperature: float = None,
+                 max_tokens: int = None,
+                 top_p: float = None,
+                 latency: float = 0,
+                 latency_distribution: str = 'constant',
+                 latency_stddev: float = 0,
+                 error_rate: float = 0,
+                 error_status: int = 503,
+                 chunk_size: int = 1,
+                 chunk_interval: float = 0,
+                 fixtures=None,
+                 default_sql: str = "SELECT 1",
+                 seed: int = None,
+                 **kwargs):
+        super().__init__(api_key, **kwargs)
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {latency_distribution}")
+        self.model_name = model_name or self.model_name
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.top_p = top_p
+        self.latency = latency
+        self.latency_distribution = latency_distribution
+        self.latency_stddev = latency_stddev
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.chunk_size = max(1, chunk_size)
+        self.chunk_interval = chunk_interval
+        if isinstance(fixtures, str):
+            fixtures = load_fixtures(fixtures)
+        elif fixtures:
+            fixtures = {normalize_question(question): sql for question, sql in fixtures.items()}
+        self.fixtures = fixtures or {}
+        self.default_sql = default_sql
+        self.random = random.Random(seed)
 
     def get_model_instance(self):
         pass
 
     def create_message_for_llm(self, system_prompt, ai_prompt, human_prompt):
-        return []
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "assistant", "content": ai_prompt},
+            {"role": "user", "content": human_prompt},
+        ]
+        return messages
+
+    def sample_latency(self):
+        mean, stddev = self.latency, self.latency_stddev
+        if self.latency_distribution == 'uniform':
+            return self.random.uniform(max(0, mean - stddev * math.sqrt(3)),
+                                       mean + stddev * math.sqrt(3))
+        if self.latency_distribution == 'normal':
+            return max(0, self.random.gauss(mean, stddev))
+        if self.latency_distribution == 'lognormal' and mean > 0:
+            sigma = math.sqrt(math.log(1 + (stddev / mean) ** 2))
+            return self.random.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)
+        if self.latency_distribution == 'exponential' and mean > 0:
+            return self.random.expovariate(1 / mean)
+        return mean
+
+    def generate_sql(self, messages):
+        '''Returns the SQL answering the question, or raises at the error rate.'''
+        if self.error_rate and self.random.random() < self.error_rate:
+            raise FakeLLMError(self.error_status)
+        question = next((message['content'] for message in reversed(messages)
+                         if isinstance(message, dict) and message.get('role') == 'user'), '')
+        match = re.search(r'Human Question: (.*)', question)
+        if match:
+            question = match.group(1)
+        sql = self.fixtures.get(normalize_question(question), self.default_sql)
+
+        # Roughly four characters per token.
+        self.record_usage(len(str(messages)) // 4, len(sql) // 4 + 1, 0, 'stop')
+        return sql
+
+    def chunks(self, sql):
+        words = re.findall(r'\s*\S+', sql)
+        for index in range(0, len(words), self.chunk_size):
+            yield ''.join(words[index:index + self.chunk_size])
 
     def get_response(self, messages) -> str:
-        self.get_model_instance()
-        return "SELECT 1"
+        time.sleep(self.sample_latency())
+        return self.generate_sql(messages)
+
+    async def get_response_async(self, messages) -> str:
+        await asyncio.sleep(self.sample_latency())
+        return self.generate_sql(messages)
+
+    def stream_response(self, messages):
+        time.sleep(self.sample_latency())
+        for index, chunk in enumerate(self.chunks(self.generate_sql(messages))):
+            if index and self.chunk_interval:
+                time.sleep(self.chunk_interval)
+            yield chunk
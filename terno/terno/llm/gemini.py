@@ -1,6 +1,15 @@
 from .base import BaseLLM
+from . import clients
+import google.ai.generativelanguage as glm
 import google.generativeai as genai
 
+# The SDK has no option to pass a client to a model. google-generativeai
+# 0.7, pinned in requirements.txt, reads the private `_client` and
+# `_async_client` attributes of the model before the process wide client,
+# so the cached clients are set there. Other versions fall back to
+# genai.configure and async calls in a thread.
+CACHED_CLIENTS_SUPPORTED = genai.__version__.startswith('0.7.')
+
 
 class GeminiLLM(BaseLLM):
     supported_system_instructions_model = ["gemini-1.5-flash-001",
@@ -51,32 +60,90 @@ class GeminiLLM(BaseLLM):
         else:
             raise ValueError(f"This model is not currently supported: {self.model_name}")
 
+        if not self.cached_clients_supported(model):
+            genai.configure(api_key=self.api_key)
+            return model
+        # genai.configure replaces the process wide client on every call,
+        # so the model is given the cached client of this API key instead.
+        model._client = clients.get_client(
+            'gemini',
+            lambda: glm.GenerativeServiceClient(client_options={'api_key': self.api_key}),
+            api_key=self.api_key)
         return model
 
+    @staticmethod
+    def cached_clients_supported(model):
+        return CACHED_CLIENTS_SUPPORTED and hasattr(model, '_client') \
+            and hasattr(model, '_async_client')
+
     def create_message_for_llm(self, system_prompt, ai_prompt, human_prompt):
         messages = [{'role': 'system', 'parts': [system_prompt]},
                     {'role': 'model', 'parts': [ai_prompt]},
                     {'role': 'user', 'parts': [human_prompt]}]
         return messages
 
-    def get_response(self, messages) -> str:
+    def get_generation_config(self):
+        return dict(
+            {
+                "temperature": self.temperature,
+                "top_p": self.top_p,
+                "max_output_tokens": self.max_tokens,
+                "top_k": self.top_k,
+                **self.custom_parameters
+            }
+        )
+
+    def generate_content(self, messages, stream=False):
         system_prompt = messages[0]['parts'][0]
         messages = messages[1:]
-        genai.configure(api_key=self.api_key)
         model = self.get_model_instance(system_prompt)
-        response = model.generate_content(
+        return model.generate_content(
             contents=messages,
-            generation_config=dict(
-                {
-                    "temperature": self.temperature,
-                    "top_p": self.top_p,
-                    "max_output_tokens": self.max_tokens,
-                    "top_k": self.top_k,
-                    **self.custom_parameters
-                }
-            ),
+            generation_config=self.get_generation_config(),
+            stream=stream,
         )
 
+    def record_response_usage(self, response):
+        """Records the usage of a response, or of the last chunk of a stream."""
+        usage = response.usage_metadata
+        finish_reason = None
+        if response.candidates:
+            finish_reason = response.candidates[0].finish_reason.name
+        self.record_usage(usage.prompt_token_count, usage.candidates_token_count,
+                          usage.cached_content_token_count, finish_reason)
+
+    def get_response(self, messages) -> str:
+        response = self.generate_content(messages)
+        self.record_response_usage(response)
+
         response = response.text.strip().removeprefix("```sql").removesuffix("```")
 
         return response
+
+    async def get_response_async(self, messages) -> str:
+        if not clients.async_clients_enabled():
+            return await super().get_response_async(messages)
+        model = self.get_model_instance(messages[0]['parts'][0])
+        if not self.cached_clients_supported(model):
+            return await super().get_response_async(messages)
+        model._async_client = clients.get_async_client(
+            'gemini',
+            lambda: glm.GenerativeServiceAsyncClient(client_options={'api_key': self.api_key}),
+            api_key=self.api_key)
+        response = await model.generate_content_async(
+            contents=messages[1:],
+            generation_config=self.get_generation_config(),
+        )
+        self.record_response_usage(response)
+
+        response = response.text.strip().removeprefix("```sql").removesuffix("```")
+
+        return response
+
+    def stream_response(self, messages):
+        chunk = None
+        for chunk in self.generate_content(messages, stream=True):
+            if chunk.text:
+                yield chunk.text
+        if chunk is not None:
+            self.record_response_usage(chunk)
@@ -1,4 +1,6 @@
 from terno.llm import BaseLLM
+from . import clients
+from django.conf import settings
 import ollama
 
 
@@ -19,8 +21,18 @@ class OllamaLLM(BaseLLM):
         self.host = host if host is not None else self.host
 
     def get_model_instance(self):
-        client = ollama.Client(host=self.host)
-        return client
+        return clients.get_client(
+            'ollama',
+            lambda: ollama.Client(host=self.host, limits=clients.http_limits(),
+                                 timeout=settings.LLM_REQUEST_TIMEOUT),
+            host=self.host)
+
+    def get_async_model_instance(self):
+        return clients.get_async_client(
+            'ollama',
+            lambda: ollama.AsyncClient(host=self.host, limits=clients.http_limits(),
+                                      timeout=settings.LLM_REQUEST_TIMEOUT),
+            host=self.host)
 
     def create_message_for_llm(self, system_prompt, ai_prompt, human_prompt):
         messages = [
@@ -30,7 +42,35 @@ class OllamaLLM(BaseLLM):
         ]
         return messages
 
+    def record_response_usage(self, response):
+        """Records the usage of a response, or of the last chunk of a stream."""
+        self.record_usage(response.get('prompt_eval_count'), response.get('eval_count'),
+                          None, response.get('done_reason'))
+
+    def options(self):
+        return {'temperature': self.temperature}
+
     def get_response(self, messages) -> str:
         model = self.get_model_instance()
-        response = model.chat(model=self.model_name, messages=messages)
+        response = model.chat(model=self.model_name, messages=messages,
+                              options=self.options())
+        self.record_response_usage(response)
         return response['message']['content']
+
+    async def get_response_async(self, messages) -> str:
+        if not clients.async_clients_enabled():
+            return await super().get_response_async(messages)
+        model = self.get_async_model_instance()
+        response = await model.chat(model=self.model_name, messages=messages,
+                                    options=self.options())
+        self.record_response_usage(response)
+        return response['message']['content']
+
+    def stream_response(self, messages):
+        model = self.get_model_instance()
+        for chunk in model.chat(model=self.model_name, messages=messages,
+                                options=self.options(), stream=True):
+            if chunk['message']['content']:
+                yield chunk['message']['content']
+            if chunk.get('done'):
+                self.record_response_usage(chunk)
@@ -1,5 +1,7 @@
 from .base import BaseLLM
-from openai import OpenAI
+from . import clients
+from django.conf import settings
+import openai
 
 
 class OpenAILLM(BaseLLM):
@@ -36,10 +38,28 @@ class OpenAILLM(BaseLLM):
         self.top_p = top_p if top_p is not None else self.top_p
 
     def get_model_instance(self):
-        client = OpenAI(
-            api_key=self.api_key,
-        )
-        return client
+        return clients.get_client(
+            'openai',
+            lambda: openai.OpenAI(
+                api_key=self.api_key,
+                timeout=settings.LLM_REQUEST_TIMEOUT,
+                # Retries are done by terno.llm.resilience.
+                max_retries=0,
+                http_client=openai.DefaultHttpxClient(limits=clients.http_limits()),
+            ),
+            api_key=self.api_key)
+
+    def get_async_model_instance(self):
+        return clients.get_async_client(
+            'openai',
+            lambda: openai.AsyncOpenAI(
+                api_key=self.api_key,
+                timeout=settings.LLM_REQUEST_TIMEOUT,
+                # Retries are done by terno.llm.resilience.
+                max_retries=0,
+                http_client=openai.DefaultAsyncHttpxClient(limits=clients.http_limits()),
+            ),
+            api_key=self.api_key)
 
     def create_message_for_llm(self, system_prompt, ai_prompt, human_prompt):
         messages = [
@@ -49,6 +69,19 @@ class OpenAILLM(BaseLLM):
         ]
         return messages
 
+    def record_response_usage(self, usage, finish_reason=None):
+        """Records the usage of a response, with the prompt tokens OpenAI cached."""
+        if usage is None:
+            return
+        # Older SDKs keep fields they do not know about as plain dicts.
+        details = getattr(usage, 'prompt_tokens_details', None)
+        if isinstance(details, dict):
+            cached_tokens = details.get('cached_tokens')
+        else:
+            cached_tokens = getattr(details, 'cached_tokens', None)
+        self.record_usage(usage.prompt_tokens, usage.completion_tokens, cached_tokens,
+                          finish_reason)
+
     def get_response(self, messages) -> str:
         model = self.get_model_instance()
         response = model.chat.completions.create(
@@ -59,6 +92,45 @@ class OpenAILLM(BaseLLM):
             top_p=self.top_p,
             **self.custom_parameters
         )
+        self.record_response_usage(response.usage, response.choices[0].finish_reason)
         response = response.choices[0].message.content
         response = response.strip().removeprefix("```sql").removesuffix("```")
         return response
+
+    async def get_response_async(self, messages) -> str:
+        if not clients.async_clients_enabled():
+            return await super().get_response_async(messages)
+        model = self.get_async_model_instance()
+        response = await model.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            top_p=self.top_p,
+            **self.custom_parameters
+        )
+        self.record_response_usage(response.usage, response.choices[0].finish_reason)
+        response = response.choices[0].message.content
+        response = response.strip().removeprefix("```sql").removesuffix("```")
+        return response
+
+    def stream_response(self, messages):
+        model = self.get_model_instance()
+        stream = model.chat.completions.create(
+            model=self.model_name,
+            messages=messages,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            top_p=self.top_p,
+            stream=True,
+            stream_options={"include_usage": True},
+            **self.custom_parameters
+        )
+        finish_reason = None
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if chunk.choices and chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            if chunk.usage is not None:
+                self.record_response_usage(chunk.usage, finish_reason)
@@ -0,0 +1,485 @@
+import asyncio
+import logging
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from django.conf import settings
+import httpx
+from .base import BaseLLM
+from . import usage
+import terno.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses worth trying again: timeouts, rate limits and server errors.
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+CONFIGURATION_STATUS_CODES = {401, 403, 404}
+
+
+class LLMTimeoutError(TimeoutError):
+    '''The provider did not answer before the deadline of the call.'''
+
+
+class CircuitOpenError(Exception):
+    '''The provider failed too often recently and is not being called.'''
+
+
+def is_retryable(error):
+    if isinstance(error, (TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    # openai and anthropic errors carry status_code, google api errors code.
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(error, 'code', None)
+    if isinstance(status_code, int):
+        return status_code in RETRYABLE_STATUS_CODES
+    name = type(error).__name__
+    return name in ('APIConnectionError', 'APITimeoutError', 'RateLimitError',
+                    'ResourceExhausted', 'ServiceUnavailable', 'DeadlineExceeded')
+
+
+def is_configuration_error(error):
+    '''
+    Whether the provider rejected the credentials or the model, which
+    retrying does not fix but another provider might.
+    '''
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(error, 'code', None)
+    if isinstance(status_code, int):
+        return status_code in CONFIGURATION_STATUS_CODES
+    name = type(error).__name__
+    return name in ('AuthenticationError', 'PermissionDeniedError', 'NotFoundError',
+                    'Unauthenticated', 'PermissionDenied', 'NotFound')
+
+
+def backoff_delay(attempt):
+    '''Exponential backoff with full jitter for the given retry attempt.'''
+    delay = min(settings.LLM_RETRY_BACKOFF_MAX,
+                settings.LLM_RETRY_BACKOFF * (2 ** attempt))
+    return random.uniform(0, delay)
+
+
+class CircuitBreaker():
+    '''
+    Stops calling a provider after LLM_CIRCUIT_FAILURE_THRESHOLD failures
+    in a row. After LLM_CIRCUIT_RESET_TIMEOUT seconds one call is let
+    through, its success closes the circuit again.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < settings.LLM_CIRCUIT_RESET_TIMEOUT:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= settings.LLM_CIRCUIT_FAILURE_THRESHOLD:
+                if self.state != self.OPEN:
+                    logger.warning(f'Opening the circuit of {self.name}')
+                    metrics.incr('llm_circuit_opened_total', provider=self.name)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker():
+    '''Latencies of the last successful calls to a provider.'''
+
+    def __init__(self, size=100):
+        self.samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def record(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def percentile(self, percent):
+        with self._lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        index = max(0, math.ceil(percent / 100 * len(samples)) - 1)
+        return samples[index]
+
+
+class ProviderHealth():
+    '''Circuit breaker, latencies and outcomes of the last calls to a provider.'''
+
+    def __init__(self, name):
+        self.name = name
+        self.breaker = CircuitBreaker(name)
+        self.latencies = LatencyTracker()
+        self.outcomes = deque(maxlen=100)
+
+    def record_success(self, latency=None):
+        self.breaker.record_success()
+        self.outcomes.append(True)
+        if latency is not None:
+            self.latencies.record(latency)
+
+    def record_failure(self):
+        self.breaker.record_failure()
+        self.outcomes.append(False)
+
+    def error_rate(self):
+        outcomes = list(self.outcomes)
+        if not outcomes:
+            return 0
+        return outcomes.count(False) / len(outcomes)
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_health(llm):
+    name = llm.provider_name
+    model_name = getattr(llm, 'model_name', None)
+    if model_name:
+        name = f'{name}:{model_name}'
+    with _providers_lock:
+        health = _providers.get(name)
+        if health is None:
+            health = ProviderHealth(name)
+            _providers[name] = health
+        return health
+
+
+def reset():
+    '''Forgets the latencies and circuit states of all providers.'''
+    with _providers_lock:
+        _providers.clear()
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name):
+    '''
+    Threads the blocking provider calls run in, so the caller can stop
+    waiting at the deadline. A call abandoned at its deadline keeps its
+    thread until the SDK gives up on it. Hedged calls wait on the calls
+    of the providers from a pool of their own.
+    '''
+    with _executors_lock:
+        executor = _executors.get(name)
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=settings.LLM_HTTP_MAX_CONNECTIONS * 2,
+                thread_name_prefix=f'terno-llm-{name}')
+            _executors[name] = executor
+        return executor
+
+
+class HedgedMessages(list):
+    '''Messages of the primary llm, with those of the fallback attached.'''
+    fallback = None
+
+
+class ResilientLLM(BaseLLM):
+    '''
+    Wraps the llm of the enabled configuration. Every call gets a deadline
+    of LLM_REQUEST_TIMEOUT seconds, retryable errors are retried with
+    jittered exponential backoff and a circuit breaker stops calling a
+    failing provider. When a fallback llm is configured, failed calls are
+    sent to it, and with LLM_HEDGE_ENABLED a call the primary takes longer
+    than its LLM_HEDGE_PERCENTILE latency to answer is also sent to the
+    fallback, the first answer wins.
+    '''
+
+    def __init__(self, llm, fallback=None):
+        self.llm = llm
+        self.fallback = fallback
+
+    def __getattr__(self, name):
+        # Sampling parameters and the like are those of the primary llm.
+        if name == 'llm':
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+    @property
+    def provider_name(self):
+        return self.llm.provider_name
+
+    def with_temperature(self, temperature):
+        fallback = None
+        if self.fallback is not None:
+            fallback = self.fallback.with_temperature(temperature)
+        llm = ResilientLLM(self.llm.with_temperature(temperature), fallback)
+        llm.role = self.role
+        return llm
+
+    def get_model_instance(self):
+        return self.llm.get_model_instance()
+
+    def create_message_for_llm(self, system_prompt, ai_prompt, human_prompt):
+        messages = HedgedMessages(
+            self.llm.create_message_for_llm(system_prompt, ai_prompt, human_prompt))
+        if self.fallback is not None:
+            messages.fallback = self.fallback.create_message_for_llm(
+                system_prompt, ai_prompt, human_prompt)
+        return messages
+
+    def _fallback_messages(self, messages):
+        return getattr(messages, 'fallback', None) or messages
+
+    def hedge_delay(self):
+        '''Seconds to wait for the primary before also asking the fallback.'''
+        latencies = get_health(self.llm).latencies
+        if len(latencies) < settings.LLM_HEDGE_MIN_SAMPLES:
+            return settings.LLM_HEDGE_DELAY
+        return latencies.percentile(settings.LLM_HEDGE_PERCENTILE)
+
+    @staticmethod
+    def record_rejection(health, error):
+        '''
+        A call the provider rejected. Rejected credentials or models count
+        as failures, so the circuit opens, other bad requests count as
+        neither failure nor success.
+        '''
+        if is_configuration_error(error):
+            health.record_failure()
+
+    def call(self, llm, messages, deadline):
+        '''
+        Returns the response of the llm, retrying retryable errors until
+        LLM_MAX_RETRIES retries are done or the deadline would pass.
+        '''
+        health = get_health(llm)
+        for attempt in range(settings.LLM_MAX_RETRIES + 1):
+            if not health.breaker.allow():
+                raise CircuitOpenError(f'{health.name} is failing, not calling it.')
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LLMTimeoutError(f'{health.name} did not respond in time.')
+
+            start_time = time.monotonic()
+            context, records = usage.detached_context()
+            future = get_executor('calls').submit(context.run, usage.measure, llm, messages)
+            try:
+                response = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                # A call still queued behind a busy pool is dropped, one
+                # already running is left to finish and recorded as timed out.
+                if not future.cancel():
+                    timed_out = usage.failed_call(llm, 'timeout')
+                    timed_out.latency = timed_out.time_to_first_token = \
+                        time.monotonic() - start_time
+                    usage.record(timed_out)
+                    health.record_failure()
+                raise LLMTimeoutError(f'{health.name} did not respond in time.')
+            except Exception as e:
+                usage.record_all(records)
+                if not is_retryable(e):
+                    self.record_rejection(health, e)
+                    raise
+                health.record_failure()
+                delay = backoff_delay(attempt)
+                if attempt == settings.LLM_MAX_RETRIES or \
+                        time.monotonic() + delay >= deadline:
+                    raise
+                logger.warning(f'Retrying {health.name} in {delay:.2f}s: {e}')
+                metrics.incr('llm_retries_total', provider=health.name)
+                time.sleep(delay)
+                continue
+
+            usage.record_all(records)
+            health.record_success(time.monotonic() - start_time)
+            return response
+
+    async def call_async(self, llm, messages, deadline):
+        '''call for async callers.'''
+        health = get_health(llm)
+        for attempt in range(settings.LLM_MAX_RETRIES + 1):
+            if not health.breaker.allow():
+                raise CircuitOpenError(f'{health.name} is failing, not calling it.')
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LLMTimeoutError(f'{health.name} did not respond in time.')
+
+            start_time = time.monotonic()
+            try:
+                response = await asyncio.wait_for(
+                    usage.measure_async(llm, messages), remaining)
+            except asyncio.TimeoutError:
+                health.record_failure()
+                raise LLMTimeoutError(f'{health.name} did not respond in time.')
+            except Exception as e:
+                if not is_retryable(e):
+                    self.record_rejection(health, e)
+                    raise
+                health.record_failure()
+                delay = backoff_delay(attempt)
+                if attempt == settings.LLM_MAX_RETRIES or \
+                        time.monotonic() + delay >= deadline:
+                    raise
+                logger.warning(f'Retrying {health.name} in {delay:.2f}s: {e}')
+                metrics.incr('llm_retries_total', provider=health.name)
+                await asyncio.sleep(delay)
+                continue
+
+            health.record_success(time.monotonic() - start_time)
+            return response
+
+    def get_response(self, messages) -> str:
+        deadline = time.monotonic() + settings.LLM_REQUEST_TIMEOUT
+        if self.fallback is None:
+            return self.call(self.llm, messages, deadline)
+
+        if not settings.LLM_HEDGE_ENABLED:
+            try:
+                return self.call(self.llm, messages, deadline)
+            except Exception as e:
+                logger.warning(f'Falling back from {self.llm.provider_name}: {e}')
+                metrics.incr('llm_fallbacks_total')
+                return self.call(self.fallback, self._fallback_messages(messages), deadline)
+
+        executor = get_executor('hedges')
+        calls = {}
+
+        def submit(llm, llm_messages):
+            context, records = usage.detached_context()
+            future = executor.submit(context.run, self.call, llm, llm_messages, deadline)
+            calls[future] = (llm, records)
+            return future
+
+        try:
+            primary = submit(self.llm, messages)
+            done, _ = wait([primary], timeout=self.hedge_delay())
+            if done and primary.exception() is None:
+                return primary.result()
+
+            metrics.incr('llm_hedged_requests_total')
+            hedge = submit(self.fallback, self._fallback_messages(messages))
+            pending = {primary, hedge}
+            error = None
+            while pending:
+                done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()),
+                                     return_when=FIRST_COMPLETED)
+                if not done:
+                    raise LLMTimeoutError('No provider responded in time.')
+                for future in done:
+                    if future.exception() is None:
+                        if future is hedge:
+                            metrics.incr('llm_hedge_wins_total')
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            for future, (llm, records) in calls.items():
+                if future.done():
+                    usage.record_all(records)
+                else:
+                    # The losing call is left running, it is recorded as cancelled.
+                    usage.record(usage.failed_call(llm, 'cancelled'))
+
+    async def get_response_async(self, messages) -> str:
+        deadline = time.monotonic() + settings.LLM_REQUEST_TIMEOUT
+        if self.fallback is None:
+            return await self.call_async(self.llm, messages, deadline)
+
+        if not settings.LLM_HEDGE_ENABLED:
+            try:
+                return await self.call_async(self.llm, messages, deadline)
+            except Exception as e:
+                logger.warning(f'Falling back from {self.llm.provider_name}: {e}')
+                metrics.incr('llm_fallbacks_total')
+                return await self.call_async(
+                    self.fallback, self._fallback_messages(messages), deadline)
+
+        primary = asyncio.ensure_future(self.call_async(self.llm, messages, deadline))
+        done, _ = await asyncio.wait([primary], timeout=self.hedge_delay())
+        if done and primary.exception() is None:
+            return primary.result()
+
+        metrics.incr('llm_hedged_requests_total')
+        hedge = asyncio.ensure_future(self.call_async(
+            self.fallback, self._fallback_messages(messages), deadline))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0, deadline - time.monotonic()),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise LLMTimeoutError('No provider responded in time.')
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            metrics.incr('llm_hedge_wins_total')
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stream_response(self, messages):
+        '''
+        Streams from the primary llm, or from the fallback when the primary
+        fails before its first chunk. Streams are not retried nor hedged.
+        '''
+        providers = [(self.llm, messages)]
+        if self.fallback is not None:
+            providers.append((self.fallback, self._fallback_messages(messages)))
+
+        error = None
+        for llm, llm_messages in providers:
+            health = get_health(llm)
+            if not health.breaker.allow():
+                error = CircuitOpenError(f'{health.name} is failing, not calling it.')
+                continue
+            started = False
+            try:
+                for chunk in usage.measure_stream(llm, llm_messages):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                if is_retryable(e):
+                    health.record_failure()
+                else:
+                    self.record_rejection(health, e)
+                if started:
+                    raise
+                error = e
+                continue
+            health.record_success()
+            return
+        raise error
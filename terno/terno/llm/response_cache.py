@@ -0,0 +1,172 @@
+import hashlib
+import json
+import logging
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from ..models import LLMResponseCache
+import terno.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# Attributes of the llm that change its response to the same messages.
+SAMPLING_PARAMETERS = ['model_name', 'temperature', 'max_tokens', 'top_p',
+                       'top_k', 'host', 'system_message']
+
+
+def is_cacheable(llm):
+    if not settings.LLM_RESPONSE_CACHE_ENABLED:
+        return False
+    return getattr(llm, 'temperature', None) == 0 or llm.cache_responses
+
+
+def cache_key(llm, messages):
+    parameters = {name: getattr(llm, name) for name in SAMPLING_PARAMETERS
+                  if hasattr(llm, name)}
+    payload = json.dumps({
+        'provider': llm.provider_name,
+        'parameters': parameters,
+        'custom_parameters': llm.custom_parameters,
+        'messages': messages,
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def lookup(key):
+    now = timezone.now()
+    updated = LLMResponseCache.objects.filter(key=key, expires_at__gt=now) \
+        .update(hits=F('hits') + 1, last_used_at=now)
+    if not updated:
+        metrics.incr('llm_response_cache_misses_total')
+        return None
+    metrics.incr('llm_response_cache_hits_total')
+    return LLMResponseCache.objects.filter(key=key) \
+        .values_list('response', flat=True).first()
+
+
+def store(key, llm, response):
+    now = timezone.now()
+    LLMResponseCache.objects.filter(key=key).delete()
+    try:
+        with transaction.atomic():
+            LLMResponseCache.objects.create(
+                key=key, provider=llm.provider_name,
+                model_name=getattr(llm, 'model_name', None),
+                response=response, size=len(response.encode('utf-8')),
+                last_used_at=now,
+                expires_at=now + timedelta(seconds=settings.LLM_RESPONSE_CACHE_TTL))
+    except IntegrityError:
+        # Another request stored the same response meanwhile.
+        return
+    evict()
+
+
+def evict():
+    '''
+    Removes expired responses, then the least recently used ones until
+    the cached responses fit in LLM_RESPONSE_CACHE_MAX_BYTES.
+    '''
+    LLMResponseCache.objects.filter(expires_at__lte=timezone.now()).delete()
+    total = LLMResponseCache.objects.aggregate(total=Sum('size'))['total'] or 0
+    excess = total - settings.LLM_RESPONSE_CACHE_MAX_BYTES
+    if excess <= 0:
+        return
+    evicted = []
+    for entry_id, size in LLMResponseCache.objects.order_by('last_used_at') \
+            .values_list('id', 'size').iterator():
+        evicted.append(entry_id)
+        excess -= size
+        if excess <= 0:
+            break
+    LLMResponseCache.objects.filter(id__in=evicted).delete()
+    metrics.incr('llm_response_cache_evictions_total', value=len(evicted))
+
+
+def purge():
+    deleted, _ = LLMResponseCache.objects.all().delete()
+    return deleted
+
+
+def stream_response(llm, messages):
+    '''
+    Generator forwarding the llm's streamed response, or the cached
+    response as a single chunk. Returns whether it came from the cache.
+    '''
+    if not is_cacheable(llm):
+        yield from llm.stream_response(messages)
+        return False
+
+    key = cache_key(llm, messages)
+    try:
+        response = lookup(key)
+    except Exception as e:
+        logger.warning(e)
+        response = None
+    if response is not None:
+        yield response
+        return True
+
+    chunks = []
+    for chunk in llm.stream_response(messages):
+        chunks.append(chunk)
+        yield chunk
+    try:
+        store(key, llm, llm.extract_sql(''.join(chunks)))
+    except Exception as e:
+        logger.warning(e)
+    return False
+
+
+def get_response(llm, messages):
+    '''
+    Returns the llm's response to the messages and whether it came from
+    the cache. Only deterministic requests are cached: temperature 0, or
+    configurations that explicitly enable caching.
+    '''
+    if not is_cacheable(llm):
+        return llm.get_response(messages), False
+
+    key = cache_key(llm, messages)
+    try:
+        response = lookup(key)
+    except Exception as e:
+        logger.warning(e)
+        response = None
+    if response is not None:
+        return response, True
+
+    response = llm.get_response(messages)
+    if not isinstance(response, str):
+        return response, False
+    try:
+        store(key, llm, response)
+    except Exception as e:
+        logger.warning(e)
+    return response, False
+
+
+async def get_response_async(llm, messages):
+    '''get_response for async callers, the cache is read in a thread.'''
+    if not is_cacheable(llm):
+        return await llm.get_response_async(messages), False
+
+    key = cache_key(llm, messages)
+    try:
+        response = await sync_to_async(lookup)(key)
+    except Exception as e:
+        logger.warning(e)
+        response = None
+    if response is not None:
+        return response, True
+
+    response = await llm.get_response_async(messages)
+    if not isinstance(response, str):
+        return response, False
+    try:
+        await sync_to_async(store)(key, llm, response)
+    except Exception as e:
+        logger.warning(e)
+    return response, False
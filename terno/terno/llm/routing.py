@@ -0,0 +1,60 @@
+from django.conf import settings
+from . import resilience
+import terno.metrics as metrics
+
+FAST = 'fast'
+STRONG = 'strong'
+DEFAULT = 'default'
+
+# Roles to try for simple and for complex questions, preferred first.
+SIMPLE_PREFERENCE = [FAST, DEFAULT, STRONG]
+COMPLEX_PREFERENCE = [STRONG, DEFAULT, FAST]
+
+
+def is_complex(question=None, db_schema=None):
+    '''Long questions and large schemas are sent to the strong model.'''
+    return len(question or '') > settings.LLM_ROUTER_QUESTION_LENGTH or \
+        len(db_schema or '') > settings.LLM_ROUTER_SCHEMA_SIZE
+
+
+def is_healthy(llm):
+    health = resilience.get_health(llm)
+    if health.breaker.state == resilience.CircuitBreaker.OPEN:
+        return False
+    if len(health.outcomes) < settings.LLM_ROUTER_MIN_SAMPLES:
+        return True
+    return health.error_rate() <= settings.LLM_ROUTER_MAX_ERROR_RATE
+
+
+def expected_latency(llm):
+    '''Median latency of the llm, 0 until it has answered enough to tell.'''
+    latencies = resilience.get_health(llm).latencies
+    if len(latencies) < settings.LLM_ROUTER_MIN_SAMPLES:
+        return 0
+    return latencies.percentile(50)
+
+
+def choose(llms, question=None, db_schema=None):
+    '''
+    Picks the llm to ask the question from the llms of the enabled
+    configurations, keyed by their role. Complex questions go to the
+    strong model. Simple ones go to the fastest of the other models,
+    going by their observed latency. Models failing too often are only
+    picked when no healthy model is left.
+    '''
+    if len(llms) == 1:
+        return next(iter(llms.values()))
+
+    complex_question = is_complex(question, db_schema)
+    preference = COMPLEX_PREFERENCE if complex_question else SIMPLE_PREFERENCE
+    candidates = [llms[role] for role in preference if role in llms]
+    candidates = [llm for llm in candidates if is_healthy(llm)] or candidates
+
+    if complex_question:
+        llm = candidates[0]
+    else:
+        cheap = [llm for llm in candidates if llm.role != STRONG] or candidates
+        llm = min(cheap, key=expected_latency)
+    metrics.incr('llm_routed_total', role=llm.role)
+    return llm
+
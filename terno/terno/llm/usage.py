@@ -0,0 +1,179 @@
+import asyncio
+import contextvars
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from django.db.models import Avg, Count, Max, Sum
+from django.db.models.functions import TruncDate
+from ..models import LLMUsage
+
+_records = contextvars.ContextVar('terno_llm_usage', default=None)
+
+
+class LLMCallUsage():
+    '''Normalized usage of one call to an llm provider.'''
+
+    def __init__(self, provider, model_name=None, prompt_tokens=None,
+                 completion_tokens=None, cached_tokens=None, finish_reason=None):
+        self.provider = provider
+        self.model_name = model_name
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_tokens = cached_tokens
+        self.finish_reason = finish_reason
+        self.time_to_first_token = None
+        self.latency = None
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+@contextmanager
+def collect():
+    '''
+    Collects the usage of the llm calls made inside the block, including
+    those run in other threads or tasks that copied the context.
+    '''
+    records = []
+    token = _records.set(records)
+    try:
+        yield records
+    finally:
+        _records.reset(token)
+
+
+def record(usage):
+    records = _records.get()
+    if records is not None:
+        records.append(usage)
+
+
+def _timed(records, start_time, first_token_time=None):
+    latency = time.monotonic() - start_time
+    for usage in records:
+        usage.latency = latency
+        if first_token_time is None:
+            # Without streaming the first token comes with the response.
+            usage.time_to_first_token = latency
+        else:
+            usage.time_to_first_token = first_token_time - start_time
+        record(usage)
+
+
+def failed_call(llm, finish_reason):
+    '''Usage of a call that failed before the provider reported any.'''
+    return LLMCallUsage(llm.provider_name, getattr(llm, 'model_name', None),
+                        finish_reason=finish_reason)
+
+
+def failure_reason(error):
+    if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+        # Abandoned by the caller, at its deadline or for a faster hedge.
+        return 'cancelled'
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, FutureTimeoutError)):
+        return 'timeout'
+    return 'error'
+
+
+class _Timing():
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.first_token_time = None
+
+
+@contextmanager
+def measuring(llm):
+    '''
+    Records the usage of the call to the llm made inside the block once
+    it is done, even when it fails. A call failing without usage from the
+    provider is recorded with why it failed as finish reason.
+    '''
+    timing = _Timing()
+    records = []
+    token = _records.set(records)
+    try:
+        yield timing
+    except BaseException as e:
+        if not records:
+            records.append(failed_call(llm, failure_reason(e)))
+        raise
+    finally:
+        _records.reset(token)
+        _timed(records, timing.start_time, timing.first_token_time)
+
+
+def measure(llm, messages):
+    '''Asks the llm, timing the call whose usage it records.'''
+    with measuring(llm):
+        return llm.get_response(messages)
+
+
+async def measure_async(llm, messages):
+    '''measure for async callers.'''
+    with measuring(llm):
+        return await llm.get_response_async(messages)
+
+
+def measure_stream(llm, messages):
+    '''Streams the response of the llm, timing its first token.'''
+    with measuring(llm) as timing:
+        for chunk in llm.stream_response(messages):
+            if timing.first_token_time is None:
+                timing.first_token_time = time.monotonic()
+            yield chunk
+
+
+def detached_context():
+    '''
+    Copy of the current context to run a call in another thread, with the
+    list its usage is recorded in. The usage is only recorded for the
+    caller once it passes it to record_all, so a call the caller stopped
+    waiting for is not recorded twice.
+    '''
+    context = contextvars.copy_context()
+    records = []
+    context.run(_records.set, records)
+    return context, records
+
+
+def record_all(records):
+    for usage in records:
+        record(usage)
+
+
+def save(records, user=None, data_source=None, prompt_log=None, query_history=None):
+    '''Persists the usage records of the llm calls made for a question.'''
+    if not records:
+        return []
+    if query_history is not None:
+        user = user or query_history.user
+        data_source = data_source or query_history.data_source
+    return LLMUsage.objects.bulk_create([
+        LLMUsage(user=user, data_source=data_source, prompt_log=prompt_log,
+                 query_history=query_history, **usage.to_dict())
+        for usage in records
+    ])
+
+
+def usage_stats(group_by=('model_name', 'data_source', 'day'), data_source=None,
+                since=None):
+    '''
+    Aggregates the llm usage by any of model_name, provider, data_source
+    and day: number of calls, tokens and latencies, for capacity planning.
+    '''
+    usage = LLMUsage.objects.all()
+    if data_source is not None:
+        usage = usage.filter(data_source=data_source)
+    if since is not None:
+        usage = usage.filter(created_at__gte=since)
+    if 'day' in group_by:
+        usage = usage.annotate(day=TruncDate('created_at'))
+    return usage.values(*group_by).annotate(
+        calls=Count('id'),
+        total_prompt_tokens=Sum('prompt_tokens'),
+        total_completion_tokens=Sum('completion_tokens'),
+        total_cached_tokens=Sum('cached_tokens'),
+        avg_latency=Avg('latency'),
+        max_latency=Max('latency'),
+        avg_time_to_first_token=Avg('time_to_first_token'),
+    ).order_by(*group_by)
@@ -0,0 +1,49 @@
+import threading
+from collections import OrderedDict
+import terno.metrics as metrics
+
+_MISSING = object()
+
+
+class LRUCache():
+    '''
+    Thread safe in-process cache holding at most `max_size` entries,
+    evicting the least recently used one first. Hits and misses are
+    counted on the instance and in the metrics registry under `name`.
+    '''
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+        if value is _MISSING:
+            metrics.incr(f'{self.name}_misses_total')
+            return default
+        metrics.incr(f'{self.name}_hits_total')
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
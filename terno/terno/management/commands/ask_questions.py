@@ -0,0 +1,51 @@
+import sys
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+import terno.models as models
+import terno.question_batch as question_batch
+
+
+class Command(BaseCommand):
+    help = ('Generates SQL for the questions of a file, one per line, and '
+            'writes the results as newline delimited JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('questions', help='File with one question per line, - for stdin.')
+        parser.add_argument('--datasource', type=int, required=True,
+                            help='Id of the datasource to ask the questions on.')
+        parser.add_argument('--user', required=True,
+                            help='Username whose roles restrict the tables used.')
+        parser.add_argument('--output', help='File to write the results to, stdout by default.')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist:
+            raise CommandError(f"No user {options['user']} found.")
+        try:
+            datasource = models.DataSource.objects.get(id=options['datasource'],
+                                                       enabled=True)
+        except models.DataSource.DoesNotExist:
+            raise CommandError('No Datasource found.')
+
+        if options['questions'] == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(options['questions']) as questions_file:
+                lines = questions_file.readlines()
+        questions = [line.strip() for line in lines if line.strip()]
+        error = question_batch.check_questions(questions)
+        if error:
+            raise CommandError(error)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                async_to_sync(self.write)(output, user, datasource, questions)
+        else:
+            async_to_sync(self.write)(self.stdout, user, datasource, questions)
+
+    async def write(self, output, user, datasource, questions):
+        results = question_batch.answer_questions(user, datasource, questions)
+        async for line in question_batch.ndjson(results):
+            output.write(line)
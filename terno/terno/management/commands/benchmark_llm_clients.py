@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from django.core.management.base import BaseCommand
+import terno.llm.clients as clients
+from terno.llm.openai import OpenAILLM
+
+REPLY = {
+    'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0,
+    'model': 'gpt-3.5-turbo',
+    'choices': [{'index': 0, 'finish_reason': 'stop',
+                 'message': {'role': 'assistant', 'content': 'SELECT 1'}}],
+    'usage': {'prompt_tokens': 10, 'completion_tokens': 2, 'total_tokens': 12},
+}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written apart, delayed ACKs would dominate.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps(REPLY).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = ('Times OpenAI calls against a local stub server, with the SDK '
+            'client shared by the calls and with a new client for every call.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200,
+                            help='Number of calls of each kind.')
+
+    def handle(self, *args, **options):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        server.daemon_threads = True
+        server.connections = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_address[1]}/v1'
+        try:
+            with patch.dict(os.environ, {'OPENAI_BASE_URL': base_url}):
+                # Builds the shared client before timing.
+                OpenAILLM(api_key='benchmark').get_response([])
+                cached = self.time_calls(server, options['calls'], lambda number: 'benchmark')
+                # Every API key gets a client of its own.
+                uncached = self.time_calls(server, options['calls'],
+                                           lambda number: f'benchmark-{number}')
+        finally:
+            clients.clear()
+            server.shutdown()
+            server.server_close()
+
+        for name, (per_call, connections) in [('shared client', cached),
+                                              ('client per call', uncached)]:
+            self.stdout.write(f'{name}: {per_call * 1000:.2f} ms per call, '
+                              f'{connections} connections')
+        self.stdout.write(f'saved per call: {(uncached[0] - cached[0]) * 1000:.2f} ms')
+
+    def time_calls(self, server, calls, api_key):
+        connections = server.connections
+        start_time = time.perf_counter()
+        for number in range(calls):
+            OpenAILLM(api_key=api_key(number)).get_response([])
+        per_call = (time.perf_counter() - start_time) / calls
+        return per_call, server.connections - connections
@@ -0,0 +1,58 @@
+import threading
+from collections import defaultdict
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_gauges = {}
+_timings = {}
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    label_str = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f'{name}{{{label_str}}}'
+
+
+def incr(name, value=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    '''
+    Records one observation (e.g. a wait time in seconds) and keeps
+    count, sum and max for it.
+    '''
+    key = _key(name, labels)
+    with _lock:
+        timing = _timings.setdefault(key, {'count': 0, 'sum': 0.0, 'max': 0.0})
+        timing['count'] += 1
+        timing['sum'] += value
+        timing['max'] = max(timing['max'], value)
+
+
+def get_counter(name, **labels):
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+
+def snapshot():
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'timings': {k: dict(v) for k, v in _timings.items()},
+        }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timings.clear()
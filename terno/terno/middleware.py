@@ -0,0 +1,43 @@
+import logging
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+import terno.metrics as metrics
+import terno.sql_query as sql_query
+
+logger = logging.getLogger(__name__)
+
+
+class SQLParseStatsMiddleware:
+    '''
+    Counts how often SQL text is parsed while handling a request and how
+    long that takes. The figures are logged, recorded as metrics and sent
+    back in a Server-Timing header.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = sql_query.start_stats()
+        response = self.get_response(request)
+        return self.add_stats(request, response, stats)
+
+    async def __acall__(self, request):
+        stats = sql_query.start_stats()
+        response = await self.get_response(request)
+        return self.add_stats(request, response, stats)
+
+    def add_stats(self, request, response, stats):
+        if stats.count:
+            duration_ms = stats.seconds * 1000
+            metrics.observe('sql_parses_per_request', stats.count)
+            metrics.observe('sql_parse_seconds_per_request', stats.seconds)
+            logger.debug(f'{request.path}: {stats.count} SQL parses in {duration_ms:.2f}ms')
+            response['Server-Timing'] = \
+                f'sqlparse;dur={duration_ms:.2f};desc="{stats.count} parses"'
+        return response
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-19 05:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0037_foreignkey_constrained_table_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='max_concurrent_queries',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum number of queries run at the same time on this             datasource. Leave blank for no limit.', null=True),
+        ),
+        migrations.AddField(
+            model_name='datasource',
+            name='queue_timeout',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds a query waits for a free slot before the             datasource is reported busy (leave blank for default).', null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.1 on 2026-10-19 05:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0038_datasource_concurrency_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='cost_reject_threshold',
+            field=models.FloatField(blank=True, help_text='Refuse to run queries whose estimated cost is above             this value. For BigQuery the cost is the number of bytes processed.', null=True),
+        ),
+        migrations.AddField(
+            model_name='datasource',
+            name='cost_warn_threshold',
+            field=models.FloatField(blank=True, help_text='Warn the user when the estimated cost is above this             value. For BigQuery the cost is the number of bytes processed.', null=True),
+        ),
+        migrations.AddField(
+            model_name='datasource',
+            name='estimate_cost',
+            field=models.BooleanField(default=False, help_text='Estimate the cost of each query with EXPLAIN (dry run             on BigQuery) before running it.'),
+        ),
+    ]
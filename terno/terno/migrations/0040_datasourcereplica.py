@@ -0,0 +1,32 @@
+# Generated by Django 5.1.1 on 2026-10-19 05:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0039_datasource_cost_thresholds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='replica_routing',
+            field=models.CharField(choices=[('primary', 'Primary only'), ('round_robin', 'Round robin'), ('least_connections', 'Least connections')], default='round_robin', help_text='How read queries are spread over the replicas of this             datasource. Without replicas every query runs on the primary.', max_length=20),
+        ),
+        migrations.CreateModel(
+            name='DataSourceReplica',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('display_name', models.CharField(default='Replica 1', max_length=20)),
+                ('connection_str', models.TextField(help_text='Connection string for the replica', max_length=300)),
+                ('connection_json', models.JSONField(blank=True, help_text='JSON key file contents for authentication             (leave blank to use the datasource credentials)', null=True)),
+                ('use_for_exports', models.BooleanField(default=False, help_text='Dedicate this replica to exports. It will not serve             interactive queries.')),
+                ('max_lag_seconds', models.PositiveIntegerField(blank=True, help_text='Take the replica out of rotation when it lags behind             the primary by more than this many seconds.', null=True)),
+                ('enabled', models.BooleanField(default=True)),
+                ('data_source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='replicas', to='terno.datasource')),
+            ],
+        ),
+    ]
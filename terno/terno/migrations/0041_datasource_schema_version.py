@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-19 05:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0040_datasourcereplica'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasource',
+            name='schema_version',
+            field=models.PositiveIntegerField(default=1, editable=False, help_text='Bumped whenever the tables, columns or access rules of             the datasource change.'),
+        ),
+    ]
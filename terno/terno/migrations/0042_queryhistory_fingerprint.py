@@ -0,0 +1,28 @@
+# Generated by Django 5.1.1 on 2026-10-19 05:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0041_datasource_schema_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryhistory',
+            name='execution_time',
+            field=models.FloatField(blank=True, help_text='Seconds taken to execute the query', null=True),
+        ),
+        migrations.AddField(
+            model_name='queryhistory',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, help_text='Hash of the SQL with literals and formatting normalized', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='queryhistory',
+            name='row_count',
+            field=models.IntegerField(blank=True, help_text='Number of rows returned by the query', null=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.1 on 2026-10-19 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0042_queryhistory_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMResponseCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(help_text='Hash of the provider, model, sampling parameters and messages', max_length=64, unique=True)),
+                ('provider', models.CharField(max_length=64)),
+                ('model_name', models.CharField(blank=True, max_length=256, null=True)),
+                ('response', models.TextField()),
+                ('size', models.IntegerField(help_text='Size of the response in bytes')),
+                ('hits', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'verbose_name_plural': 'LLM response cache',
+            },
+        ),
+        migrations.AddField(
+            model_name='llmconfiguration',
+            name='cache_responses',
+            field=models.BooleanField(default=False, help_text='Reuse the response to an identical prompt even when             the temperature is above 0. Responses at temperature 0             are always cached.'),
+        ),
+        migrations.AddField(
+            model_name='queryhistory',
+            name='llm_cache_hit',
+            field=models.BooleanField(default=False, help_text='Whether the generated SQL came from the LLM response cache'),
+        ),
+    ]
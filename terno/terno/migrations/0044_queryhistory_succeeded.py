@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-19 05:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0043_llmresponsecache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryhistory',
+            name='succeeded',
+            field=models.BooleanField(blank=True, help_text='Whether the executed SQL ran without error', null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-19 05:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0044_queryhistory_succeeded'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='llmconfiguration',
+            name='fallback',
+            field=models.ForeignKey(blank=True, help_text='Another LLM to send requests to when this one fails,             and to hedge slow requests with when hedging is enabled.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='terno.llmconfiguration'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-19 06:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0045_llmconfiguration_fallback'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='llmconfiguration',
+            name='role',
+            field=models.CharField(choices=[('default', 'Default'), ('fast', 'Fast'), ('strong', 'Strong')], default='default', help_text='Simple questions are sent to the fast LLM and complex             ones to the strong LLM, when several LLMs are enabled.', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='llmconfiguration',
+            name='enabled',
+            field=models.BooleanField(default=True, help_text='Only one LLM of each role can be enabled at a time.'),
+        ),
+    ]
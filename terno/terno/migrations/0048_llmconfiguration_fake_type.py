@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-19 06:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0047_llmusage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='llmconfiguration',
+            name='llm_type',
+            field=models.CharField(choices=[('openai', 'OpenAI'), ('gemini', 'Gemini'), ('anthropic', 'Anthropic'), ('ollama', 'Ollama'), ('custom', 'CustomLLM'), ('fake', 'Fake (load testing)')], help_text='Select the type of LLM (e.g., OpenAI, Gemini, etc.).', max_length=64),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-19 06:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0048_llmconfiguration_fake_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='llmconfiguration',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
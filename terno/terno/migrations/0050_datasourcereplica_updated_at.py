@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-19 07:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('terno', '0049_llmconfiguration_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasourcereplica',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, null=True),
+        ),
+    ]
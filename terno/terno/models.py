@@ -11,7 +11,8 @@ class LLMConfiguration(models.Model):
         ('gemini', 'Gemini'),
         ('anthropic', 'Anthropic'),
         ('ollama', 'Ollama'),
-        ('custom', 'CustomLLM')
+        ('custom', 'CustomLLM'),
+        ('fake', 'Fake (load testing)'),
         # Add other LLM types here
     ]
 
@@ -45,9 +46,29 @@ class LLMConfiguration(models.Model):
         help_text="Set the top-k parameter value (Limits the model \
             to consider only the top k most probable next words). \
             Leave blank for default.")
+    ROLES = [
+        ('default', 'Default'),
+        ('fast', 'Fast'),
+        ('strong', 'Strong'),
+    ]
+
+    role = models.CharField(
+        max_length=16, choices=ROLES, default='default',
+        help_text="Simple questions are sent to the fast LLM and complex \
+            ones to the strong LLM, when several LLMs are enabled.")
     enabled = models.BooleanField(
         default=True,
-        help_text="Make sure to enable only one LLM at a time.")
+        help_text="Only one LLM of each role can be enabled at a time.")
+    cache_responses = models.BooleanField(
+        default=False,
+        help_text="Reuse the response to an identical prompt even when \
+            the temperature is above 0. Responses at temperature 0 \
+            are always cached.")
+    fallback = models.ForeignKey(
+        'self', on_delete=models.SET_NULL, blank=True, null=True,
+        related_name='+',
+        help_text="Another LLM to send requests to when this one fails, \
+            and to hedge slow requests with when hedging is enabled.")
     custom_parameters = models.JSONField(
         blank=True, null=True,
         help_text=(
@@ -60,6 +81,7 @@ class LLMConfiguration(models.Model):
             "Note: Only include parameters that are supported by the LLM \
             you are using, otherwise an error may occur."
         ))
+    updated_at = models.DateTimeField(auto_now=True, blank=True, null=True)
 
     def clean(self):
         super().clean()
@@ -79,6 +101,26 @@ class LLMConfiguration(models.Model):
         return f"{self.llm_type} - {self.model_name or 'default-model'}"
 
 
+class LLMResponseCache(models.Model):
+    key = models.CharField(
+        max_length=64, unique=True,
+        help_text="Hash of the provider, model, sampling parameters and messages")
+    provider = models.CharField(max_length=64)
+    model_name = models.CharField(max_length=256, blank=True, null=True)
+    response = models.TextField()
+    size = models.IntegerField(help_text="Size of the response in bytes")
+    hits = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(db_index=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name_plural = "LLM response cache"
+
+    def __str__(self):
+        return f"{self.provider} - {self.model_name or 'default-model'} - {self.key[:12]}"
+
+
 class DataSource(models.Model):
     class DBType(models.TextChoices):
         default = "generic", _("Generic")
@@ -86,6 +128,11 @@ class DataSource(models.Model):
         MSSQL = "mysql", _("MySQL")
         postgres = "postgres", _("Postgres")
         bigquery = "bigquery", _("BigQuery")
+
+    class ReplicaRouting(models.TextChoices):
+        primary = "primary", _("Primary only")
+        round_robin = "round_robin", _("Round robin")
+        least_connections = "least_connections", _("Least connections")
     display_name = models.CharField(max_length=20, default='Datasource 1')
     type = models.CharField(max_length=20, choices=DBType,
                             default=DBType.default)
@@ -108,11 +155,66 @@ class DataSource(models.Model):
     dialect_version = models.CharField(max_length=20, default='',
                                        null=True, blank=True)
     enabled = models.BooleanField(default=True)
+    max_concurrent_queries = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Maximum number of queries run at the same time on this \
+            datasource. Leave blank for no limit.")
+    queue_timeout = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Seconds a query waits for a free slot before the \
+            datasource is reported busy (leave blank for default).")
+    estimate_cost = models.BooleanField(
+        default=False,
+        help_text="Estimate the cost of each query with EXPLAIN (dry run \
+            on BigQuery) before running it.")
+    cost_warn_threshold = models.FloatField(
+        null=True, blank=True,
+        help_text="Warn the user when the estimated cost is above this \
+            value. For BigQuery the cost is the number of bytes processed.")
+    cost_reject_threshold = models.FloatField(
+        null=True, blank=True,
+        help_text="Refuse to run queries whose estimated cost is above \
+            this value. For BigQuery the cost is the number of bytes processed.")
+    replica_routing = models.CharField(
+        max_length=20, choices=ReplicaRouting,
+        default=ReplicaRouting.round_robin,
+        help_text="How read queries are spread over the replicas of this \
+            datasource. Without replicas every query runs on the primary.")
+    schema_version = models.PositiveIntegerField(
+        default=1, editable=False,
+        help_text="Bumped whenever the tables, columns or access rules of \
+            the datasource change.")
 
     def __str__(self):
         return self.display_name
 
 
+class DataSourceReplica(models.Model):
+    """Model to represent an additional read endpoint of a data source."""
+    data_source = models.ForeignKey(DataSource, on_delete=models.CASCADE,
+                                    related_name='replicas')
+    display_name = models.CharField(max_length=20, default='Replica 1')
+    connection_str = models.TextField(
+        max_length=300, help_text="Connection string for the replica")
+    connection_json = models.JSONField(
+        null=True, blank=True,
+        help_text="JSON key file contents for authentication \
+            (leave blank to use the datasource credentials)")
+    use_for_exports = models.BooleanField(
+        default=False,
+        help_text="Dedicate this replica to exports. It will not serve \
+            interactive queries.")
+    max_lag_seconds = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Take the replica out of rotation when it lags behind \
+            the primary by more than this many seconds.")
+    enabled = models.BooleanField(default=True)
+    updated_at = models.DateTimeField(auto_now=True, blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.data_source.display_name} - {self.display_name}"
+
+
 class Table(models.Model):
     """Model to represent a table in the data source."""
     name = models.CharField(max_length=255)
@@ -222,6 +324,21 @@ class QueryHistory(models.Model):
         max_length=64, choices=DATA_TYPES,
         help_text="Select the type of data you want to save")
     data = models.TextField(blank=True, null=True)
+    fingerprint = models.CharField(
+        max_length=64, blank=True, null=True, db_index=True,
+        help_text="Hash of the SQL with literals and formatting normalized")
+    execution_time = models.FloatField(
+        blank=True, null=True,
+        help_text="Seconds taken to execute the query")
+    row_count = models.IntegerField(
+        blank=True, null=True,
+        help_text="Number of rows returned by the query")
+    succeeded = models.BooleanField(
+        blank=True, null=True,
+        help_text="Whether the executed SQL ran without error")
+    llm_cache_hit = models.BooleanField(
+        default=False,
+        help_text="Whether the generated SQL came from the LLM response cache")
     created_at = models.DateTimeField(auto_now_add=True, blank=True, null=True)
     updated_at = models.DateTimeField(auto_now=True, blank=True, null=True)
 
@@ -233,6 +350,31 @@ class PromptLog(models.Model):
     updated_at = models.DateTimeField(auto_now=True, blank=True, null=True)
 
 
+class LLMUsage(models.Model):
+    """Tokens and latency of one call to an LLM provider."""
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    data_source = models.ForeignKey(DataSource, on_delete=models.SET_NULL,
+                                    null=True, blank=True)
+    prompt_log = models.ForeignKey(PromptLog, on_delete=models.SET_NULL,
+                                   null=True, blank=True)
+    query_history = models.ForeignKey(QueryHistory, on_delete=models.SET_NULL,
+                                      null=True, blank=True)
+    provider = models.CharField(max_length=64)
+    model_name = models.CharField(max_length=256, null=True, blank=True)
+    prompt_tokens = models.IntegerField(null=True, blank=True)
+    completion_tokens = models.IntegerField(null=True, blank=True)
+    cached_tokens = models.IntegerField(
+        null=True, blank=True,
+        help_text="Prompt tokens read from the provider's prompt cache.")
+    finish_reason = models.CharField(max_length=64, null=True, blank=True)
+    time_to_first_token = models.FloatField(null=True, blank=True)
+    latency = models.FloatField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f'{self.provider} {self.model_name} {self.created_at}'
+
+
 class SystemPrompts(models.Model):
     data_source = models.ForeignKey(DataSource, on_delete=models.CASCADE)
     system_prompt = models.TextField(blank=True, null=True)
@@ -6,5 +6,5 @@ class AbstractPipeline(ABC):
         pass
 
     @abstractmethod
-    def run(self, input):
+    def run(self, **inputs):
         raise NotImplementedError("Run method not implemented")
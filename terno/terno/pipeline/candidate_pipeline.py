@@ -0,0 +1,188 @@
+from terno.pipeline.pipeline import Pipeline
+from terno.pipeline.result import PipelineResult, StepError, StepResult
+from terno.llm import resilience
+from concurrent.futures import as_completed
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+import asyncio
+import contextvars
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Estimated tokens of the candidates still running after their pipeline
+# returned, see abandoned_tokens.
+_abandoned_tokens = 0
+_abandoned_lock = threading.Lock()
+
+
+def abandoned_tokens():
+    '''Estimated tokens of the losing candidates still being generated.'''
+    return _abandoned_tokens
+
+
+def _abandon(future, tokens):
+    global _abandoned_tokens
+    if future.done() or not tokens:
+        return
+    with _abandoned_lock:
+        _abandoned_tokens += tokens
+
+    def finished(future):
+        global _abandoned_tokens
+        with _abandoned_lock:
+            _abandoned_tokens -= tokens
+    future.add_done_callback(finished)
+
+
+class CandidatePipeline(Pipeline):
+    """
+    Runs its steps, each generating a candidate SQL for the same question,
+    concurrently. Candidates are validated as they arrive and the first
+    valid one is returned while the others are cancelled. When none is
+    valid, the candidate of the first step that answered is returned.
+    Candidates left running are counted in abandoned_tokens, at
+    candidate_tokens each, until they finish. Their usage is left out of
+    the usage of the pipeline and given to save_usage when they finish.
+    """
+
+    def __init__(self, steps=None, validate=None, candidate_tokens=0, save_usage=None):
+        super().__init__(steps)
+        # Returns why a candidate can not be used, or None when it can.
+        self.validate = validate
+        self.candidate_tokens = candidate_tokens
+        self.save_usage = save_usage
+        self.candidates = []
+        # Names of the candidates that finished, and of those still
+        # running when the pipeline returned.
+        self.finished = set()
+        self.abandoned = set()
+        self._lock = threading.Lock()
+
+    @property
+    def usage(self):
+        return [record for step in self._steps if step.name not in self.abandoned
+                for record in getattr(step, 'usage', ())]
+
+    def check(self, inputs):
+        '''Raises ValueError when two candidates have the same name.'''
+        names = set()
+        for step in self._steps:
+            if step.name in names:
+                raise ValueError(f'Step {step.name} is added twice.')
+            names.add(step.name)
+
+    def check_candidate(self, step, response=None, error=None):
+        if error is None and self.validate is not None:
+            try:
+                error = self.validate(response)
+            except Exception as e:
+                logger.exception(e)
+                error = str(e)
+        candidate = {'step': step, 'response': response, 'error': error}
+        self.candidates.append(candidate)
+        return candidate
+
+    def result(self, candidate, start_time):
+        step = candidate['step']
+        self.results = {step.name: StepResult(
+            step.name, step.output, StepResult.SUCCESS, candidate['response'],
+            execution_time=time.time() - start_time)}
+        return PipelineResult(self.results.values())
+
+    def fallback(self, start_time):
+        answered = [candidate for candidate in self.candidates
+                    if candidate['response'] is not None]
+        if not answered:
+            candidate = self.candidates[0]
+            raise StepError(candidate['step'].name, StepResult.ERROR, candidate['error'])
+        answered.sort(key=lambda candidate: self._steps.index(candidate['step']))
+        return self.result(answered[0], start_time)
+
+    def execute(self, step, inputs):
+        '''Runs a candidate on the shared pool of candidates.'''
+        try:
+            return step.execute(**inputs)
+        finally:
+            with self._lock:
+                self.finished.add(step.name)
+                late = step.name in self.abandoned
+            if late:
+                self.save_late_usage(step)
+            else:
+                close_old_connections()
+
+    def save_late_usage(self, step):
+        '''
+        Saves the usage of a candidate that finished after the pipeline
+        returned. It runs on the shared pool, whose threads outlive
+        requests, so their database connections are closed here.
+        '''
+        try:
+            if self.save_usage is not None:
+                self.save_usage(step)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            close_old_connections()
+
+    def run(self, **inputs):
+        self.check(inputs)
+        start_time = time.time()
+        self.candidates = []
+        self.finished = set()
+        self.abandoned = set()
+        executor = resilience.get_executor('candidates')
+        futures = {executor.submit(contextvars.copy_context().run, self.execute, step, inputs): step
+                   for step in self._steps}
+        try:
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    candidate = self.check_candidate(futures[future], error=str(future.exception()))
+                else:
+                    candidate = self.check_candidate(futures[future], future.result())
+                if candidate['error'] is None:
+                    return self.result(candidate, start_time)
+        finally:
+            # Candidates not started yet are dropped, running ones are
+            # left to finish in the background.
+            with self._lock:
+                for future, step in futures.items():
+                    if future.cancel():
+                        continue
+                    if step.name not in self.finished:
+                        self.abandoned.add(step.name)
+                    _abandon(future, self.candidate_tokens)
+        return self.fallback(start_time)
+
+    async def run_async(self, **inputs):
+        self.check(inputs)
+        start_time = time.time()
+        self.candidates = []
+        self.finished = set()
+        self.abandoned = set()
+        tasks = {asyncio.ensure_future(step.execute_async(**inputs)): step
+                 for step in self._steps}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        candidate = self.check_candidate(tasks[task], error=str(task.exception()))
+                    else:
+                        candidate = await sync_to_async(self.check_candidate)(tasks[task], task.result())
+                    if candidate['error'] is None:
+                        return self.result(candidate, start_time)
+        finally:
+            executor = resilience.get_executor('candidates')
+            for task in pending:
+                task.cancel()
+                _abandon(task, self.candidate_tokens)
+                self.abandoned.add(tasks[task].name)
+                # Saved from the pool, the event loop can not use the ORM.
+                task.add_done_callback(
+                    lambda task: executor.submit(self.save_late_usage, tasks[task]))
+        return self.fallback(start_time)
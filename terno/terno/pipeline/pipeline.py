@@ -1,4 +1,10 @@
 from terno.pipeline.abstract_pipeline import AbstractPipeline
+from terno.pipeline.result import PipelineResult, StepError, StepResult
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import concurrent.futures
+from django.conf import settings
+import asyncio
+import contextvars
 import time
 import logging
 
@@ -6,28 +12,199 @@ logger = logging.getLogger(__name__)
 
 
 class Pipeline(AbstractPipeline):
+    """
+    Runs its steps as a graph. A step starts once the steps producing its
+    inputs are done, so independent steps run concurrently, on at most
+    PIPELINE_MAX_WORKERS threads or as tasks of the event loop. A step
+    that fails or times out fails the pipeline with a StepError, and the
+    steps that did not start yet are skipped.
+    """
     _steps = []
 
     def __init__(self, steps=None):
         if steps is None:
             steps = []
         self._steps = steps
+        # Result of each step of the last run, by step name.
+        self.results = {}
 
     def add_step(self, step):
         self._steps.append(step)
 
-    def run(self):
+    @property
+    def steps(self):
+        return list(self._steps)
+
+    @property
+    def usage(self):
+        '''
+        Usage of the llm calls made by the steps, including those of steps
+        that failed, see terno.llm.usage.
+        '''
+        return [record for step in self._steps for record in getattr(step, 'usage', ())]
+
+    @property
+    def cache_hit(self):
+        return any(getattr(step, 'cache_hit', False) for step in self._steps)
+
+    @property
+    def prompt_log(self):
+        '''Log of the prompt of the step whose answer was used, else of the last one.'''
+        logged = [step for step in self._steps if getattr(step, 'prompt_log', None) is not None]
+        used = [step for step in logged
+                if step.name in self.results and self.results[step.name].ok]
+        return (used or logged)[-1].prompt_log if logged else None
+
+    def check(self, inputs):
+        '''Raises ValueError when the steps can not all be run.'''
+        names = set()
+        available = set(inputs)
+        for step in self._steps:
+            if step.name in names:
+                raise ValueError(f'Step {step.name} is added twice.')
+            names.add(step.name)
+            if step.output is not None:
+                if step.output in available:
+                    raise ValueError(f'{step.output} is produced by two steps.')
+                available.add(step.output)
+
+        # The steps must be runnable in some order, without cycles.
+        done = set(inputs)
+        pending = list(self._steps)
+        while pending:
+            ready = [step for step in pending if done.issuperset(step.inputs)]
+            if not ready:
+                raise ValueError('Inputs of steps ' + ', '.join(step.name for step in pending)
+                                 + ' are missing or depend on each other.')
+            for step in ready:
+                pending.remove(step)
+                done.add(step.output)
+
+    def ready_steps(self, values, started):
+        return [step for step in self._steps
+                if step not in started and all(name in values for name in step.inputs)]
+
+    def succeeded(self, step, output, start_time, values):
+        self.results[step.name] = StepResult(step.name, step.output, StepResult.SUCCESS,
+                                             output, execution_time=time.time() - start_time)
+        if step.output is not None:
+            values[step.output] = output
+
+    def failed(self, step, error, start_time):
+        # Before Python 3.11 the timeouts of asyncio and concurrent.futures
+        # are not the builtin TimeoutError.
+        timeout = isinstance(error, (TimeoutError, asyncio.TimeoutError,
+                                     concurrent.futures.TimeoutError))
+        status = StepResult.TIMEOUT if timeout else StepResult.ERROR
+        logger.warning(f'Step {step.name} {status}: {error}')
+        self.results[step.name] = StepResult(step.name, step.output, status,
+                                             error=str(error) or status,
+                                             execution_time=time.time() - start_time)
+        step_error = StepError(step.name, status, str(error) or f'Step {step.name} timed out.')
+        step_error.__cause__ = error
+        return step_error
+
+    def finish(self, error):
+        for step in self._steps:
+            if step.name not in self.results:
+                self.results[step.name] = StepResult(step.name, step.output, StepResult.SKIPPED)
+        if error is not None:
+            raise error
+        return PipelineResult(self.results[step.name] for step in self._steps)
+
+    @staticmethod
+    def step_inputs(step, values):
+        return {name: values[name] for name in step.inputs}
+
+    def run(self, **inputs):
+        self.check(inputs)
+        self.results = {}
+        values = dict(inputs)
+        started = []
+        running = {}
+        executor = None
+        error = None
         try:
-            result = []
-            for step in self._steps:
-                start_time = time.time()
+            while error is None:
+                ready = self.ready_steps(values, started)
+                if not ready and not running:
+                    break
+                if len(ready) == 1 and not running and ready[0].timeout is None:
+                    # Steps depending on each other run in the calling thread.
+                    step = ready[0]
+                    started.append(step)
+                    start_time = time.time()
+                    try:
+                        output = step.execute(**self.step_inputs(step, values))
+                    except Exception as e:
+                        error = self.failed(step, e, start_time)
+                    else:
+                        self.succeeded(step, output, start_time, values)
+                    continue
 
-                step_result = step.execute()
-                print('step_result', step_result)
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=settings.PIPELINE_MAX_WORKERS,
+                                                  thread_name_prefix='terno-pipeline')
+                for step in ready:
+                    started.append(step)
+                    future = executor.submit(contextvars.copy_context().run, step.execute,
+                                             **self.step_inputs(step, values))
+                    running[future] = (step, time.time())
 
-                execution_time = time.time() - start_time
-                result.append([step_result, execution_time])
-            return result
+                deadlines = [start_time + step.timeout - time.time()
+                             for step, start_time in running.values()
+                             if step.timeout is not None]
+                done, _ = wait(running, timeout=max(0, min(deadlines)) if deadlines else None,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    step, start_time = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or self.failed(step, future.exception(), start_time)
+                    else:
+                        self.succeeded(step, future.result(), start_time, values)
+                for future, (step, start_time) in list(running.items()):
+                    if step.timeout is not None and time.time() - start_time >= step.timeout:
+                        running.pop(future)
+                        error = error or self.failed(step, TimeoutError(), start_time)
+        finally:
+            if executor is not None:
+                # Steps not started yet are dropped, running ones are left
+                # to finish in the background.
+                executor.shutdown(wait=False, cancel_futures=True)
+        return self.finish(error)
 
-        except Exception as e:
-            logger.warning(e)
+    async def run_step_async(self, step, inputs):
+        if step.timeout is None:
+            return await step.execute_async(**inputs)
+        try:
+            return await asyncio.wait_for(step.execute_async(**inputs), step.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'Step {step.name} timed out after {step.timeout} seconds.')
+
+    async def run_async(self, **inputs):
+        self.check(inputs)
+        self.results = {}
+        values = dict(inputs)
+        started = []
+        running = {}
+        error = None
+        try:
+            while error is None:
+                for step in self.ready_steps(values, started):
+                    started.append(step)
+                    task = asyncio.ensure_future(
+                        self.run_step_async(step, self.step_inputs(step, values)))
+                    running[task] = (step, time.time())
+                if not running:
+                    break
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    step, start_time = running.pop(task)
+                    if task.exception() is not None:
+                        error = error or self.failed(step, task.exception(), start_time)
+                    else:
+                        self.succeeded(step, task.result(), start_time, values)
+        finally:
+            for task in running:
+                task.cancel()
+        return self.finish(error)
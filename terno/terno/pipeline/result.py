@@ -0,0 +1,45 @@
+class StepResult():
+    '''Outcome of a step of a pipeline.'''
+    SUCCESS = 'success'
+    ERROR = 'error'
+    TIMEOUT = 'timeout'
+    SKIPPED = 'skipped'
+
+    def __init__(self, name, output_name=None, status=SUCCESS, output=None,
+                 error=None, execution_time=0):
+        self.name = name
+        self.output_name = output_name
+        self.status = status
+        self.output = output
+        self.error = error
+        self.execution_time = execution_time
+
+    @property
+    def ok(self):
+        return self.status == self.SUCCESS
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class PipelineResult(list):
+    '''The results of the steps of a pipeline, in the order of its steps.'''
+
+    def output(self, name):
+        '''Returns the output the steps made available under name.'''
+        for result in self:
+            if result.ok and result.output_name == name:
+                return result.output
+        raise KeyError(name)
+
+
+class StepError(Exception):
+    '''
+    A step of a pipeline failed or timed out. The message is the one of
+    the underlying error, which is chained as the cause.
+    '''
+
+    def __init__(self, step, status, message):
+        super().__init__(message)
+        self.step = step
+        self.status = status
@@ -1,7 +1,76 @@
-class Step():
-    def __init__(self, llm, messages):
+import asyncio
+from asgiref.sync import sync_to_async
+from terno.llm import response_cache
+from terno.llm import usage
+
+
+class BaseStep():
+    '''
+    A step of a pipeline. It runs once the steps producing its inputs are
+    done, and is passed their outputs as keyword arguments. What it
+    returns is made available to the steps after it under the name output.
+    A step running longer than timeout seconds fails the pipeline.
+    '''
+
+    def __init__(self, name, inputs=(), output=None, timeout=None):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.output = output
+        self.timeout = timeout
+
+    def execute(self, **inputs):
+        raise NotImplementedError("Execute method not implemented")
+
+    async def execute_async(self, **inputs):
+        return await sync_to_async(self.execute)(**inputs)
+
+
+class FunctionStep(BaseStep):
+    '''Step calling a function, or a coroutine function, with its inputs.'''
+
+    def __init__(self, function, name=None, inputs=(), output=None, timeout=None):
+        super().__init__(name or function.__name__, inputs, output, timeout)
+        self.function = function
+
+    def execute(self, **inputs):
+        return self.function(**inputs)
+
+    async def execute_async(self, **inputs):
+        if asyncio.iscoroutinefunction(self.function):
+            return await self.function(**inputs)
+        return await sync_to_async(self.function)(**inputs)
+
+
+class Step(BaseStep):
+    '''
+    Step asking the llm. The messages can be given up front, or be the
+    input of the same name when an earlier step builds them.
+    '''
+
+    def __init__(self, llm, messages, name='generate_sql', inputs=(),
+                 output='generated_sql', timeout=None):
+        super().__init__(name, inputs, output, timeout)
         self.llm = llm
         self.messages = messages
+        self.cache_hit = False
+        # Usage of the llm calls made by the step, see terno.llm.usage.
+        self.usage = []
+        self.prompt_log = None
+
+    def execute(self, **inputs):
+        self.messages = inputs.get('messages', self.messages)
+        with usage.collect() as self.usage:
+            response, self.cache_hit = response_cache.get_response(self.llm, self.messages)
+        return response
+
+    async def execute_async(self, **inputs):
+        self.messages = inputs.get('messages', self.messages)
+        with usage.collect() as self.usage:
+            response, self.cache_hit = await response_cache.get_response_async(
+                self.llm, self.messages)
+        return response
 
-    def execute(self):
-        return self.llm.get_response(self.messages)
+    def stream(self):
+        """Yields the response of the llm in chunks as they arrive."""
+        with usage.collect() as self.usage:
+            self.cache_hit = yield from response_cache.stream_response(self.llm, self.messages)
@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import sqlalchemy
+from django.conf import settings
+import terno.utils as utils
+import terno.admission as admission
+import terno.replicas as replicas
+
+logger = logging.getLogger(__name__)
+
+
+class QueryJobError(Exception):
+    pass
+
+
+class QueryJob():
+    PENDING = 'pending'
+    RUNNING = 'running'
+    SUCCESS = 'success'
+    ERROR = 'error'
+
+    def __init__(self, user_id, datasource_id, native_sql):
+        self.id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.datasource_id = datasource_id
+        self.native_sql = native_sql
+        self.status = self.PENDING
+        self.error = None
+        self.columns = []
+        self.rows = []
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def done(self):
+        return self.status in (self.SUCCESS, self.ERROR)
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0
+        end = self.finished_at or time.time()
+        return end - self.started_at
+
+    def is_expired(self, now=None):
+        if not self.done or self.finished_at is None:
+            return False
+        now = now or time.time()
+        return now - self.finished_at > settings.QUERY_JOB_TTL
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'job_status': self.status,
+            'elapsed': round(self.elapsed, 3),
+            'rows_fetched': len(self.rows),
+            'error': self.error,
+        }
+
+
+_jobs = {}
+# Job counting the rows of a query, by (user id, datasource id, count sql).
+_count_jobs = {}
+_jobs_lock = threading.Lock()
+_executor = None
+
+
+def get_executor():
+    global _executor
+    with _jobs_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.QUERY_JOB_MAX_WORKERS,
+                thread_name_prefix='terno-query-job')
+        return _executor
+
+
+def purge_expired_jobs():
+    now = time.time()
+    with _jobs_lock:
+        expired = [job_id for job_id, job in _jobs.items()
+                   if job.is_expired(now)]
+        for job_id in expired:
+            del _jobs[job_id]
+    return len(expired)
+
+
+def submit_job(user, datasource, native_sql):
+    '''
+    Queues the native sql for execution and returns the job right away.
+    Jobs are kept in the memory of the current process, so polling has
+    to reach the same worker that accepted the job.
+    '''
+    purge_expired_jobs()
+    job = QueryJob(user.id, datasource.id, native_sql)
+    # Resolve the replicas here, the worker threads stay off the ORM.
+    replicas.get_router(datasource)
+    with _jobs_lock:
+        pending = sum(1 for j in _jobs.values() if not j.done)
+        if pending >= settings.QUERY_JOB_MAX_PENDING:
+            raise QueryJobError('Too many queries are running, please try again later.')
+        _jobs[job.id] = job
+    get_executor().submit(run_job, job, datasource)
+    return job
+
+
+def submit_count_job(user, datasource, count_sql):
+    '''
+    Returns the job counting the rows of a query for the user, submitting
+    it unless an earlier page of the same query already did. Failed and
+    expired jobs are submitted again.
+    '''
+    key = (user.id, datasource.id, count_sql)
+    purge_expired_jobs()
+    with _jobs_lock:
+        job = _jobs.get(_count_jobs.get(key))
+    if job is not None and job.status != QueryJob.ERROR:
+        return job
+    job = submit_job(user, datasource, count_sql)
+    with _jobs_lock:
+        _count_jobs[key] = job.id
+        for stale_key in [k for k, job_id in _count_jobs.items() if job_id not in _jobs]:
+            del _count_jobs[stale_key]
+    return job
+
+
+def get_job(user, job_id):
+    purge_expired_jobs()
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job is None or job.user_id != user.id:
+        return None
+    return job
+
+
+def run_job(job, datasource):
+    try:
+        with admission.admit(datasource, job.user_id):
+            job.status = QueryJob.RUNNING
+            job.started_at = time.time()
+            with replicas.connect(datasource) as con:
+                execute_result = con.execute(sqlalchemy.text(job.native_sql))
+                job.columns = list(execute_result.keys())
+                while True:
+                    rows = execute_result.fetchmany(settings.QUERY_JOB_FETCH_SIZE)
+                    if not rows:
+                        break
+                    job.rows.extend(rows)
+        status = QueryJob.SUCCESS
+    except Exception as e:
+        logger.exception(e)
+        job.error = str(e)
+        status = QueryJob.ERROR
+    # A done job always has its finish time, see QueryJob.is_expired.
+    job.finished_at = time.time()
+    job.status = status
+
+
+def get_job_page(job, page, per_page):
+    return utils.prepare_table_data(job.columns, job.rows, len(job.rows),
+                                    page, per_page)
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.conf import settings
+from django.db import connections
+import terno.models as models
+import terno.utils as utils
+import terno.metrics as metrics
+from terno.llm import resilience, routing
+from terno.llm.base import LLMFactory
+
+logger = logging.getLogger(__name__)
+
+
+def check_questions(questions):
+    '''Returns why the batch can not be answered, or None when it can.'''
+    if not isinstance(questions, list) or not questions:
+        return 'Provide a list of questions.'
+    if not all(isinstance(question, str) and question.strip()
+               for question in questions):
+        return 'Every question must be a non empty string.'
+    if len(questions) > settings.BATCH_QUESTIONS_MAX:
+        return f'At most {settings.BATCH_QUESTIONS_MAX} questions can be asked in one batch.'
+    return None
+
+
+class AdaptiveLimit():
+    '''
+    Bounds how many questions of a batch are sent to the llm at a time.
+    The limit is halved when a call fails, the provider is likely rate
+    limiting or overloaded, and raised by one after each answer, up to
+    BATCH_QUESTIONS_MAX_CONCURRENCY.
+    '''
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = maximum
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def increase(self):
+        self.limit = min(self.maximum, self.limit + 1)
+
+    def decrease(self):
+        self.limit = max(1, self.limit // 2)
+
+
+def circuit_wait(llm):
+    '''Seconds until the open circuit of the llm lets a call through.'''
+    breaker = resilience.get_health(llm).breaker
+    if breaker.state != resilience.CircuitBreaker.OPEN:
+        return 0
+    return max(0, settings.LLM_CIRCUIT_RESET_TIMEOUT - (time.monotonic() - breaker.opened_at))
+
+
+async def answer_question(user, datasource, roles, db_schema, llms, question, limit):
+    for attempt in range(2):
+        async with limit:
+            llm = routing.choose(llms, question, db_schema)
+            response = await utils.llm_response_async(
+                user, question, db_schema, datasource, llm=llm)
+            if response['status'] == 'success':
+                limit.increase()
+                response = await utils.escalate_llm_response_async(
+                    user, question, db_schema, datasource, roles, response)
+                break
+            limit.decrease()
+        wait = circuit_wait(llm)
+        if attempt or not wait:
+            break
+        # The provider keeps failing, wait for its circuit instead of
+        # failing the rest of the batch right away, leaving the slot to
+        # questions routed to other llms.
+        metrics.incr('batch_question_circuit_waits_total', provider=llm.provider_name)
+        await asyncio.sleep(wait)
+
+    if response['status'] == 'error':
+        return {'status': 'error', 'error': response['error']}
+
+    await sync_to_async(utils.log_generated_sql)(user, datasource, response)
+    return {'status': 'success', 'generated_sql': response['generated_sql'],
+            'cache_hit': response['cache_hit'], 'role': response['role']}
+
+
+async def answer_questions(user, datasource, questions, roles=None):
+    '''
+    Async generator answering the questions on the datasource, yielding
+    one result per question, with its index, as soon as it is answered.
+    The schema and the llms are prepared once for the whole batch.
+    '''
+    if roles is None:
+        roles = user.groups.all()
+    db_schema = await sync_to_async(utils.generate_schema)(datasource, roles)
+    llms = await sync_to_async(LLMFactory.get_llms)()
+    limit = AdaptiveLimit(settings.BATCH_QUESTIONS_MAX_CONCURRENCY)
+
+    await models.QueryHistory.objects.abulk_create([
+        models.QueryHistory(user=user, data_source=datasource,
+                            data_type='user_prompt', data=question)
+        for question in questions
+    ])
+
+    async def answer(index, question):
+        try:
+            result = await answer_question(user, datasource, roles, db_schema,
+                                           llms, question, limit)
+        except Exception as e:
+            logger.exception(e)
+            result = {'status': 'error', 'error': str(e)}
+        return {'index': index, 'question': question, **result}
+
+    tasks = [asyncio.ensure_future(answer(index, question))
+             for index, question in enumerate(questions)]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        # The client went away, do not ask the remaining questions.
+        for task in tasks:
+            task.cancel()
+
+
+async def ndjson(results):
+    '''Serializes the results as newline delimited JSON.'''
+    async for result in results:
+        yield json.dumps(result) + '\n'
+
+
+def iterate(results):
+    '''
+    Iterates over async results for a synchronous caller, like a WSGI
+    server, which would otherwise collect them all before sending any.
+    They are produced by an event loop in a thread of its own and handed
+    over as they come. Closing the iterator stops the batch.
+    '''
+    items = queue.Queue()
+    done = object()
+    stopped = threading.Event()
+
+    async def produce():
+        # Keep the ORM work of the batch in one thread, as ASGI requests do.
+        async with ThreadSensitiveContext():
+            try:
+                async for item in results:
+                    items.put(item)
+                    if stopped.is_set():
+                        break
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                await results.aclose()
+                await sync_to_async(connections.close_all)()
+                items.put(done)
+
+    threading.Thread(target=asyncio.run, args=(produce(),),
+                     name='terno-question-batch', daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
@@ -1,8 +1,15 @@
-from terno.models import DataSource, Table, TableColumn, ForeignKey
+import contextvars
+from terno.models import DataSource, DataSourceReplica, Table, TableColumn, ForeignKey
+import terno.models as models
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
 import sqlalchemy
 import terno.utils as utils
+import terno.fingerprint as fingerprint
+import terno.sql_query as sql_query
+import terno.replicas as replicas
+import terno.llm.clients as llm_clients
+from terno.llm.base import LLMFactory
 from sqlshield.models import MDatabase
 
 
@@ -71,10 +78,93 @@ def load_metadata(datasource):
     print("Finished building the tables!!")
 
 
+# Set while metadata is imported, the schema version is bumped once afterwards.
+_loading_metadata = contextvars.ContextVar('loading_metadata', default=False)
+
+
+@receiver(pre_save, sender=models.QueryHistory)
+def fingerprint_query_history(sender, instance, **kwargs):
+    """Sets the fingerprint of generated and actually executed SQL."""
+    # User executed SQL is not fingerprinted, its translation is
+    # logged as actual executed SQL right after it.
+    if instance.fingerprint is None and instance.data and \
+            instance.data_type in ('generated_sql', 'actual_executed_sql'):
+        dialect_name = instance.data_source.dialect_name
+        # Callers that already parsed the data can set parsed_query
+        # to spare parsing it again.
+        query = getattr(instance, 'parsed_query', None)
+        if query is None or query.sql != instance.data or \
+                query.dialect != sql_query.get_sqlglot_dialect(dialect_name):
+            query = instance.data
+        instance.fingerprint = fingerprint.fingerprint(query, dialect_name)
+
+
 @receiver(post_save, sender=DataSource)
 def update_tables_on_datasource_change(sender, instance, created, **kwargs):
     """Fetches and saves table information when a data source is saved."""
-    load_metadata(instance)
+    replicas.invalidate(instance.id)
+    token = _loading_metadata.set(True)
+    try:
+        load_metadata(instance)
+    finally:
+        _loading_metadata.reset(token)
+    utils.bump_schema_version([instance.id])
     # if created:
     #     for table_name in retrieved_tables:
     #         Table.objects.create(name=table_name, data_source=instance)
+
+
+@receiver([post_save, post_delete], sender=DataSourceReplica)
+def reset_routing_on_replica_change(sender, instance, **kwargs):
+    """Rebuilds the replica rotation of the data source on its next query."""
+    replicas.invalidate(instance.data_source_id)
+
+
+@receiver([post_save, post_delete], sender=models.LLMConfiguration)
+def reset_llm_on_configuration_change(sender, instance, **kwargs):
+    """Builds the llm and its SDK clients again from the changed configuration."""
+    llm_clients.clear()
+    LLMFactory.invalidate()
+
+
+def _affected_datasource_ids(instance):
+    if isinstance(instance, Table):
+        return [instance.data_source_id]
+    if isinstance(instance, TableColumn):
+        return Table.objects.filter(id=instance.table_id).values_list('data_source_id', flat=True)
+    if isinstance(instance, ForeignKey):
+        return Table.objects.filter(id=instance.referred_table_id).values_list('data_source_id', flat=True)
+    if isinstance(instance, (models.GroupTableSelector, models.GroupColumnSelector)):
+        # Group selectors are not tied to a datasource.
+        return None
+    return [instance.data_source_id]
+
+
+ACCESS_RULE_MODELS = [
+    Table, TableColumn, ForeignKey,
+    models.PrivateTableSelector, models.GroupTableSelector,
+    models.PrivateColumnSelector, models.GroupColumnSelector,
+    models.GroupTableRowFilter, models.TableRowFilter,
+]
+
+ACCESS_RULE_RELATIONS = [
+    models.PrivateTableSelector.tables.through,
+    models.GroupTableSelector.tables.through,
+    models.PrivateColumnSelector.columns.through,
+    models.GroupColumnSelector.columns.through,
+]
+
+
+@receiver([post_save, post_delete])
+def bump_schema_version_on_change(sender, instance, **kwargs):
+    """Invalidates cached translations when the schema or access rules change."""
+    if sender not in ACCESS_RULE_MODELS or _loading_metadata.get():
+        return
+    utils.bump_schema_version(_affected_datasource_ids(instance))
+
+
+@receiver(m2m_changed)
+def bump_schema_version_on_selection_change(sender, instance, action, **kwargs):
+    if sender not in ACCESS_RULE_RELATIONS or not action.startswith('post_'):
+        return
+    utils.bump_schema_version(_affected_datasource_ids(instance))
@@ -0,0 +1,274 @@
+import itertools
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import sqlalchemy
+from django.conf import settings
+from django.db.models import Count, Max
+import terno.models as models
+import terno.utils as utils
+import terno.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+
+def replication_lag(con):
+    """Seconds the replica behind `con` trails its primary, if known."""
+    dialect_name = con.engine.dialect.name
+    if dialect_name == 'postgresql':
+        lag = con.execute(sqlalchemy.text(
+            "SELECT CASE WHEN pg_is_in_recovery() THEN "
+            "COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) "
+            "ELSE 0 END")).scalar()
+        return float(lag)
+    if dialect_name == 'mysql':
+        status = con.execute(sqlalchemy.text('SHOW REPLICA STATUS')).mappings().first()
+        if status is None:
+            return 0.0
+        lag = status.get('Seconds_Behind_Source')
+        return float(lag) if lag is not None else None
+    return None
+
+
+class Endpoint():
+    def __init__(self, name, db_type, connection_str, connection_json=None,
+                 is_primary=False, for_exports=False, max_lag_seconds=None):
+        self.name = name
+        self.db_type = db_type
+        self.connection_str = connection_str
+        self.connection_json = connection_json
+        self.is_primary = is_primary
+        self.for_exports = for_exports
+        self.max_lag_seconds = max_lag_seconds
+        self.active = 0
+        self.healthy = True
+        self.lag = None
+        self.last_checked = None
+        self.down_until = 0
+        self._engine = None
+        self._check_lock = threading.Lock()
+        self._lag_unknown_logged = False
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = utils.create_db_engine(
+                self.db_type, self.connection_str,
+                credentials_info=self.connection_json)
+        return self._engine
+
+    def in_rotation(self, now):
+        return self.healthy and now >= self.down_until
+
+    def mark_failed(self):
+        self.healthy = False
+        self.down_until = time.monotonic() + settings.REPLICA_FAILURE_COOLDOWN
+        metrics.incr('replica_failures_total', endpoint=self.name)
+        logger.warning(f'Replica {self.name} taken out of rotation')
+
+    def check_health(self):
+        self.last_checked = time.monotonic()
+        try:
+            with self.engine.connect() as con:
+                con.execute(sqlalchemy.text('SELECT 1'))
+                self.lag = self.read_lag(con)
+        except Exception as e:
+            logger.warning(e)
+            self.mark_failed()
+            return
+        if self.max_lag_seconds is not None and self.lag is not None \
+                and self.lag > self.max_lag_seconds:
+            self.healthy = False
+            metrics.set_gauge('replica_lag_seconds', self.lag, endpoint=self.name)
+            return
+        # A replica that failed stays out of rotation until its cooldown
+        # is over, even when it answers again before.
+        self.healthy = True
+        if self.lag is not None:
+            metrics.set_gauge('replica_lag_seconds', self.lag, endpoint=self.name)
+
+    def read_lag(self, con):
+        """
+        Replication lag of the endpoint, None when the server can not tell,
+        e.g. MySQL before 8.0.22 or an account without the REPLICATION
+        CLIENT privilege. The replica then stays in rotation unchecked.
+        """
+        try:
+            return replication_lag(con)
+        except sqlalchemy.exc.DBAPIError as e:
+            if not self._lag_unknown_logged:
+                self._lag_unknown_logged = True
+                logger.warning(f'Replication lag of {self.name} is unknown, '
+                               f'max_lag_seconds is not enforced: {e}')
+            return None
+
+    def refresh_health(self, wait=False):
+        """
+        Runs a health check unless one is running already. With `wait`
+        the caller waits for the running check instead of skipping it.
+        """
+        if not self._check_lock.acquire(blocking=wait):
+            return
+        try:
+            if wait and self.last_checked is not None:
+                # Checked while this caller waited.
+                return
+            self.check_health()
+        finally:
+            self._check_lock.release()
+
+
+class ReplicaRouter():
+    '''
+    Picks the endpoint a read query runs on. Replicas that fail or lag
+    behind are skipped until a later health check finds them usable
+    again, and the primary connection is used when no replica is.
+    '''
+
+    def __init__(self, datasource, replicas, key=None, version=None):
+        self.key = key
+        self.version = version
+        self.version_checked_at = time.monotonic()
+        self.policy = datasource.replica_routing
+        self.primary = Endpoint(
+            f'{datasource.id}:primary', datasource.type,
+            datasource.connection_str, datasource.connection_json,
+            is_primary=True)
+        self.replicas = [
+            Endpoint(f'{datasource.id}:{replica.id}', datasource.type,
+                     replica.connection_str,
+                     replica.connection_json or datasource.connection_json,
+                     for_exports=replica.use_for_exports,
+                     max_lag_seconds=replica.max_lag_seconds)
+            for replica in replicas
+        ]
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+
+    def _refresh_health(self, candidates):
+        # Endpoints are checked before their first use, later checks run in
+        # the background so that queries do not wait on them.
+        now = time.monotonic()
+        for endpoint in candidates:
+            if endpoint.last_checked is None:
+                endpoint.refresh_health(wait=True)
+            elif now - endpoint.last_checked > settings.REPLICA_HEALTH_CHECK_INTERVAL:
+                get_executor().submit(endpoint.refresh_health)
+
+    def choose(self, purpose='query'):
+        if self.policy == models.DataSource.ReplicaRouting.primary or not self.replicas:
+            return self.primary
+
+        candidates = [r for r in self.replicas if not r.for_exports]
+        if purpose == 'export':
+            candidates = [r for r in self.replicas if r.for_exports] or candidates
+        self._refresh_health(candidates)
+
+        now = time.monotonic()
+        with self._lock:
+            available = [r for r in candidates if r.in_rotation(now)]
+            if not available:
+                return self.primary
+            if self.policy == models.DataSource.ReplicaRouting.least_connections:
+                start = next(self._counter) % len(available)
+                rotated = available[start:] + available[:start]
+                return min(rotated, key=lambda r: r.active)
+            return available[next(self._counter) % len(available)]
+
+    @contextmanager
+    def connect(self, purpose='query'):
+        endpoint = self.choose(purpose)
+        with self._lock:
+            endpoint.active += 1
+        try:
+            try:
+                connection = endpoint.engine.connect()
+            except (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError):
+                # Only failures to connect say the replica is down, errors
+                # of the query itself do not.
+                if not endpoint.is_primary:
+                    endpoint.mark_failed()
+                raise
+            with connection as con:
+                yield con
+        finally:
+            with self._lock:
+                endpoint.active -= 1
+
+
+_routers = {}
+_routers_lock = threading.Lock()
+_executor = None
+
+
+def get_executor():
+    global _executor
+    with _routers_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.REPLICA_HEALTH_CHECK_WORKERS,
+                thread_name_prefix='terno-replica-health')
+        return _executor
+
+
+def _router_key(datasource):
+    return (datasource.id, datasource.type, datasource.connection_str,
+            json.dumps(datasource.connection_json, sort_keys=True),
+            datasource.replica_routing)
+
+
+def get_replica_version(datasource_id):
+    '''
+    Version of the replicas of the datasource, read from the database so
+    that every worker sees a replica added, changed or removed through
+    another one.
+    '''
+    version = models.DataSourceReplica.objects.filter(
+        data_source_id=datasource_id).aggregate(
+            count=Count('id'), last_id=Max('id'), updated_at=Max('updated_at'))
+    return (version['count'], version['last_id'], version['updated_at'])
+
+
+def get_router(datasource):
+    '''
+    Returns the router of the datasource. It is reused until the
+    datasource or its replicas change, the replicas are checked at most
+    every REPLICA_CONFIG_CHECK_INTERVAL seconds.
+    '''
+    key = _router_key(datasource)
+    now = time.monotonic()
+    with _routers_lock:
+        router = _routers.get(datasource.id)
+    if router is not None and router.key == key and \
+            now - router.version_checked_at < settings.REPLICA_CONFIG_CHECK_INTERVAL:
+        return router
+
+    version = get_replica_version(datasource.id)
+    if router is not None and router.key == key and router.version == version:
+        router.version_checked_at = now
+        return router
+    replicas = list(models.DataSourceReplica.objects.filter(
+        data_source_id=datasource.id, enabled=True))
+    router = ReplicaRouter(datasource, replicas, key, version)
+    with _routers_lock:
+        _routers[datasource.id] = router
+    return router
+
+
+def invalidate(datasource_id):
+    with _routers_lock:
+        _routers.pop(datasource_id, None)
+
+
+@contextmanager
+def connect(datasource, purpose='query'):
+    '''
+    Opens a connection for a read query on the datasource, routed to one
+    of its replicas when it has any. Exports prefer replicas that are
+    dedicated to them.
+    '''
+    with get_router(datasource).connect(purpose) as con:
+        yield con
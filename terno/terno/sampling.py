@@ -0,0 +1,69 @@
+from django.conf import settings
+from sqlglot import exp
+
+# Dialects supporting TABLESAMPLE and the sampling method to ask for.
+TABLESAMPLE_METHODS = {
+    'postgres': 'SYSTEM',
+    'bigquery': 'SYSTEM',
+    'tsql': 'SYSTEM',
+    'snowflake': 'SYSTEM',
+    'oracle': None,
+}
+
+
+def _scanned_tables(expression):
+    """Tables read by the query, leaving out references to its CTEs."""
+    cte_names = {cte.alias_or_name for cte in expression.find_all(exp.CTE)}
+    return [table for table in expression.find_all(exp.Table)
+            if table.db or table.name not in cte_names]
+
+
+def add_table_sample(expression, dialect, sample_percent):
+    method = TABLESAMPLE_METHODS[dialect]
+    for table in _scanned_tables(expression):
+        sample = exp.TableSample(this=table.copy(),
+                                 percent=exp.Literal.number(sample_percent))
+        if method:
+            sample.set('method', exp.var(method))
+        table.replace(sample)
+    return expression
+
+
+def add_row_cap(expression, row_cap):
+    for table in _scanned_tables(expression):
+        alias = table.alias_or_name
+        base_table = table.copy()
+        base_table.set('alias', None)
+        capped = exp.select('*').from_(base_table).limit(row_cap)
+        table.replace(capped.subquery(alias))
+    return expression
+
+
+def rewrite_for_preview(query, sample_percent=None, row_cap=None):
+    '''
+    Rewrites the ParsedQuery in place so it only reads a sample of every
+    table it scans. Dialects with TABLESAMPLE read `sample_percent` percent
+    of each table, the others scan at most `row_cap` rows per table.
+    '''
+    if sample_percent is None:
+        sample_percent = settings.PREVIEW_SAMPLE_PERCENT
+    if row_cap is None:
+        row_cap = settings.PREVIEW_ROW_CAP
+    dialect = query.dialect
+    try:
+        if dialect in TABLESAMPLE_METHODS:
+            query.transform(lambda e: add_table_sample(e, dialect, sample_percent))
+            sampling = {'method': 'tablesample', 'percent': sample_percent}
+        else:
+            query.transform(lambda e: add_row_cap(e, row_cap))
+            sampling = {'method': 'row_cap', 'rows_per_table': row_cap}
+    except Exception as e:
+        return {
+            'status': 'error',
+            'error': str(e)
+        }
+
+    return {
+        'status': 'success',
+        'sampling': sampling,
+    }
@@ -0,0 +1,223 @@
+import math
+import re
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from django.conf import settings
+from django.db.models import OuterRef, Q, Subquery
+import terno.models as models
+import terno.utils as utils
+
+
+def char_ngrams(text, ngram_range=(3, 5)):
+    '''Counts the character n-grams of the text, ignoring case and spacing.'''
+    text = ' ' + re.sub(r'\s+', ' ', text.lower()).strip() + ' '
+    ngrams = Counter()
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        for start in range(len(text) - n + 1):
+            ngrams[text[start:start + n]] += 1
+    return ngrams
+
+
+def _weights(ngrams, idf, n_documents):
+    '''TF-IDF weights of the n-grams and their norm.'''
+    # N-grams no document has get the highest inverse document frequency.
+    unseen = math.log(1 + n_documents) + 1
+    weights = {ngram: (1 + math.log(count)) * idf.get(ngram, unseen)
+               for ngram, count in ngrams.items()}
+    norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+    return weights, norm
+
+
+class SimilarityIndex():
+    '''
+    Character n-gram TF-IDF index over the questions asked on one
+    datasource whose generated SQL later ran successfully. Pairs are
+    added as they show up in QueryHistory. The weights and norms of the
+    questions are computed again once after questions were added, so a
+    search only sums the weights found in the postings of the n-grams of
+    the question. At most SIMILAR_QUESTION_INDEX_MAX_SIZE questions are
+    kept, the ones added first are dropped first.
+    '''
+
+    def __init__(self, datasource_id):
+        self.datasource_id = datasource_id
+        # Indexed questions by history id, oldest first.
+        self.documents = OrderedDict()
+        self.document_frequency = Counter()
+        # Documents, postings of (history id, weight) by n-gram, document
+        # norms and inverse document frequencies as of the last build.
+        self.built = ({}, {}, {}, {})
+        self.changed = False
+        # Update time and id of the last execution read.
+        self.watermark = None
+        self.refreshed_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, history_id, question, sql):
+        with self._lock:
+            if history_id in self.documents:
+                return
+            ngrams = char_ngrams(question)
+            self.documents[history_id] = {
+                'history_id': history_id,
+                'question': question,
+                'sql': sql,
+                'ngrams': ngrams,
+            }
+            self.document_frequency.update(ngrams.keys())
+            while len(self.documents) > settings.SIMILAR_QUESTION_INDEX_MAX_SIZE:
+                _, evicted = self.documents.popitem(last=False)
+                for ngram in evicted['ngrams']:
+                    self.document_frequency[ngram] -= 1
+                    if not self.document_frequency[ngram]:
+                        del self.document_frequency[ngram]
+            self.changed = True
+
+    def build(self):
+        '''Computes the weights of the documents when any were added since the last build.'''
+        with self._lock:
+            if not self.changed:
+                return
+            self.changed = False
+            documents = dict(self.documents)
+            document_frequency = dict(self.document_frequency)
+
+        n_documents = len(documents)
+        idf = {ngram: math.log((1 + n_documents) / (1 + frequency)) + 1
+               for ngram, frequency in document_frequency.items()}
+        postings = defaultdict(list)
+        norms = {}
+        for history_id, document in documents.items():
+            weights, norms[history_id] = _weights(document['ngrams'], idf, n_documents)
+            for ngram, weight in weights.items():
+                postings[ngram].append((history_id, weight))
+        self.built = (documents, dict(postings), norms, idf)
+
+    def search(self, question, limit=3):
+        '''Returns the most similar indexed questions with their SQL.'''
+        self.build()
+        documents, postings, norms, idf = self.built
+        query_weights, query_norm = _weights(char_ngrams(question), idf, len(documents))
+        scores = defaultdict(float)
+        for ngram, weight in query_weights.items():
+            for history_id, document_weight in postings.get(ngram, ()):
+                scores[history_id] += weight * document_weight
+
+        results = sorted(((dot / (query_norm * norms[history_id]), documents[history_id])
+                          for history_id, dot in scores.items()),
+                         key=lambda result: result[0], reverse=True)
+        similar = []
+        seen_sql = set()
+        for similarity, document in results:
+            if document['sql'] in seen_sql:
+                continue
+            seen_sql.add(document['sql'])
+            similar.append({
+                'history_id': document['history_id'],
+                'question': document['question'],
+                'sql': document['sql'],
+                'similarity': round(similarity, 4),
+            })
+            if len(similar) == limit:
+                break
+        return similar
+
+    def refresh(self):
+        '''
+        Adds the question and generated SQL pairs whose SQL was executed
+        successfully since the last refresh. The executions are read
+        SIMILAR_QUESTION_REFRESH_BATCH_SIZE at a time, in the order they
+        were last updated.
+        '''
+        if not self._refresh_lock.acquire(blocking=False):
+            # Another request is refreshing the index already.
+            return
+        try:
+            self.refreshed_at = time.monotonic()
+            executions = models.QueryHistory.objects.filter(
+                data_source_id=self.datasource_id, data_type='user_executed_sql',
+                succeeded=True, updated_at__isnull=False,
+            ).order_by('updated_at', 'id')
+            question = models.QueryHistory.objects.filter(
+                user=OuterRef('user'), data_source=OuterRef('data_source'),
+                data_type='user_prompt', id__lt=OuterRef('id')).order_by('-id')
+            while True:
+                page = executions
+                if self.watermark is not None:
+                    updated_at, last_id = self.watermark
+                    page = page.filter(Q(updated_at__gt=updated_at)
+                                       | Q(updated_at=updated_at, id__gt=last_id))
+                page = list(page.values_list('id', 'updated_at', 'data')[
+                    :settings.SIMILAR_QUESTION_REFRESH_BATCH_SIZE])
+                if not page:
+                    break
+
+                pairs = models.QueryHistory.objects.filter(
+                    data_source_id=self.datasource_id, data_type='generated_sql',
+                    data__in={sql for _, _, sql in page},
+                ).annotate(
+                    question=Subquery(question.values('data')[:1])
+                ).values_list('id', 'question', 'data')
+                for history_id, question_text, sql in pairs:
+                    if question_text:
+                        self.add(history_id, question_text, sql)
+                last_id, updated_at, _ = page[-1]
+                self.watermark = (updated_at, last_id)
+            self.build()
+        finally:
+            self._refresh_lock.release()
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(datasource_id):
+    with _indexes_lock:
+        index = _indexes.get(datasource_id)
+        if index is None:
+            index = SimilarityIndex(datasource_id)
+            _indexes[datasource_id] = index
+    if (index.refreshed_at is None or time.monotonic() - index.refreshed_at
+            >= settings.SIMILAR_QUESTION_REFRESH_INTERVAL):
+        index.refresh()
+    return index
+
+
+def clear():
+    with _indexes_lock:
+        _indexes.clear()
+
+
+def find_similar_questions(datasource, roles, question, limit=None):
+    '''
+    Returns earlier questions on the datasource similar to this one, at
+    least SIMILAR_QUESTION_SUGGEST_THRESHOLD similar, most similar first.
+    Those above SIMILAR_QUESTION_REUSE_THRESHOLD are marked reusable.
+    Questions whose SQL the roles are not allowed to run are left out.
+    '''
+    if limit is None:
+        limit = settings.SIMILAR_QUESTION_LIMIT
+    index = get_index(datasource.id)
+    # Look further than the limit, some questions may be left out.
+    candidates = [similar for similar in index.search(question, limit * 4)
+                  if similar['similarity'] >= settings.SIMILAR_QUESTION_SUGGEST_THRESHOLD]
+    if not candidates:
+        return []
+    translations = utils.translate_sql_batch(
+        datasource, roles, [similar['sql'] for similar in candidates])
+
+    similar_questions = []
+    for similar, translation in zip(candidates, translations):
+        if translation['status'] != 'success':
+            continue
+        similar['reusable'] = similar['similarity'] >= settings.SIMILAR_QUESTION_REUSE_THRESHOLD
+        similar_questions.append(similar)
+        if len(similar_questions) == limit:
+            break
+    return similar_questions
@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+import terno.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+
+class _Call():
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_calls = {}
+_calls_lock = threading.Lock()
+
+
+def make_key(*parts):
+    digest = hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+    return f'terno:singleflight:{digest}'
+
+
+def do(key, fn):
+    '''
+    Runs fn once for all concurrent callers using the same key. The
+    first caller executes it and the others wait and receive its result
+    (or its exception). With SINGLE_FLIGHT_CACHE_LOCK enabled the
+    leader also takes a lock in the shared cache so that other processes
+    wait for the result instead of running the same work.
+    '''
+    with _calls_lock:
+        call = _calls.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _calls[key] = call
+
+    if not leader:
+        metrics.incr('singleflight_shared_total')
+        call.event.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    try:
+        if settings.SINGLE_FLIGHT_CACHE_LOCK:
+            call.result = _do_with_cache_lock(key, fn)
+        else:
+            call.result = fn()
+        return call.result
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _calls_lock:
+            del _calls[key]
+        call.event.set()
+
+
+def _do_with_cache_lock(key, fn):
+    lock_key = f'{key}:lock'
+    result_key = f'{key}:result'
+    lock_timeout = settings.SINGLE_FLIGHT_LOCK_TIMEOUT
+    deadline = time.monotonic() + lock_timeout
+    token = uuid.uuid4().hex
+
+    while not cache.add(lock_key, token, timeout=lock_timeout):
+        # Another process is running the same work, wait for its result.
+        if time.monotonic() > deadline:
+            break
+        time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        result = cache.get(result_key)
+        if result is not None:
+            metrics.incr('singleflight_shared_total')
+            return result
+    else:
+        try:
+            result = fn()
+            try:
+                cache.set(result_key, result, timeout=settings.SINGLE_FLIGHT_RESULT_TTL)
+            except Exception as e:
+                logger.warning(e)
+            return result
+        finally:
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+    # The other process took too long, run the work ourselves.
+    return fn()
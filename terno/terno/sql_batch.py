@@ -0,0 +1,67 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+import terno.utils as utils
+import terno.cost_estimation as cost_estimation
+import terno.replicas as replicas
+
+logger = logging.getLogger(__name__)
+
+
+def check_statements(statements):
+    '''Returns why the batch can not be run, or None when it can.'''
+    if not isinstance(statements, list) or not statements:
+        return 'Provide a list of SQL statements.'
+    if not all(isinstance(statement, str) and statement.strip()
+               for statement in statements):
+        return 'Every statement must be a non empty string.'
+    if len(statements) > settings.BATCH_SQL_MAX_STATEMENTS:
+        return f'At most {settings.BATCH_SQL_MAX_STATEMENTS} statements can be run in one batch.'
+    return None
+
+
+def run_statement(datasource, native_sql, page, per_page, user):
+    cost_response = cost_estimation.check_query_cost(datasource, native_sql, user)
+    if cost_response['status'] != 'success':
+        return {
+            'status': cost_response['status'],
+            'error': cost_response['error'],
+            'cost_estimate': cost_response['cost_estimate'],
+        }
+
+    start_time = time.perf_counter()
+    # The response may be shared with identical queries, so copy it.
+    response = dict(utils.execute_native_sql(datasource, native_sql, page,
+                                             per_page, user=user))
+    response['execution_time'] = time.perf_counter() - start_time
+    response['cost_estimate'] = cost_response['cost_estimate']
+    return response
+
+
+def run_statements(datasource, native_sqls, page=1, per_page=25, user=None):
+    '''
+    Runs the translated statements of a batch concurrently on the pooled
+    engine of the datasource, at most BATCH_SQL_MAX_WORKERS at a time, and
+    returns one response per statement in the order they were given.
+    '''
+    if not native_sqls:
+        return []
+
+    # Load the replica router here, the worker threads do not use the ORM.
+    replicas.get_router(datasource)
+
+    def run(native_sql):
+        try:
+            return run_statement(datasource, native_sql, page, per_page, user)
+        except Exception as e:
+            logger.exception(e)
+            return {
+                'status': 'error',
+                'error': str(e)
+            }
+
+    max_workers = min(len(native_sqls), settings.BATCH_SQL_MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=max_workers,
+                            thread_name_prefix='terno-sql-batch') as executor:
+        return list(executor.map(run, native_sqls))
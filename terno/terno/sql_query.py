@@ -0,0 +1,95 @@
+import contextvars
+import logging
+import time
+import sqlglot
+import terno.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# sqlalchemy dialect name -> sqlglot dialect name
+SQLGLOT_DIALECTS = {
+    'postgresql': 'postgres',
+    'mysql': 'mysql',
+    'sqlite': 'sqlite',
+    'bigquery': 'bigquery',
+    'oracle': 'oracle',
+    'mssql': 'tsql',
+    'snowflake': 'snowflake',
+}
+
+
+def get_sqlglot_dialect(dialect_name):
+    return SQLGLOT_DIALECTS.get(dialect_name)
+
+
+class ParseStats():
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+
+
+_parse_stats = contextvars.ContextVar('sql_parse_stats', default=None)
+
+
+def start_stats():
+    stats = ParseStats()
+    _parse_stats.set(stats)
+    return stats
+
+
+def get_stats():
+    return _parse_stats.get()
+
+
+def record_parse(seconds):
+    '''
+    Counts one parse of SQL text towards the current request. Parses done
+    outside of ParsedQuery (e.g. inside sqlshield) are recorded with this.
+    '''
+    stats = _parse_stats.get()
+    if stats is not None:
+        stats.record(seconds)
+    metrics.observe('sql_parse_seconds', seconds)
+
+
+class ParsedQuery():
+    '''
+    SQL text together with its sqlglot AST. The text is parsed at most
+    once, the first time a stage asks for the AST, and the stages then
+    modify that AST in place. The SQL text is generated again only when
+    it is read after a modification.
+    '''
+
+    def __init__(self, sql, dialect_name=None):
+        self.dialect = get_sqlglot_dialect(dialect_name)
+        self._sql = sql
+        self._expression = None
+        self._dirty = False
+
+    @property
+    def expression(self):
+        if self._expression is None:
+            start_time = time.perf_counter()
+            self._expression = sqlglot.parse_one(self._sql, read=self.dialect)
+            record_parse(time.perf_counter() - start_time)
+        return self._expression
+
+    @property
+    def sql(self):
+        if self._dirty:
+            self._sql = self._expression.sql(dialect=self.dialect)
+            self._dirty = False
+        return self._sql
+
+    def transform(self, fn):
+        '''Calls fn with the AST, which it may change in place.'''
+        result = fn(self.expression)
+        self._dirty = True
+        return result
+
+    def __str__(self):
+        return self.sql
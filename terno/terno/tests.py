@@ -1,14 +1,49 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from unittest.mock import patch, MagicMock
 from django.contrib.auth.models import User, Group
 from django.http import HttpResponse
+from django.contrib import admin
+from django.core.management import call_command
 import terno.models as models
+import terno.admin as terno_admin
 import terno.utils as utils
+import terno.query_jobs as query_jobs
+import terno.admission as admission
+import terno.metrics as metrics
+import terno.singleflight as singleflight
+import terno.cost_estimation as cost_estimation
+import terno.replicas as replicas
+import terno.sampling as sampling
+import terno.sql_query as sql_query
+import terno.fingerprint as fingerprint
+import terno.sql_batch as sql_batch
+import terno.question_batch as question_batch
+import terno.similarity as similarity
+from django.core.cache import cache
 import terno.llm as llms
+import terno.llm.clients as llm_clients
+from terno.llm import response_cache
+from terno.llm import resilience
+from terno.llm import usage as llm_usage
 from terno.pipeline.pipeline import Pipeline
-from terno.pipeline.step import Step
+from terno.pipeline.step import Step, FunctionStep
+from terno.pipeline.result import PipelineResult, StepError, StepResult
+from terno.pipeline.candidate_pipeline import CandidatePipeline
+import terno.pipeline.candidate_pipeline as candidate_pipeline
 import csv
+import sqlalchemy
+import concurrent.futures
 import io
+import time
+import threading
+import asyncio
+import tempfile
+from asgiref.sync import async_to_sync
+import json
+import os
+from datetime import timedelta
+from django.utils import timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
 class BaseTestCase(TestCase):
@@ -186,6 +221,824 @@ class LLMTestCase(BaseTestCase):
         self.assertEqual(response, "SELECT 1")
 
 
+class FakeLLMTestCase(BaseTestCase):
+    def setUp(self):
+        resilience.reset()
+        llms.LLMFactory.invalidate()
+        self.addCleanup(resilience.reset)
+        self.addCleanup(llms.LLMFactory.invalidate)
+        self.user = super().create_user()
+        self.ds = super().create_datasource()
+
+    def test_selected_by_factory(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as fixtures:
+            json.dump({'How many albums are there?': 'SELECT COUNT(*) FROM Album'}, fixtures)
+        self.addCleanup(os.remove, fixtures.name)
+        models.LLMConfiguration.objects.create(
+            llm_type='fake', api_key='none', enabled=True,
+            custom_parameters={'fixtures': fixtures.name, 'latency': 0.01})
+
+        self.client.force_login(self.user)
+        response = self.client.post(
+            '/get-sql/', content_type='application/json',
+            data={'prompt': 'how many albums are there', 'datasourceId': self.ds.id})
+        self.assertEqual(response.json()['generated_sql'], 'SELECT COUNT(*) FROM Album')
+        usage = models.LLMUsage.objects.get()
+        self.assertEqual((usage.provider, usage.model_name), ('FakeLLM', 'fake'))
+        self.assertGreaterEqual(usage.latency, 0.01)
+
+        response = self.client.post(
+            '/get-sql/', content_type='application/json',
+            data={'prompt': 'Show me all albums', 'datasourceId': self.ds.id,
+                  'reuse_similar': False})
+        self.assertEqual(response.json()['generated_sql'], 'SELECT 1')
+
+    def test_latency_distributions(self):
+        for distribution in ('uniform', 'normal', 'lognormal', 'exponential'):
+            llm = llms.FakeLLM(latency=0.2, latency_distribution=distribution,
+                               latency_stddev=0.05, seed=1)
+            samples = [llm.sample_latency() for _ in range(2000)]
+            self.assertTrue(all(sample >= 0 for sample in samples))
+            self.assertAlmostEqual(sum(samples) / len(samples), 0.2, delta=0.02)
+        self.assertEqual(llms.FakeLLM(latency=0.2).sample_latency(), 0.2)
+        with self.assertRaises(ValueError):
+            llms.FakeLLM(latency_distribution='pareto')
+
+    def test_errors_and_streaming(self):
+        llm = llms.FakeLLM(error_rate=1, error_status=429)
+        with self.assertRaises(Exception) as raised:
+            llm.get_response([])
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertTrue(resilience.is_retryable(raised.exception))
+
+        llm = llms.FakeLLM(default_sql='SELECT Title FROM Album LIMIT 3',
+                           chunk_size=2, chunk_interval=0.02)
+        start_time = time.monotonic()
+        self.assertEqual(list(llm.stream_response([])),
+                         ['SELECT Title', ' FROM Album', ' LIMIT 3'])
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.04)
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(request)
+        self.server.headers.append({name.lower(): value for name, value in self.headers.items()})
+        if request.get('stream'):
+            body = ''.join(f'data: {json.dumps(event)}\n\n'
+                           for event in self.server.stream_reply)
+            body = (body + 'data: [DONE]\n\n').encode('utf-8')
+            content_type = 'text/event-stream'
+        else:
+            body = json.dumps(self.server.reply).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    """Local HTTP server answering every request with the provider style `reply`."""
+    daemon_threads = True
+
+    def __init__(self, reply, stream_reply=None):
+        super().__init__(('127.0.0.1', 0), StubLLMHandler)
+        self.reply = reply
+        self.stream_reply = stream_reply or []
+        self.requests = []
+        self.headers = []
+        self.connections = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+OPENAI_REPLY = {
+    'id': 'chatcmpl-1', 'object': 'chat.completion', 'created': 0,
+    'model': 'gpt-3.5-turbo',
+    'choices': [{'index': 0, 'finish_reason': 'stop',
+                 'message': {'role': 'assistant', 'content': 'SELECT 1'}}],
+    'usage': {'prompt_tokens': 10, 'completion_tokens': 2, 'total_tokens': 12},
+}
+
+
+ANTHROPIC_REPLY = {
+    'id': 'msg_1', 'type': 'message', 'role': 'assistant',
+    'model': 'claude-3-5-sonnet-20240620',
+    'content': [{'type': 'text', 'text': 'SELECT 1'}],
+    'stop_reason': 'end_turn', 'stop_sequence': None,
+    'usage': {'input_tokens': 12, 'output_tokens': 2,
+              'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 1100},
+}
+
+
+def openai_stream_chunk(content):
+    return {
+        'id': 'chatcmpl-1', 'object': 'chat.completion.chunk', 'created': 0,
+        'model': 'gpt-3.5-turbo',
+        'choices': [{'index': 0, 'finish_reason': None,
+                     'delta': {'role': 'assistant', 'content': content}}],
+    }
+
+
+def parse_sse(response):
+    events = []
+    for block in b''.join(response.streaming_content).decode('utf-8').split('\n\n'):
+        if block:
+            event, data = block.split('\n')
+            events.append((event.removeprefix('event: '),
+                           json.loads(data.removeprefix('data: '))))
+    return events
+
+
+class LLMClientCacheTestCase(BaseTestCase):
+    def setUp(self):
+        llm_clients.clear()
+        self.server = StubLLMServer(OPENAI_REPLY)
+        environ = patch.dict(os.environ, {'OPENAI_BASE_URL': self.server.url + '/v1'})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.addCleanup(self.server.stop)
+        self.addCleanup(llm_clients.clear)
+
+    def test_connection_reused(self):
+        for _ in range(5):
+            llm = llms.OpenAILLM(api_key='test_key')
+            self.assertEqual(llm.get_response([]), 'SELECT 1')
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_clients_keyed_by_api_key(self):
+        first = llms.OpenAILLM(api_key='first_key').get_model_instance()
+        self.assertIs(llms.OpenAILLM(api_key='first_key').get_model_instance(), first)
+        self.assertIsNot(llms.OpenAILLM(api_key='second_key').get_model_instance(), first)
+
+    def test_clear_closes_clients_later(self):
+        openai_client = llms.OpenAILLM(api_key='test_key').get_model_instance()
+        anthropic_client = llms.AnthropicLLM(api_key='test_key').get_model_instance()
+        with self.settings(LLM_CLIENT_CLOSE_DELAY=0.2):
+            llm_clients.clear()
+        self.assertIsNot(llms.OpenAILLM(api_key='test_key').get_model_instance(), openai_client)
+        # Requests still using the dropped client are not cut off.
+        self.assertFalse(openai_client.is_closed())
+        self.assertEqual(openai_client.chat.completions.create(
+            model='gpt-3.5-turbo', messages=[]).choices[0].message.content, 'SELECT 1')
+        time.sleep(0.4)
+        self.assertTrue(openai_client.is_closed())
+        self.assertTrue(anthropic_client.is_closed())
+
+    def test_gemini_client_set_on_pinned_sdk_only(self):
+        llm = llms.GeminiLLM(api_key='test_key', model_name='gemini-1.5-flash-001')
+        model = llm.get_model_instance('system')
+        self.assertIs(llm.get_model_instance('system')._client, model._client)
+        with patch('terno.llm.gemini.CACHED_CLIENTS_SUPPORTED', False), \
+                patch('google.generativeai.configure') as configure:
+            model = llm.get_model_instance('system')
+        self.assertIsNone(model._client)
+        configure.assert_called_once_with(api_key='test_key')
+
+    def test_refresh_on_configuration_change(self):
+        first = llms.OllamaLLM(host=self.server.url).get_model_instance()
+        models.LLMConfiguration.objects.create(
+            llm_type='openai', api_key='test_key', enabled=True)
+        self.assertIsNot(llms.OllamaLLM(host=self.server.url).get_model_instance(), first)
+
+
+class PromptCachingTestCase(BaseTestCase):
+    def setUp(self):
+        llm_clients.clear()
+        metrics.reset()
+        self.addCleanup(llm_clients.clear)
+        self.addCleanup(metrics.reset)
+
+    def start_server(self, reply, base_url_variable, path=''):
+        server = StubLLMServer(reply)
+        self.addCleanup(server.stop)
+        environ = patch.dict(os.environ, {base_url_variable: server.url + path})
+        environ.start()
+        self.addCleanup(environ.stop)
+        return server
+
+    def test_anthropic_prefix_marked(self):
+        server = self.start_server(ANTHROPIC_REPLY, 'ANTHROPIC_BASE_URL')
+        llm = llms.AnthropicLLM(api_key='test_key')
+        for question in ['first question', 'second question']:
+            messages = llm.create_message_for_llm('system', 'schema', question)
+            self.assertEqual(llm.get_response(messages), 'SELECT 1')
+
+        first, second = server.requests
+        self.assertEqual(first['messages'][:2], second['messages'][:2])
+        self.assertEqual(first['messages'][1]['content'], [
+            {'type': 'text', 'text': 'schema', 'cache_control': {'type': 'ephemeral'}}])
+        self.assertEqual(second['messages'][2], {'role': 'user', 'content': 'second question'})
+        self.assertEqual(server.headers[0]['anthropic-beta'], 'prompt-caching-2024-07-31')
+        self.assertEqual(metrics.get_counter('llm_cached_prompt_tokens_total',
+                                             provider='AnthropicLLM'), 2200)
+        self.assertEqual(metrics.get_counter('llm_prompt_tokens_total',
+                                             provider='AnthropicLLM'), 2224)
+
+    def test_anthropic_caching_disabled(self):
+        server = self.start_server(ANTHROPIC_REPLY, 'ANTHROPIC_BASE_URL')
+        llm = llms.AnthropicLLM(api_key='test_key')
+        with self.settings(LLM_PROMPT_CACHING=False):
+            llm.get_response(llm.create_message_for_llm('system', 'schema', 'question'))
+        self.assertEqual(server.requests[0]['messages'][1]['content'], 'schema')
+        self.assertNotIn('anthropic-beta', server.headers[0])
+
+    def test_openai_cached_tokens_recorded(self):
+        reply = dict(OPENAI_REPLY, usage={
+            'prompt_tokens': 1200, 'completion_tokens': 2, 'total_tokens': 1202,
+            'prompt_tokens_details': {'cached_tokens': 1024}})
+        server = self.start_server(reply, 'OPENAI_BASE_URL', '/v1')
+        llm = llms.OpenAILLM(api_key='test_key')
+        llm.get_response(llm.create_message_for_llm('system', 'schema', 'question'))
+        self.assertEqual([message['role'] for message in server.requests[0]['messages']],
+                         ['system', 'assistant', 'user'])
+        self.assertEqual(metrics.get_counter('llm_cached_prompt_tokens_total',
+                                             provider='OpenAILLM'), 1024)
+
+
+class LLMFactoryCacheTestCase(BaseTestCase):
+    def setUp(self):
+        llms.LLMFactory.invalidate()
+        self.addCleanup(llms.LLMFactory.invalidate)
+        self.config = models.LLMConfiguration.objects.create(
+            llm_type='openai', api_key='test_key', model_name='gpt-4o', enabled=True)
+
+    def test_llm_reused(self):
+        with patch.object(llms.LLMFactory, 'build_llm',
+                          wraps=llms.LLMFactory.build_llm) as build_llm:
+            first = llms.LLMFactory.create_llm()
+            second = llms.LLMFactory.create_llm()
+        self.assertIs(first, second)
+        self.assertEqual(first.model_name, 'gpt-4o')
+        build_llm.assert_called_once()
+
+    def test_invalidated_on_change(self):
+        first = llms.LLMFactory.create_llm()
+        self.config.model_name = 'gpt-4o-mini'
+        self.config.save()
+        second = llms.LLMFactory.create_llm()
+        self.assertIsNot(first, second)
+        self.assertEqual(second.model_name, 'gpt-4o-mini')
+
+        self.config.delete()
+        with self.assertRaises(ValueError):
+            llms.LLMFactory.create_llm()
+
+    def test_version_change_from_other_worker(self):
+        first = llms.LLMFactory.create_llm()
+        # Another worker saved the configuration, this one got no signal.
+        models.LLMConfiguration.objects.filter(id=self.config.id).update(
+            model_name='gpt-4o-mini', updated_at=timezone.now())
+        self.assertIs(llms.LLMFactory.create_llm(), first)
+        with self.settings(LLM_CONFIG_CHECK_INTERVAL=0), \
+                patch('terno.llm.clients.clear') as clear:
+            self.assertEqual(llms.LLMFactory.create_llm().model_name, 'gpt-4o-mini')
+        # The clients of the old configuration are dropped here too.
+        clear.assert_called_once_with()
+
+
+class LLMResponseCacheTestCase(BaseTestCase):
+    def setUp(self):
+        self.llm = llms.OpenAILLM(api_key='test_key', temperature=0)
+        self.messages = self.llm.create_message_for_llm('system', 'schema', 'question')
+
+    def test_cached_at_temperature_zero(self):
+        with patch.object(self.llm, 'get_response', return_value='SELECT 1') as get_response:
+            self.assertEqual(response_cache.get_response(self.llm, self.messages),
+                             ('SELECT 1', False))
+            self.assertEqual(response_cache.get_response(self.llm, self.messages),
+                             ('SELECT 1', True))
+            other_messages = self.llm.create_message_for_llm('system', 'schema', 'other')
+            self.assertEqual(response_cache.get_response(self.llm, other_messages),
+                             ('SELECT 1', False))
+        self.assertEqual(get_response.call_count, 2)
+        self.assertEqual(models.LLMResponseCache.objects.get(
+            key=response_cache.cache_key(self.llm, self.messages)).hits, 1)
+
+    def test_sampling_parameters_in_key(self):
+        other_llm = llms.OpenAILLM(api_key='test_key', temperature=0, max_tokens=10)
+        self.assertNotEqual(response_cache.cache_key(self.llm, self.messages),
+                            response_cache.cache_key(other_llm, self.messages))
+
+    def test_not_cached_when_sampling(self):
+        self.llm.temperature = 0.7
+        with patch.object(self.llm, 'get_response', return_value='SELECT 1') as get_response:
+            response_cache.get_response(self.llm, self.messages)
+            response_cache.get_response(self.llm, self.messages)
+            self.assertEqual(get_response.call_count, 2)
+
+            self.llm.cache_responses = True
+            response_cache.get_response(self.llm, self.messages)
+            response_cache.get_response(self.llm, self.messages)
+            self.assertEqual(get_response.call_count, 3)
+
+    def test_expired(self):
+        with patch.object(self.llm, 'get_response', return_value='SELECT 1') as get_response, \
+                self.settings(LLM_RESPONSE_CACHE_TTL=0):
+            response_cache.get_response(self.llm, self.messages)
+            self.assertEqual(response_cache.get_response(self.llm, self.messages),
+                             ('SELECT 1', False))
+        self.assertEqual(get_response.call_count, 2)
+
+    def test_evicted_by_size(self):
+        with patch.object(self.llm, 'get_response', side_effect=['a' * 60, 'b' * 60, 'c' * 60]), \
+                self.settings(LLM_RESPONSE_CACHE_MAX_BYTES=150):
+            for question in ['first', 'second', 'third']:
+                messages = self.llm.create_message_for_llm('system', 'schema', question)
+                response_cache.get_response(self.llm, messages)
+        self.assertEqual(sorted(models.LLMResponseCache.objects.values_list('response', flat=True)),
+                         ['b' * 60, 'c' * 60])
+        self.assertEqual(response_cache.purge(), 2)
+
+    @patch('terno.utils.LLMFactory.create_llm')
+    def test_hits_recorded_in_history(self, mock_create_llm):
+        mock_create_llm.return_value = self.llm
+        user = super().create_user()
+        ds = super().create_datasource()
+        self.client.force_login(user)
+        with patch.object(self.llm, 'get_response_async', return_value='SELECT * FROM Album'):
+            for _ in range(2):
+                response = self.client.post(
+                    '/get-sql/', content_type='application/json',
+                    data={'prompt': 'Show me all albums', 'datasourceId': ds.id})
+                self.assertEqual(response.json()['generated_sql'], 'SELECT * FROM Album')
+        self.assertEqual(list(models.QueryHistory.objects.filter(
+            data_type='generated_sql').order_by('id').values_list('llm_cache_hit', flat=True)),
+            [False, True])
+
+
+class StreamResponseTestCase(BaseTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='12345',
+                                             is_staff=True)
+        self.ds = super().create_datasource()
+        self.client.force_login(self.user)
+
+    def test_openai_stream(self):
+        llm_clients.clear()
+        self.addCleanup(llm_clients.clear)
+        server = StubLLMServer(OPENAI_REPLY, [openai_stream_chunk('```sql\nSELECT'),
+                                              openai_stream_chunk(' 1```')])
+        self.addCleanup(server.stop)
+        with patch.dict(os.environ, {'OPENAI_BASE_URL': server.url + '/v1'}):
+            llm = llms.OpenAILLM(api_key='test_key')
+            chunks = list(llm.stream_response([]))
+        self.assertEqual(chunks, ['```sql\nSELECT', ' 1```'])
+        self.assertTrue(server.requests[0]['stream'])
+        self.assertEqual(llm.extract_sql(''.join(chunks)), 'SELECT 1')
+
+    @patch('terno.utils.LLMFactory.create_llm')
+    def test_get_sql_stream(self, mock_create_llm):
+        mock_create_llm.return_value = llms.FakeLLM(api_key='test_key')
+        response = self.client.post(
+            '/get-sql-stream/', content_type='application/json',
+            data={'prompt': 'Show me all albums', 'datasourceId': self.ds.id})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = parse_sse(response)
+        self.assertEqual(events[:2], [('token', {'token': 'SELECT'}),
+                                      ('token', {'token': ' 1'})])
+        self.assertEqual(events[2][0], 'done')
+        self.assertEqual(events[2][1]['generated_sql'], 'SELECT 1')
+        self.assertEqual(models.QueryHistory.objects.get(
+            data_type='generated_sql').data, 'SELECT 1')
+
+    @patch('terno.utils.LLMFactory.create_llm')
+    def test_console_stream_error(self, mock_create_llm):
+        mock_create_llm.side_effect = Exception("LLM Error")
+        response = self.client.post(
+            '/console-stream/', content_type='application/json',
+            data={'systemPrompt': '{{db_schema}}', 'assistantMessage': '',
+                  'userPrompt': 'Show me all albums', 'datasourceId': self.ds.id})
+        self.assertEqual(parse_sse(response), [
+            ('error', {'status': 'error', 'error': 'LLM Error'})])
+        self.assertFalse(models.QueryHistory.objects.filter(
+            data_type='generated_sql').exists())
+
+
+class SlowFakeLLM(llms.FakeLLM):
+    """Fake llm that takes `latency` seconds to answer asynchronously."""
+
+    def __init__(self, latency, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def get_response_async(self, messages) -> str:
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        await asyncio.sleep(self.latency)
+        self.in_flight -= 1
+        return "SELECT 1"
+
+
+class AsyncLLMTestCase(BaseTestCase):
+    def setUp(self):
+        self.user = super().create_user()
+        self.ds = super().create_datasource()
+
+    async def test_openai_async(self):
+        llm_clients.clear()
+        self.addCleanup(llm_clients.clear)
+        server = StubLLMServer(OPENAI_REPLY)
+        self.addCleanup(server.stop)
+        with patch.dict(os.environ, {'OPENAI_BASE_URL': server.url + '/v1'}), \
+                self.settings(LLM_ASYNC_CLIENTS=True):
+            llm = llms.OpenAILLM(api_key='test_key')
+            responses = await asyncio.gather(*[llm.get_response_async([]) for _ in range(3)])
+        self.assertEqual(responses, ['SELECT 1'] * 3)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_sync_clients_outside_asgi(self):
+        llm_clients.clear()
+        self.addCleanup(llm_clients.clear)
+        server = StubLLMServer(OPENAI_REPLY)
+        self.addCleanup(server.stop)
+        with patch.dict(os.environ, {'OPENAI_BASE_URL': server.url + '/v1'}), \
+                self.settings(LLM_ASYNC_CLIENTS=False):
+            llm = llms.OpenAILLM(api_key='test_key')
+            for _ in range(3):
+                # Every call runs on an event loop of its own, as under WSGI.
+                self.assertEqual(async_to_sync(llm.get_response_async)([]), 'SELECT 1')
+        self.assertEqual(len(llm_clients._async_clients), 0)
+        self.assertEqual(server.connections, 1)
+
+    async def test_concurrent_questions(self):
+        # Many more questions are waiting on the llm than there are threads.
+        llm = SlowFakeLLM(0.2, api_key='test_key')
+        await self.async_client.aforce_login(self.user)
+        with patch('terno.utils.LLMFactory.create_llm', return_value=llm):
+            responses = await asyncio.gather(*[
+                self.async_client.post(
+                    '/get-sql/', content_type='application/json',
+                    data={'prompt': f'Question {i}', 'datasourceId': self.ds.id})
+                for i in range(20)
+            ])
+        self.assertTrue(all(response.json()['generated_sql'] == 'SELECT 1'
+                            for response in responses))
+        self.assertEqual(llm.peak_in_flight, 20)
+
+
+class ServiceUnavailable(Exception):
+    status_code = 503
+
+
+class FlakyFakeLLM(llms.FakeLLM):
+    """Fake llm answering after `latency` seconds, raising `errors` first."""
+
+    def __init__(self, model_name, latency=0, errors=None, response="SELECT 1", **kwargs):
+        super().__init__(**kwargs)
+        self.model_name = model_name
+        self.latency = latency
+        self.errors = list(errors or [])
+        self.response = response
+        self.calls = 0
+
+    def answer(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.response
+
+    def get_response(self, messages) -> str:
+        time.sleep(self.latency)
+        return self.answer()
+
+    async def get_response_async(self, messages) -> str:
+        await asyncio.sleep(self.latency)
+        return self.answer()
+
+
+class ResilientLLMTestCase(BaseTestCase):
+    def setUp(self):
+        resilience.reset()
+        self.addCleanup(resilience.reset)
+        override = self.settings(LLM_RETRY_BACKOFF=0.01, LLM_REQUEST_TIMEOUT=5,
+                                 LLM_HEDGE_ENABLED=False)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_retries_retryable_errors(self):
+        primary = FlakyFakeLLM('primary', api_key='test_key', errors=[ServiceUnavailable(), ServiceUnavailable()])
+        self.assertEqual(llms.ResilientLLM(primary).get_response([]), 'SELECT 1')
+        self.assertEqual(primary.calls, 3)
+
+        primary = FlakyFakeLLM('primary', api_key='test_key', errors=[ValueError('Bad request')])
+        with self.assertRaises(ValueError):
+            llms.ResilientLLM(primary).get_response([])
+        self.assertEqual(primary.calls, 1)
+
+    def test_rejected_credentials_open_circuit(self):
+        class AuthenticationError(Exception):
+            status_code = 401
+
+        primary = FlakyFakeLLM('primary', api_key='test_key',
+                               errors=[ValueError('Bad request'), AuthenticationError()])
+        llm = llms.ResilientLLM(primary)
+        health = resilience.get_health(primary)
+        with self.settings(LLM_CIRCUIT_FAILURE_THRESHOLD=1):
+            with self.assertRaises(ValueError):
+                llm.get_response([])
+            # A bad request says nothing about the provider.
+            self.assertEqual(list(health.outcomes), [])
+            self.assertEqual(health.breaker.state, resilience.CircuitBreaker.CLOSED)
+            with self.assertRaises(AuthenticationError):
+                llm.get_response([])
+            self.assertEqual(health.breaker.state, resilience.CircuitBreaker.OPEN)
+
+    def test_queued_call_dropped_at_deadline(self):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        busy = threading.Event()
+        executor.submit(busy.wait, 1)
+        primary = FlakyFakeLLM('primary', api_key='test_key')
+        with patch('terno.llm.resilience.get_executor', return_value=executor), \
+                self.settings(LLM_REQUEST_TIMEOUT=0.1), \
+                llm_usage.collect() as records, \
+                self.assertRaises(resilience.LLMTimeoutError):
+            llms.ResilientLLM(primary).get_response([])
+        busy.set()
+        executor.shutdown(wait=True)
+        self.assertEqual(primary.calls, 0)
+        self.assertEqual(records, [])
+
+    def test_deadline(self):
+        llm = llms.ResilientLLM(FlakyFakeLLM('primary', api_key='test_key', latency=1))
+        start_time = time.monotonic()
+        with self.settings(LLM_REQUEST_TIMEOUT=0.1), \
+                self.assertRaises(resilience.LLMTimeoutError):
+            llm.get_response([])
+        self.assertLess(time.monotonic() - start_time, 0.5)
+
+    def test_circuit_breaker(self):
+        primary = FlakyFakeLLM('primary', api_key='test_key', errors=[ServiceUnavailable()] * 2)
+        llm = llms.ResilientLLM(primary)
+        with self.settings(LLM_MAX_RETRIES=0, LLM_CIRCUIT_FAILURE_THRESHOLD=2):
+            for _ in range(2):
+                with self.assertRaises(ServiceUnavailable):
+                    llm.get_response([])
+            with self.assertRaises(resilience.CircuitOpenError):
+                llm.get_response([])
+            self.assertEqual(primary.calls, 2)
+
+            with self.settings(LLM_CIRCUIT_RESET_TIMEOUT=0):
+                self.assertEqual(llm.get_response([]), 'SELECT 1')
+            self.assertEqual(resilience.get_health(primary).breaker.state,
+                             resilience.CircuitBreaker.CLOSED)
+
+    def test_fallback(self):
+        primary = FlakyFakeLLM('primary', api_key='test_key', errors=[ServiceUnavailable()] * 3)
+        fallback = FlakyFakeLLM('fallback', api_key='test_key', response='SELECT 2')
+        llm = llms.ResilientLLM(primary, fallback)
+        self.assertEqual(llm.get_response([]), 'SELECT 2')
+        self.assertEqual(primary.calls, 3)
+
+    def test_hedged_request(self):
+        primary = FlakyFakeLLM('primary', api_key='test_key', latency=1)
+        fallback = FlakyFakeLLM('fallback', api_key='test_key', response='SELECT 2')
+        llm = llms.ResilientLLM(primary, fallback)
+        start_time = time.monotonic()
+        with self.settings(LLM_HEDGE_ENABLED=True, LLM_HEDGE_DELAY=0.05), \
+                llm_usage.collect() as records:
+            self.assertEqual(llm.get_response([]), 'SELECT 2')
+        self.assertLess(time.monotonic() - start_time, 0.5)
+        # The losing call is recorded although it is still running.
+        self.assertEqual([(usage.model_name, usage.finish_reason) for usage in records],
+                         [('primary', 'cancelled')])
+
+    async def test_hedged_request_async(self):
+        primary = FlakyFakeLLM('primary', api_key='test_key', latency=1)
+        fallback = FlakyFakeLLM('fallback', api_key='test_key', response='SELECT 2')
+        llm = llms.ResilientLLM(primary, fallback)
+        with self.settings(LLM_HEDGE_ENABLED=True, LLM_HEDGE_DELAY=0.05):
+            self.assertEqual(await llm.get_response_async([]), 'SELECT 2')
+            # Answering fast again, the primary is not hedged.
+            primary.latency = 0
+            self.assertEqual(await llm.get_response_async([]), 'SELECT 1')
+        self.assertEqual(fallback.calls, 1)
+
+    def test_hedge_delay_from_latencies(self):
+        primary = FlakyFakeLLM('primary', api_key='test_key')
+        llm = llms.ResilientLLM(primary, FlakyFakeLLM('fallback', api_key='test_key'))
+        latencies = resilience.get_health(primary).latencies
+        with self.settings(LLM_HEDGE_MIN_SAMPLES=20, LLM_HEDGE_PERCENTILE=95,
+                           LLM_HEDGE_DELAY=10):
+            for seconds in range(1, 20):
+                latencies.record(seconds)
+            self.assertEqual(llm.hedge_delay(), 10)
+            latencies.record(20)
+            self.assertEqual(llm.hedge_delay(), 19)
+
+    def test_factory_builds_fallback(self):
+        llms.LLMFactory.invalidate()
+        self.addCleanup(llms.LLMFactory.invalidate)
+        fallback = models.LLMConfiguration.objects.create(
+            llm_type='anthropic', api_key='test_key', enabled=False)
+        models.LLMConfiguration.objects.create(
+            llm_type='openai', api_key='test_key', model_name='gpt-4o',
+            fallback=fallback, enabled=True)
+        llm = llms.LLMFactory.create_llm()
+        self.assertIsInstance(llm.llm, llms.OpenAILLM)
+        self.assertIsInstance(llm.fallback, llms.AnthropicLLM)
+        self.assertEqual(llm.model_name, 'gpt-4o')
+        messages = llm.create_message_for_llm('system', 'schema', 'question')
+        self.assertEqual(messages[0]['role'], 'system')
+        self.assertEqual(messages.fallback[0]['role'], 'user')
+
+
+class LLMRoutingTestCase(BaseTestCase):
+    def setUp(self):
+        resilience.reset()
+        llms.LLMFactory.invalidate()
+        self.addCleanup(resilience.reset)
+        self.addCleanup(llms.LLMFactory.invalidate)
+        self.fast = models.LLMConfiguration.objects.create(
+            llm_type='openai', api_key='test_key', model_name='gpt-4o-mini',
+            role='fast', enabled=True)
+        self.strong = models.LLMConfiguration.objects.create(
+            llm_type='anthropic', api_key='test_key', role='strong', enabled=True)
+
+    def test_routed_by_complexity(self):
+        self.assertEqual(llms.LLMFactory.create_llm('How many albums?', 'Album(Title)').role,
+                         'fast')
+        self.assertEqual(llms.LLMFactory.create_llm('x' * 400, 'Album(Title)').role,
+                         'strong')
+        with self.settings(LLM_ROUTER_SCHEMA_SIZE=5):
+            self.assertEqual(llms.LLMFactory.create_llm('How many albums?', 'Album(Title)').role,
+                             'strong')
+        self.assertEqual(llms.LLMFactory.create_llm(role='strong').model_name,
+                         llms.AnthropicLLM.model_name)
+
+    def test_routed_by_latency_and_errors(self):
+        models.LLMConfiguration.objects.create(
+            llm_type='openai', api_key='test_key', model_name='gpt-4o', enabled=True)
+        routed = llms.LLMFactory.get_llms()
+        for _ in range(10):
+            resilience.get_health(routed['fast']).record_success(2)
+            resilience.get_health(routed['default']).record_success(0.5)
+        self.assertEqual(llms.LLMFactory.create_llm('How many albums?').role, 'default')
+
+        with self.settings(LLM_CIRCUIT_FAILURE_THRESHOLD=100):
+            for _ in range(20):
+                resilience.get_health(routed['default']).record_failure()
+        self.assertEqual(llms.LLMFactory.create_llm('How many albums?').role, 'fast')
+
+    def test_one_enabled_configuration_per_role(self):
+        model_admin = terno_admin.LLMConfigurationAdmin(models.LLMConfiguration, admin.site)
+        other_fast = models.LLMConfiguration(
+            llm_type='openai', api_key='test_key', model_name='gpt-4o', role='fast')
+        model_admin.save_model(None, other_fast, None, False)
+        self.assertEqual(set(models.LLMConfiguration.objects.filter(enabled=True)),
+                         {other_fast, self.strong})
+
+    def test_escalated_on_invalid_sql(self):
+        user = super().create_user()
+        ds = super().create_datasource()
+        self.client.force_login(user)
+        with patch.object(llms.OpenAILLM, 'get_response_async',
+                          return_value='SELECT * FROM NoSuchTable'), \
+                patch.object(llms.AnthropicLLM, 'get_response_async',
+                             return_value='SELECT * FROM Album') as strong_response:
+            response = self.client.post(
+                '/get-sql/', content_type='application/json',
+                data={'prompt': 'Show me all albums', 'datasourceId': ds.id})
+        self.assertEqual(response.json()['generated_sql'], 'SELECT * FROM Album')
+        strong_response.assert_called_once()
+
+    def test_escalated_when_streaming(self):
+        user = super().create_user()
+        ds = super().create_datasource()
+        self.client.force_login(user)
+        with patch.object(llms.OpenAILLM, 'stream_response',
+                          return_value=iter(['SELECT * ', 'FROM NoSuchTable'])), \
+                patch.object(llms.AnthropicLLM, 'get_response',
+                             return_value='SELECT * FROM Album') as strong_response:
+            response = self.client.post(
+                '/get-sql-stream/', content_type='application/json',
+                data={'prompt': 'Show me all albums', 'datasourceId': ds.id})
+            events = parse_sse(response)
+        self.assertEqual(events[-1][0], 'done')
+        self.assertEqual(events[-1][1]['generated_sql'], 'SELECT * FROM Album')
+        strong_response.assert_called_once()
+        self.assertEqual(models.QueryHistory.objects.get(data_type='generated_sql').data,
+                         'SELECT * FROM Album')
+
+
+class ChunkedFakeLLM(llms.FakeLLM):
+    """Fake llm reporting its usage, streaming its response in two chunks."""
+    model_name = "fake"
+
+    def get_response(self, messages) -> str:
+        self.record_usage(100, 2, 80, 'stop')
+        return "SELECT 1"
+
+    def stream_response(self, messages):
+        yield "SELECT"
+        time.sleep(0.1)
+        yield " 1"
+        self.record_usage(100, 2, 80, 'stop')
+
+
+class LLMUsageTestCase(BaseTestCase):
+    def setUp(self):
+        resilience.reset()
+        self.addCleanup(resilience.reset)
+        self.user = super().create_user()
+        self.ds = super().create_datasource()
+
+    def test_recorded_per_call(self):
+        llm_clients.clear()
+        self.addCleanup(llm_clients.clear)
+        server = StubLLMServer(OPENAI_REPLY)
+        self.addCleanup(server.stop)
+        llm = llms.ResilientLLM(llms.OpenAILLM(api_key='test_key'))
+        self.client.force_login(self.user)
+        with patch.dict(os.environ, {'OPENAI_BASE_URL': server.url + '/v1'}), \
+                patch('terno.utils.LLMFactory.create_llm', return_value=llm):
+            response = self.client.post(
+                '/get-sql/', content_type='application/json',
+                data={'prompt': 'Show me all albums', 'datasourceId': self.ds.id})
+        self.assertEqual(response.json()['generated_sql'], 'SELECT 1')
+
+        usage = models.LLMUsage.objects.get()
+        self.assertEqual((usage.provider, usage.model_name), ('OpenAILLM', 'gpt-3.5-turbo'))
+        self.assertEqual((usage.prompt_tokens, usage.completion_tokens, usage.finish_reason),
+                         (10, 2, 'stop'))
+        self.assertGreater(usage.latency, 0)
+        self.assertEqual(usage.time_to_first_token, usage.latency)
+        self.assertEqual((usage.user, usage.data_source), (self.user, self.ds))
+        self.assertEqual(usage.query_history, models.QueryHistory.objects.get(
+            data_type='generated_sql'))
+        self.assertEqual(usage.prompt_log, models.PromptLog.objects.get())
+
+    def test_failed_calls_recorded(self):
+        llm = llms.ResilientLLM(llms.FakeLLM(error_rate=1))
+        with patch('terno.utils.LLMFactory.create_llm', return_value=llm), \
+                self.settings(LLM_RETRY_BACKOFF=0):
+            response = utils.llm_response(self.user, 'Show me all albums', 'Album(Title)',
+                                          self.ds)
+        self.assertEqual(response['status'], 'error')
+        self.assertEqual([(usage.finish_reason, usage.user, usage.data_source)
+                          for usage in models.LLMUsage.objects.all()],
+                         [('error', self.user, self.ds)] * 3)
+        self.assertEqual(models.LLMUsage.objects.first().prompt_log, models.PromptLog.objects.get())
+
+    def test_timed_out_call_recorded(self):
+        llm = llms.ResilientLLM(FlakyFakeLLM('slow', latency=0.5, api_key='test_key'))
+        with patch('terno.utils.LLMFactory.create_llm', return_value=llm), \
+                self.settings(LLM_REQUEST_TIMEOUT=0.1):
+            response = utils.llm_response(self.user, 'Show me all albums', 'Album(Title)',
+                                          self.ds)
+        self.assertEqual(response['status'], 'error')
+        usage = models.LLMUsage.objects.get()
+        self.assertEqual(usage.finish_reason, 'timeout')
+        self.assertGreaterEqual(usage.latency, 0.1)
+
+    def test_time_to_first_token(self):
+        step = Step(llms.ResilientLLM(ChunkedFakeLLM(api_key='test_key')), [])
+        self.assertEqual(''.join(step.stream()), 'SELECT 1')
+        usage, = step.usage
+        self.assertEqual((usage.prompt_tokens, usage.cached_tokens), (100, 80))
+        self.assertLess(usage.time_to_first_token, 0.1)
+        self.assertGreaterEqual(usage.latency, 0.1)
+
+    def test_usage_stats(self):
+        llm = llms.ResilientLLM(ChunkedFakeLLM(api_key='test_key'))
+        for _ in range(3):
+            step = Step(llm, [])
+            step.execute()
+            llm_usage.save(step.usage, user=self.user, data_source=self.ds)
+        models.LLMUsage.objects.filter(id=models.LLMUsage.objects.first().id).update(
+            created_at=timezone.now() - timedelta(days=1), model_name='other')
+
+        stats = list(llm_usage.usage_stats(group_by=('model_name', 'data_source', 'day')))
+        self.assertEqual([(row['model_name'], row['calls'], row['total_prompt_tokens'])
+                          for row in stats], [('fake', 2, 200), ('other', 1, 100)])
+        self.assertEqual(stats[0]['data_source'], self.ds.id)
+        self.assertEqual(stats[0]['day'], timezone.localdate())
+        self.assertEqual(llm_usage.usage_stats(group_by=('model_name',))
+                         .get(model_name='fake')['total_cached_tokens'], 160)
+
+
 class LLMResponseTestCase(BaseTestCase):
     def setUp(self):
         self.user = super().create_user()
@@ -204,7 +1057,8 @@ class LLMResponseTestCase(BaseTestCase):
         mock_pipeline = MagicMock(spec=Pipeline)
         mock_create_pipeline.return_value = mock_pipeline
 
-        mock_get_response.return_value = [["SELECT * FROM Album"]]
+        mock_get_response.return_value = PipelineResult([
+            StepResult('generate_sql', 'generated_sql', output="SELECT * FROM Album")])
 
         response = utils.llm_response(self.user, self.user_query,
                                       self.db_schema, self.datasource)
@@ -272,10 +1126,205 @@ class CreatePipelineTestCase(BaseTestCase):
 
     def test_run_pipeline(self):
         pipeline = Pipeline()
-        step = Step(self.llm, ['messages'])
+        step = Step(llms.FakeLLM(api_key='test_key'), ['messages'])
         pipeline.add_step(step)
         response = utils.get_response_from_pipeline(pipeline)
-        print(response)
+        self.assertEqual(response.output('generated_sql'), 'SELECT 1')
+
+
+class PipelineTestCase(BaseTestCase):
+    def sleep(self, seconds, output):
+        def step(**inputs):
+            time.sleep(seconds)
+            return output
+        return step
+
+    def test_independent_steps_run_concurrently(self):
+        pipeline = Pipeline([
+            FunctionStep(self.sleep(0.1, 'Album(Title)'), 'prune_schema', output='schema'),
+            FunctionStep(self.sleep(0.1, ['Q: albums A: SELECT * FROM Album']),
+                         'few_shots', output='examples'),
+            FunctionStep(lambda schema, examples, question: f'{schema} {len(examples)} {question}',
+                         'prompt', inputs=('schema', 'examples', 'question'), output='prompt'),
+        ])
+        start_time = time.monotonic()
+        response = pipeline.run(question='Show me all albums')
+        self.assertLess(time.monotonic() - start_time, 0.18)
+        self.assertEqual(response.output('prompt'), 'Album(Title) 1 Show me all albums')
+        self.assertEqual([result.name for result in response],
+                         ['prune_schema', 'few_shots', 'prompt'])
+        self.assertTrue(all(result.ok for result in response))
+
+    def test_failed_step(self):
+        def cost_check():
+            raise ValueError('Query is too expensive')
+
+        pipeline = Pipeline([
+            FunctionStep(cost_check, output='cost'),
+            FunctionStep(lambda cost: cost, 'report', inputs=('cost',)),
+        ])
+        with self.assertRaises(StepError) as raised:
+            pipeline.run()
+        self.assertEqual((raised.exception.step, raised.exception.status),
+                         ('cost_check', StepResult.ERROR))
+        self.assertEqual(str(raised.exception), 'Query is too expensive')
+        self.assertEqual(pipeline.results['report'].status, StepResult.SKIPPED)
+
+        with self.assertRaises(ValueError):
+            Pipeline([FunctionStep(lambda cost: cost, 'report', inputs=('cost',))]).run()
+
+    def test_step_timeout(self):
+        pipeline = Pipeline([
+            FunctionStep(self.sleep(0.5, 'Album(Title)'), 'prune_schema', output='schema',
+                         timeout=0.05),
+            FunctionStep(self.sleep(0, []), 'few_shots', output='examples'),
+        ])
+        start_time = time.monotonic()
+        with self.assertRaises(StepError) as raised:
+            pipeline.run()
+        self.assertLess(time.monotonic() - start_time, 0.3)
+        self.assertEqual(raised.exception.status, StepResult.TIMEOUT)
+        self.assertTrue(pipeline.results['few_shots'].ok)
+
+        def wait_for_result():
+            raise concurrent.futures.TimeoutError()
+
+        with self.assertRaises(StepError) as raised:
+            Pipeline([FunctionStep(wait_for_result)]).run()
+        self.assertEqual(raised.exception.status, StepResult.TIMEOUT)
+
+    def test_run_async(self):
+        async def prune_schema():
+            await asyncio.sleep(0.1)
+            return 'Album(Title)'
+
+        async def few_shots():
+            await asyncio.sleep(0.1)
+            return []
+
+        async def slow():
+            await asyncio.sleep(0.5)
+
+        pipeline = Pipeline([
+            FunctionStep(prune_schema, output='schema'),
+            FunctionStep(few_shots, output='examples'),
+            Step(llms.FakeLLM(), None, inputs=('schema', 'examples', 'messages')),
+        ])
+        start_time = time.monotonic()
+        response = async_to_sync(pipeline.run_async)(messages=[])
+        self.assertLess(time.monotonic() - start_time, 0.18)
+        self.assertEqual(response.output('generated_sql'), 'SELECT 1')
+
+        pipeline = Pipeline([FunctionStep(slow, timeout=0.05)])
+        with self.assertRaises(StepError) as raised:
+            async_to_sync(pipeline.run_async)()
+        self.assertEqual(raised.exception.status, StepResult.TIMEOUT)
+        self.assertEqual(str(raised.exception), 'Step slow timed out after 0.05 seconds.')
+
+
+class CandidateFakeLLM(llms.FakeLLM):
+    """Fake llm answering the queued (latency, sql) candidates in turn."""
+
+    def __init__(self, candidates, **kwargs):
+        super().__init__(**kwargs)
+        self.candidates = candidates
+
+    def get_response(self, messages) -> str:
+        latency, sql = self.candidates.pop(0)
+        time.sleep(latency)
+        return sql
+
+    async def get_response_async(self, messages) -> str:
+        latency, sql = self.candidates.pop(0)
+        await asyncio.sleep(latency)
+        return sql
+
+
+class CandidatePipelineTestCase(BaseTestCase):
+    def setUp(self):
+        self.user = super().create_user()
+        self.datasource = super().create_datasource()
+        override = self.settings(LLM_CANDIDATES=3)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    async def test_first_valid_candidate_wins(self):
+        llm = CandidateFakeLLM([(0.05, 'SELECT * FROM NoSuchTable'),
+                                (0.1, 'SELECT * FROM Album'),
+                                (2, 'SELECT * FROM Track')], api_key='test_key')
+        start_time = time.monotonic()
+        with patch('terno.utils.LLMFactory.create_llm', return_value=llm):
+            response = await utils.llm_response_async(
+                self.user, 'Show me all albums', 'Album(Title)', self.datasource)
+        self.assertEqual(response['generated_sql'], 'SELECT * FROM Album')
+        # The slowest candidate was cancelled instead of waited for.
+        self.assertLess(time.monotonic() - start_time, 1)
+        self.assertEqual(await models.PromptLog.objects.acount(), 1)
+
+    def test_first_candidate_when_none_valid(self):
+        pipeline = CandidatePipeline(validate=lambda sql: 'Invalid')
+        for name, latency in [('first', 0.1), ('second', 0), ('third', 0)]:
+            pipeline.add_step(Step(FlakyFakeLLM(name, latency, response=f'SELECT * FROM {name}',
+                                                api_key='test_key'), [], name=name))
+        response = utils.get_response_from_pipeline(pipeline)
+        self.assertEqual(response.output('generated_sql'), 'SELECT * FROM first')
+        self.assertEqual(len(pipeline.candidates), 3)
+
+    def test_sampled_candidates(self):
+        llm = llms.OpenAILLM(api_key='test_key', temperature=0)
+        pipeline = utils.create_pipeline(llm, 'multi_candidate_pipeline', self.user,
+                                         'Album(Title)', self.datasource, 'Show me all albums')
+        self.assertIsInstance(pipeline, CandidatePipeline)
+        self.assertEqual([step.llm.temperature for step in pipeline._steps], [0, 0.7, 0.7])
+        self.assertIs(pipeline._steps[1].messages, pipeline._steps[0].messages)
+        self.assertEqual([step.name for step in pipeline._steps],
+                         ['generate_sql', 'generate_sql_1', 'generate_sql_2'])
+        pipeline.check({})
+
+        pipeline.add_step(Step(llm, []))
+        with self.assertRaises(ValueError):
+            pipeline.run()
+
+    def test_cost_cap(self):
+        llm = llms.OpenAILLM(api_key='test_key', max_tokens=1000)
+        with self.settings(LLM_CANDIDATE_TOKEN_BUDGET=4000):
+            pipeline = utils.create_pipeline(llm, 'multi_candidate_pipeline', self.user,
+                                             'Album(Title)', self.datasource, 'Show me all albums')
+        self.assertEqual(len(pipeline._steps), 2)
+
+    def test_abandoned_candidates_use_budget(self):
+        pipeline = CandidatePipeline(candidate_tokens=30000)
+        for name, latency in [('first', 0.05), ('second', 0.3), ('third', 0.3)]:
+            pipeline.add_step(Step(FlakyFakeLLM(name, latency, api_key='test_key'), [], name=name))
+        pipeline.run()
+        self.assertEqual(candidate_pipeline.abandoned_tokens(), 60000)
+
+        llm = llms.OpenAILLM(api_key='test_key', max_tokens=1000)
+        with self.settings(LLM_CANDIDATE_TOKEN_BUDGET=61000):
+            # Only one candidate fits while the losers are running.
+            self.assertEqual(utils.candidate_count(llm, []), 1)
+            time.sleep(0.5)
+            self.assertEqual(candidate_pipeline.abandoned_tokens(), 0)
+            self.assertEqual(utils.candidate_count(llm, []), 3)
+
+    def test_late_candidates_usage_saved(self):
+        saved = []
+        pipeline = CandidatePipeline(save_usage=lambda step: saved.append(step.name))
+        for name, latency in [('first', 0), ('second', 0.2), ('third', 0.2)]:
+            pipeline.add_step(Step(FlakyFakeLLM(name, latency, api_key='test_key'), [], name=name))
+        pipeline.run()
+        self.assertEqual(pipeline.abandoned, {'second', 'third'})
+        time.sleep(0.4)
+        self.assertEqual(sorted(saved), ['second', 'third'])
+
+    def test_ollama_samples_at_temperature(self):
+        server = StubLLMServer({'model': 'llama3.1', 'done': True,
+                                'message': {'role': 'assistant', 'content': 'SELECT 1'}})
+        self.addCleanup(server.stop)
+        self.addCleanup(llm_clients.clear)
+        llm = llms.OllamaLLM(host=server.url).with_temperature(0.7)
+        self.assertEqual(llm.get_response([]), 'SELECT 1')
+        self.assertEqual(server.requests[0]['options']['temperature'], 0.7)
 
 
 class GenerateExecuteNativeSQLTestCase(BaseTestCase):
@@ -290,6 +1339,41 @@ class GenerateExecuteNativeSQLTestCase(BaseTestCase):
         self.assertEqual(response['native_sql'],
                          expected_sql)
 
+    def test_translate_sql_is_cached(self):
+        datasource = models.DataSource.objects.get(display_name='test_db')
+        roles = Group.objects.filter(name='sales')
+        cache = utils.get_translation_cache()
+        cache.clear()
+        hits, misses = cache.hits, cache.misses
+
+        with patch('terno.utils.prepare_mdb', wraps=utils.prepare_mdb) as mock_prepare_mdb:
+            first = utils.translate_sql(datasource, roles, 'SELECT * from Album;')
+            second = utils.translate_sql(datasource, roles, 'SELECT * from Album;')
+        self.assertEqual(first, second)
+        self.assertEqual(mock_prepare_mdb.call_count, 1)
+
+        error = utils.translate_sql(datasource, roles, 'SELECT * from InvalidTable;')
+        self.assertEqual(error['status'], 'error')
+        self.assertEqual(cache.misses - misses, 2)
+        self.assertEqual(cache.hits - hits, 1)
+
+    def test_translate_sql_invalidated_by_rule_change(self):
+        datasource = models.DataSource.objects.get(display_name='test_db')
+        roles = Group.objects.filter(name='sales')
+        user_sql = 'SELECT * from Track;'
+        before = utils.translate_sql(datasource, roles, user_sql)
+
+        models.TableRowFilter.objects.filter(data_source=datasource).update(filter_str='GenreId=2')
+        datasource.refresh_from_db()
+        self.assertEqual(utils.translate_sql(datasource, roles, user_sql), before)
+
+        row_filter = models.TableRowFilter.objects.get(data_source=datasource)
+        row_filter.save()
+        datasource.refresh_from_db()
+        after = utils.translate_sql(datasource, roles, user_sql)
+        self.assertIn('GenreId=2', after['native_sql'].replace(' ', ''))
+        self.assertNotEqual(after, before)
+
     def test_generate_native_sql_error(self):
         response = utils.generate_native_sql(self.mdb, 'SELECT * from InvalidTable;')
 
@@ -310,6 +1394,20 @@ class GenerateExecuteNativeSQLTestCase(BaseTestCase):
         self.assertEqual(result['table_data']['row_count'], 347)
         self.assertEqual(result['table_data']['page'], 1)
 
+    def test_execute_native_sql_defer_count(self):
+        datasource = models.DataSource.objects.get(display_name='test_db')
+        native_sql = 'SELECT * FROM Album;'
+        result = utils.execute_native_sql(datasource, native_sql, 1, 25,
+                                          defer_count=True)
+        self.assertIsNone(result['table_data']['row_count'])
+        self.assertIsNone(result['table_data']['total_pages'])
+        self.assertEqual(len(result['table_data']['data']), 25)
+
+        result = utils.execute_native_sql(datasource, native_sql, 14, 25,
+                                          defer_count=True)
+        self.assertEqual(result['table_data']['row_count'], 347)
+        self.assertEqual(len(result['table_data']['data']), 22)
+
 
 class ExportResultTestCase(BaseTestCase):
     def setUp(self) -> None:
@@ -331,6 +1429,815 @@ class ExportResultTestCase(BaseTestCase):
         self.assertEqual(rows[2], ['2', 'Balls to the Wall', '2'])
 
 
+class QueryJobTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        self.user = super().create_user()
+        self.ds = super().create_datasource()
+
+    def wait_for_job(self, job):
+        for _ in range(100):
+            if job.done:
+                return
+            time.sleep(0.05)
+        self.fail('Query job did not finish')
+
+    def test_submit_and_fetch_job(self):
+        job = query_jobs.submit_job(self.user, self.ds, 'SELECT * FROM Album;')
+        self.assertIs(query_jobs.get_job(self.user, job.id), job)
+        self.wait_for_job(job)
+
+        self.assertEqual(job.status, query_jobs.QueryJob.SUCCESS)
+        self.assertEqual(job.to_dict()['rows_fetched'], 347)
+        table_data = query_jobs.get_job_page(job, 2, 25)
+        self.assertEqual(table_data['columns'], ['AlbumId', 'Title', 'ArtistId'])
+        self.assertEqual(table_data['row_count'], 347)
+        self.assertEqual(table_data['data'][0]['AlbumId'], 26)
+
+    def test_background_row_count(self):
+        count_sql = utils.count_query(sql_query.ParsedQuery('SELECT * FROM Album;', 'sqlite'))
+        self.assertEqual(count_sql,
+                         'SELECT COUNT(*) AS row_count FROM (SELECT * FROM Album) AS terno_count')
+        job = query_jobs.submit_count_job(self.user, self.ds, count_sql)
+        self.wait_for_job(job)
+        self.assertEqual(job.rows[0][0], 347)
+        # Later pages of the same query reuse the count.
+        self.assertIs(query_jobs.submit_count_job(self.user, self.ds, count_sql), job)
+        other_user = User.objects.create_user(username='other', password='other')
+        self.assertIsNot(query_jobs.submit_count_job(other_user, self.ds, count_sql), job)
+
+    def test_job_error(self):
+        job = query_jobs.submit_job(self.user, self.ds, 'SELECT * FROM InvalidTable;')
+        self.wait_for_job(job)
+        self.assertEqual(job.status, query_jobs.QueryJob.ERROR)
+        self.assertIn('InvalidTable', job.error)
+
+    def test_job_not_visible_to_other_users(self):
+        other_user = User.objects.create_user(username='other', password='12345')
+        job = query_jobs.submit_job(self.user, self.ds, 'SELECT 1;')
+        self.assertIsNone(query_jobs.get_job(other_user, job.id))
+
+    def test_expired_jobs_are_purged(self):
+        job = query_jobs.submit_job(self.user, self.ds, 'SELECT 1;')
+        self.wait_for_job(job)
+        with self.settings(QUERY_JOB_TTL=0):
+            job.finished_at -= 1
+            self.assertIsNone(query_jobs.get_job(self.user, job.id))
+
+    def test_done_job_without_finish_time_not_expired(self):
+        job = query_jobs.QueryJob(self.user.id, self.ds.id, 'SELECT 1;')
+        job.status = query_jobs.QueryJob.SUCCESS
+        self.assertFalse(job.is_expired())
+
+
+class AdmissionControllerTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+
+    def test_busy_after_queue_timeout(self):
+        controller = admission.AdmissionController('ds', 1, 0.05)
+        controller.acquire('user1')
+        with self.assertRaises(admission.DatasourceBusy):
+            controller.acquire('user2')
+        self.assertEqual(controller.queue_depth, 0)
+        self.assertEqual(metrics.get_counter('admission_rejected_total',
+                                             datasource='ds'), 1)
+        controller.release()
+        controller.acquire('user2')
+        self.assertEqual(controller.running, 1)
+
+    def test_slots_are_shared_fairly_across_users(self):
+        controller = admission.AdmissionController('ds', 1, 5)
+        controller.acquire('holder')
+        order = []
+        order_lock = threading.Lock()
+
+        def run(user_key):
+            controller.acquire(user_key)
+            with order_lock:
+                order.append(user_key)
+            controller.release()
+
+        threads = []
+        for user_key in ['user1', 'user1', 'user1', 'user2']:
+            thread = threading.Thread(target=run, args=(user_key,))
+            thread.start()
+            threads.append(thread)
+            while controller.queue_depth < len(threads):
+                time.sleep(0.001)
+
+        controller.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['user1', 'user2', 'user1', 'user1'])
+
+    def test_limit_change_keeps_running_queries(self):
+        ds = super().create_datasource()
+        ds.max_concurrent_queries = 2
+        controller = admission.get_controller(ds)
+        controller.acquire('user1')
+        controller.acquire('user2')
+
+        ds.max_concurrent_queries = 1
+        self.assertIs(admission.get_controller(ds), controller)
+        with self.assertRaises(admission.DatasourceBusy):
+            controller.queue_timeout = 0.05
+            controller.acquire('user3')
+        controller.release()
+        with self.assertRaises(admission.DatasourceBusy):
+            controller.acquire('user3')
+        controller.release()
+        controller.acquire('user3')
+        self.assertEqual(controller.running, 1)
+        controller.release()
+
+    def test_execute_native_sql_busy(self):
+        ds = super().create_datasource()
+        ds.max_concurrent_queries = 1
+        ds.queue_timeout = 0
+        controller = admission.get_controller(ds)
+        controller.acquire('other')
+        try:
+            result = utils.execute_native_sql(ds, 'SELECT 1;', 1, 25)
+        finally:
+            controller.release()
+        self.assertEqual(result['status'], 'busy')
+        result = utils.execute_native_sql(ds, 'SELECT 1;', 1, 25)
+        self.assertEqual(result['status'], 'success')
+
+
+class SingleFlightTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        metrics.reset()
+
+    def test_concurrent_calls_share_one_execution(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return {'status': 'success'}
+
+        key = singleflight.make_key(1, 'SELECT 1', 1, 25)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(singleflight.do(key, work)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        while metrics.get_counter('singleflight_shared_total') < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_errors_are_shared(self):
+        def fail():
+            raise ValueError('boom')
+
+        key = singleflight.make_key('error')
+        with self.assertRaises(ValueError):
+            singleflight.do(key, fail)
+        self.assertEqual(singleflight.do(key, lambda: 'ok'), 'ok')
+
+    def test_waits_for_result_of_other_process(self):
+        key = singleflight.make_key('cache-lock')
+        cache.add(f'{key}:lock', 'other-process')
+        threading.Timer(0.1, lambda: cache.set(f'{key}:result', 'shared')).start()
+        with self.settings(SINGLE_FLIGHT_CACHE_LOCK=True,
+                           SINGLE_FLIGHT_POLL_INTERVAL=0.01):
+            result = singleflight.do(key, lambda: 'own')
+        self.assertEqual(result, 'shared')
+        cache.clear()
+
+
+class CostEstimationTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        self.ds = super().create_datasource()
+        self.ds.estimate_cost = True
+        self.ds.dialect_name = 'postgresql'
+        self.pg_plan = [{'Plan': {'Node Type': 'Seq Scan',
+                                  'Total Cost': 1500.5, 'Plan Rows': 90000}}]
+
+    @patch('terno.cost_estimation._explain')
+    def test_postgres_estimate(self, mock_explain):
+        mock_explain.return_value = self.pg_plan
+        response = cost_estimation.check_query_cost(self.ds, 'SELECT * FROM Album')
+        mock_explain.assert_called_once_with(
+            self.ds, 'EXPLAIN (FORMAT JSON) SELECT * FROM Album')
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['cost_estimate']['rows'], 90000)
+        self.assertEqual(response['cost_estimate']['cost'], 1500.5)
+        self.assertIsNone(response['cost_estimate']['warning'])
+
+    @patch('terno.cost_estimation._explain')
+    def test_thresholds(self, mock_explain):
+        mock_explain.return_value = self.pg_plan
+        self.ds.cost_warn_threshold = 1000
+        response = cost_estimation.check_query_cost(self.ds, 'SELECT * FROM Album')
+        self.assertEqual(response['status'], 'success')
+        self.assertIn('expensive', response['cost_estimate']['warning'])
+
+        self.ds.cost_reject_threshold = 1200
+        response = cost_estimation.check_query_cost(self.ds, 'SELECT * FROM Album')
+        self.assertEqual(response['status'], 'error')
+        self.assertIn('too expensive', response['error'])
+
+    @patch('terno.cost_estimation._explain')
+    def test_mysql_estimate(self, mock_explain):
+        self.ds.dialect_name = 'mysql'
+        mock_explain.return_value = '{"query_block": {"cost_info": {"query_cost": "35.25"}, ' \
+            '"table": {"table_name": "Album", "rows_examined_per_scan": 347}}}'
+        estimate = cost_estimation.estimate_cost(self.ds, 'SELECT * FROM Album')
+        self.assertEqual(estimate['cost'], 35.25)
+        self.assertEqual(estimate['rows'], 347)
+
+    @patch('terno.cost_estimation._explain')
+    def test_estimate_takes_a_query_slot(self, mock_explain):
+        mock_explain.return_value = self.pg_plan
+        self.ds.max_concurrent_queries = 1
+        self.ds.queue_timeout = 0
+        controller = admission.get_controller(self.ds)
+        controller.acquire('other')
+        try:
+            response = cost_estimation.check_query_cost(self.ds, 'SELECT * FROM Album')
+        finally:
+            controller.release()
+        self.assertEqual(response['status'], 'busy')
+        mock_explain.assert_not_called()
+
+    def test_explain_uses_the_pooled_router(self):
+        replica = models.DataSourceReplica.objects.create(
+            data_source=self.ds, display_name='r1', connection_str='sqlite:///../chinook.db')
+        router = replicas.get_router(self.ds)
+        self.assertEqual(cost_estimation._explain(self.ds, 'SELECT COUNT(*) FROM Album'), 347)
+        self.assertEqual(router.replicas[0].name, f'{self.ds.id}:{replica.id}')
+        self.assertIsNotNone(router.replicas[0]._engine)
+        # Later estimates reuse the engine.
+        with patch('terno.utils.create_db_engine') as create_db_engine:
+            self.assertEqual(cost_estimation._explain(self.ds, 'SELECT COUNT(*) FROM Album'), 347)
+        create_db_engine.assert_not_called()
+
+    def test_unsupported_dialect_is_allowed(self):
+        self.ds.dialect_name = 'sqlite'
+        self.ds.cost_reject_threshold = 0
+        response = cost_estimation.check_query_cost(self.ds, 'SELECT * FROM Album')
+        self.assertEqual(response['status'], 'success')
+        self.assertFalse(response['cost_estimate']['supported'])
+
+    def test_disabled(self):
+        self.ds.estimate_cost = False
+        response = cost_estimation.check_query_cost(self.ds, 'SELECT * FROM Album')
+        self.assertEqual(response, {'status': 'success', 'cost_estimate': None})
+
+
+class ReplicaRoutingTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        self.ds = super().create_datasource()
+
+    def add_replica(self, name, connection_str='sqlite:///../chinook.db', **kwargs):
+        return models.DataSourceReplica.objects.create(
+            data_source=self.ds, display_name=name,
+            connection_str=connection_str, **kwargs)
+
+    def test_primary_without_replicas(self):
+        router = replicas.get_router(self.ds)
+        self.assertIs(router.choose(), router.primary)
+
+    def test_round_robin(self):
+        r1 = self.add_replica('r1')
+        r2 = self.add_replica('r2')
+        router = replicas.get_router(self.ds)
+        chosen = [router.choose().name for _ in range(4)]
+        self.assertEqual(chosen, [f'{self.ds.id}:{r1.id}', f'{self.ds.id}:{r2.id}'] * 2)
+
+    def test_least_connections(self):
+        self.add_replica('r1')
+        self.add_replica('r2')
+        self.ds.replica_routing = models.DataSource.ReplicaRouting.least_connections
+        router = replicas.get_router(self.ds)
+        busy = router.choose()
+        busy.active = 3
+        for _ in range(3):
+            self.assertIsNot(router.choose(), busy)
+
+    def test_failed_replica_is_taken_out_of_rotation(self):
+        self.add_replica('broken', connection_str='sqlite:////nonexistent/dir/chinook.db')
+        healthy = self.add_replica('healthy')
+        router = replicas.get_router(self.ds)
+        for _ in range(3):
+            self.assertEqual(router.choose().name, f'{self.ds.id}:{healthy.id}')
+
+    def test_query_errors_keep_the_replica(self):
+        replica = self.add_replica('r1')
+        router = replicas.get_router(self.ds)
+        with self.assertRaises(sqlalchemy.exc.OperationalError):
+            with router.connect() as con:
+                con.execute(sqlalchemy.text('SELECT * FROM NoSuchTable'))
+        self.assertEqual(router.choose().name, f'{self.ds.id}:{replica.id}')
+
+    def test_recovered_replica_waits_for_cooldown(self):
+        self.add_replica('r1')
+        router = replicas.get_router(self.ds)
+        endpoint = router.replicas[0]
+        endpoint.mark_failed()
+        endpoint.check_health()
+        self.assertTrue(endpoint.healthy)
+        self.assertIs(router.choose(), router.primary)
+
+    def test_lagging_replica_is_taken_out_of_rotation(self):
+        self.add_replica('lagging', max_lag_seconds=10)
+        router = replicas.get_router(self.ds)
+        with patch('terno.replicas.replication_lag', return_value=60):
+            self.assertIs(router.choose(), router.primary)
+
+    def test_unknown_lag_keeps_the_replica(self):
+        replica = self.add_replica('r1', max_lag_seconds=10)
+        router = replicas.get_router(self.ds)
+        error = sqlalchemy.exc.ProgrammingError('SHOW REPLICA STATUS', {}, Exception())
+        with patch('terno.replicas.replication_lag', side_effect=error):
+            self.assertEqual(router.choose().name, f'{self.ds.id}:{replica.id}')
+        self.assertIsNone(router.replicas[0].lag)
+
+    def test_health_rechecked_in_background(self):
+        self.add_replica('r1')
+        router = replicas.get_router(self.ds)
+        router.choose()
+        router.replicas[0].last_checked -= 3600
+        with patch('terno.replicas.get_executor') as get_executor, \
+                patch.object(replicas.Endpoint, 'check_health') as check_health:
+            router.choose()
+        get_executor.return_value.submit.assert_called_once_with(
+            router.replicas[0].refresh_health)
+        check_health.assert_not_called()
+
+    def test_replica_changed_by_another_worker(self):
+        replica = self.add_replica('r1')
+        with self.settings(REPLICA_CONFIG_CHECK_INTERVAL=0):
+            router = replicas.get_router(self.ds)
+            self.assertIs(replicas.get_router(self.ds), router)
+            # Saved without the signals, as another worker would.
+            models.DataSourceReplica.objects.filter(id=replica.id).update(
+                enabled=False, updated_at=timezone.now())
+            router = replicas.get_router(self.ds)
+        self.assertEqual(router.replicas, [])
+        self.assertIs(router.choose(), router.primary)
+
+    def test_exports_use_dedicated_replica(self):
+        self.add_replica('interactive')
+        export = self.add_replica('export', use_for_exports=True)
+        router = replicas.get_router(self.ds)
+        for _ in range(2):
+            self.assertEqual(router.choose('export').name, f'{self.ds.id}:{export.id}')
+            self.assertNotEqual(router.choose().name, f'{self.ds.id}:{export.id}')
+
+    def test_execute_on_replica(self):
+        self.add_replica('r1')
+        native_sql = 'SELECT * FROM Album;'
+        result = utils.execute_native_sql(self.ds, native_sql, 1, 25)
+        self.assertEqual(result['table_data']['row_count'], 347)
+
+
+class PreviewSamplingTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        self.native_sql = 'SELECT * FROM (SELECT AlbumId AS AlbumId, Title AS Title, ' \
+            'ArtistId AS ArtistId FROM Album) AS Album'
+
+    def test_tablesample_dialect(self):
+        query = sql_query.ParsedQuery(self.native_sql, 'postgresql')
+        response = sampling.rewrite_for_preview(query, 1, 100)
+        self.assertEqual(response['status'], 'success')
+        self.assertIn('FROM Album TABLESAMPLE SYSTEM (1)', query.sql)
+        self.assertEqual(response['sampling'], {'method': 'tablesample', 'percent': 1})
+
+    def test_cte_references_are_not_sampled(self):
+        query = sql_query.ParsedQuery(
+            'WITH a AS (SELECT * FROM Album) SELECT * FROM a', 'postgresql')
+        sampling.rewrite_for_preview(query, 5, 100)
+        self.assertEqual(query.sql,
+                         'WITH a AS (SELECT * FROM Album TABLESAMPLE SYSTEM (5)) SELECT * FROM a')
+
+    def test_row_cap_dialect(self):
+        ds = super().create_datasource()
+        query = sql_query.ParsedQuery(self.native_sql, 'sqlite')
+        response = sampling.rewrite_for_preview(query, 1, 100)
+        self.assertIn('FROM (SELECT * FROM Album LIMIT 100) AS Album', query.sql)
+        self.assertEqual(response['sampling'], {'method': 'row_cap', 'rows_per_table': 100})
+
+        result = utils.execute_native_sql(ds, query.sql, 1, 25)
+        self.assertEqual(result['table_data']['row_count'], 100)
+
+    def test_invalid_sql(self):
+        query = sql_query.ParsedQuery('SELECT * FROM (', 'postgresql')
+        response = sampling.rewrite_for_preview(query)
+        self.assertEqual(response['status'], 'error')
+
+
+class ParsedQueryTestCase(BaseTestCase):
+    def test_parsed_once_across_stages(self):
+        stats = sql_query.start_stats()
+        query = sql_query.ParsedQuery('SELECT * FROM Album;', 'sqlite')
+        self.assertEqual(stats.count, 0)
+
+        sampling.rewrite_for_preview(query, 1, 10)
+        count_sql = utils.count_query(query)
+        self.assertEqual(stats.count, 1)
+        self.assertEqual(query.sql, 'SELECT * FROM (SELECT * FROM Album LIMIT 10) AS Album')
+        self.assertEqual(count_sql, 'SELECT COUNT(*) AS row_count FROM '
+                         '(SELECT * FROM (SELECT * FROM Album LIMIT 10) AS Album) AS terno_count')
+        self.assertEqual(stats.count, 1)
+
+    def test_text_is_kept_until_modified(self):
+        query = sql_query.ParsedQuery('select  1', 'sqlite')
+        query.expression
+        self.assertEqual(query.sql, 'select  1')
+        query.transform(lambda e: e.limit(1, copy=False))
+        self.assertEqual(query.sql, 'SELECT 1 LIMIT 1')
+
+    def test_request_stats_header(self):
+        user = super().create_user()
+        ds = super().create_datasource()
+        utils.get_translation_cache().clear()
+        self.client.force_login(user)
+        response = self.client.post(
+            '/execute-sql', content_type='application/json',
+            data={'sql': 'SELECT * FROM Album', 'datasourceId': ds.id, 'preview': True})
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertIn('desc="2 parses"', response['Server-Timing'])
+
+
+class FingerprintTestCase(BaseTestCase):
+    def test_literals_and_formatting_ignored(self):
+        first = fingerprint.fingerprint(
+            "SELECT Name FROM Artist WHERE ArtistId = 1 AND Name = 'AC/DC'", 'sqlite')
+        second = fingerprint.fingerprint(
+            "select name\n  from artist where artistid = 42 and name = 'Accept';", 'sqlite')
+        self.assertEqual(first, second)
+
+    def test_in_lists_collapsed(self):
+        first = fingerprint.fingerprint('SELECT * FROM Album WHERE AlbumId IN (1, 2)')
+        second = fingerprint.fingerprint('SELECT * FROM Album WHERE AlbumId IN (3, 4, 5)')
+        self.assertEqual(first, second)
+
+    def test_structure_distinguished(self):
+        first = fingerprint.fingerprint('SELECT * FROM Album WHERE AlbumId = 1')
+        second = fingerprint.fingerprint('SELECT * FROM Album WHERE ArtistId = 1')
+        self.assertNotEqual(first, second)
+
+    def test_unparsable_sql(self):
+        first = fingerprint.fingerprint('SELECT * FROM (')
+        second = fingerprint.fingerprint('select *  from (')
+        self.assertEqual(first, second)
+
+    def test_parsed_query_reused(self):
+        stats = sql_query.start_stats()
+        query = sql_query.ParsedQuery('SELECT * FROM Album', 'sqlite')
+        sampling.rewrite_for_preview(query, 1, 10)
+        fingerprint.fingerprint(query)
+        self.assertEqual(stats.count, 1)
+        self.assertEqual(query.sql, 'SELECT * FROM (SELECT * FROM Album LIMIT 10) AS Album')
+
+    def test_fingerprint_stats(self):
+        user = super().create_user()
+        ds = super().create_datasource()
+        utils.get_translation_cache().clear()
+        self.client.force_login(user)
+        for album_id in [1, 2, 3]:
+            response = self.client.post(
+                '/execute-sql', content_type='application/json',
+                data={'sql': f'SELECT * FROM Album WHERE AlbumId = {album_id}',
+                      'datasourceId': ds.id})
+            self.assertEqual(response.json()['status'], 'success')
+        models.QueryHistory.objects.create(
+            user=user, data_source=ds, data_type='generated_sql',
+            data='SELECT * FROM Artist')
+
+        stats = list(fingerprint.fingerprint_stats(data_source=ds))
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['count'], 3)
+        self.assertEqual(stats[0]['total_rows'], 3)
+        self.assertIsNotNone(stats[0]['avg_execution_time'])
+
+        # Every endpoint fingerprints the native SQL with the datasource dialect.
+        executed = models.QueryHistory.objects.filter(data_type='actual_executed_sql').first()
+        self.assertEqual(executed.fingerprint, fingerprint.fingerprint(executed.data, 'sqlite'))
+
+        generated = models.QueryHistory.objects.get(data_type='generated_sql')
+        self.assertEqual(generated.fingerprint,
+                         fingerprint.fingerprint('SELECT * FROM Artist', 'sqlite'))
+
+
+class SQLBatchTestCase(BaseTestCase):
+    def setUp(self):
+        self.user = super().create_user()
+        self.ds = super().create_datasource()
+        utils.get_translation_cache().clear()
+        self.client.force_login(self.user)
+
+    def test_execute_batch(self):
+        statements = [
+            'SELECT * FROM Album WHERE AlbumId = 1',
+            'SELECT * FROM NoSuchTable',
+            'SELECT Name FROM Artist LIMIT 3',
+        ]
+        with patch('terno.utils.prepare_mdb', wraps=utils.prepare_mdb) as prepare_mdb:
+            response = self.client.post(
+                '/execute-sql-batch', content_type='application/json',
+                data={'statements': statements, 'datasourceId': self.ds.id})
+        self.assertEqual(prepare_mdb.call_count, 1)
+
+        response = response.json()
+        self.assertEqual(response['status'], 'success')
+        results = response['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['status'], 'success')
+        self.assertEqual(results[0]['table_data']['row_count'], 1)
+        self.assertEqual(results[1]['status'], 'error')
+        self.assertEqual(results[2]['status'], 'success')
+        self.assertEqual(results[2]['table_data']['columns'], ['Name'])
+        self.assertEqual(models.QueryHistory.objects.filter(
+            data_type='actual_executed_sql', row_count__isnull=False).count(), 2)
+
+    def test_statement_limit(self):
+        with self.settings(BATCH_SQL_MAX_STATEMENTS=2):
+            response = self.client.post(
+                '/execute-sql-batch', content_type='application/json',
+                data={'statements': ['SELECT 1'] * 3, 'datasourceId': self.ds.id})
+        self.assertEqual(response.json()['status'], 'error')
+        self.assertEqual(sql_batch.check_statements([]), 'Provide a list of SQL statements.')
+
+    def test_statements_run_concurrently(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def execute_native_sql(*args, **kwargs):
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+            return {'status': 'success', 'table_data': {'row_count': 0}}
+
+        with patch('terno.utils.execute_native_sql', side_effect=execute_native_sql), \
+                self.settings(BATCH_SQL_MAX_WORKERS=3):
+            responses = sql_batch.run_statements(self.ds, ['SELECT 1'] * 6)
+        self.assertEqual(len(responses), 6)
+        self.assertEqual(max(peak), 3)
+
+
+class QuestionBatchTestCase(BaseTestCase):
+    def setUp(self):
+        resilience.reset()
+        self.addCleanup(resilience.reset)
+        self.user = super().create_user()
+        self.ds = super().create_datasource()
+        self.client.force_login(self.user)
+        self.llm = llms.ResilientLLM(FlakyFakeLLM(
+            'fake', api_key='test_key', response='SELECT * FROM Album'))
+        get_llms = patch('terno.question_batch.LLMFactory.get_llms',
+                         return_value={'default': self.llm})
+        get_llms.start()
+        self.addCleanup(get_llms.stop)
+
+    def answer(self, questions):
+        async def collect():
+            return [result async for result in
+                    question_batch.answer_questions(self.user, self.ds, questions)]
+        return async_to_sync(collect)()
+
+    async def test_answer_batch(self):
+        await self.async_client.aforce_login(self.user)
+        questions = ['Show me all albums', 'List the albums', 'Which albums are there']
+        with patch('terno.utils.generate_schema', wraps=utils.generate_schema) as generate_schema:
+            response = await self.async_client.post(
+                '/get-sql-batch/', content_type='application/json',
+                data={'questions': questions, 'datasourceId': self.ds.id})
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            self.assertTrue(response.is_async)
+            results = [json.loads(line) async for line in response]
+        self.assertEqual(generate_schema.call_count, 1)
+
+        self.assertEqual(sorted(result['index'] for result in results), [0, 1, 2])
+        for result in results:
+            self.assertEqual(result['question'], questions[result['index']])
+            self.assertEqual(result['status'], 'success')
+            self.assertEqual(result['generated_sql'], 'SELECT * FROM Album')
+        self.assertEqual(await models.QueryHistory.objects.filter(
+            data_type='user_prompt').acount(), 3)
+        self.assertEqual(await models.QueryHistory.objects.filter(
+            data_type='generated_sql').acount(), 3)
+
+    def test_question_limit(self):
+        with self.settings(BATCH_QUESTIONS_MAX=2):
+            response = self.client.post(
+                '/get-sql-batch/', content_type='application/json',
+                data={'questions': ['Show me all albums'] * 3, 'datasourceId': self.ds.id})
+        self.assertEqual(response.json()['status'], 'error')
+        self.assertEqual(question_batch.check_questions(['Show me all albums', ' ']),
+                         'Every question must be a non empty string.')
+
+    def test_bounded_concurrency(self):
+        running = []
+        peak = []
+
+        async def get_response_async(messages):
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.05)
+            running.pop()
+            return 'SELECT * FROM Album'
+
+        with patch.object(self.llm.llm, 'get_response_async', side_effect=get_response_async), \
+                self.settings(BATCH_QUESTIONS_MAX_CONCURRENCY=2):
+            results = self.answer([f'Show me album {i}' for i in range(6)])
+        self.assertEqual(len(results), 6)
+        self.assertEqual(max(peak), 2)
+
+    def test_failures_lower_the_limit(self):
+        limit = question_batch.AdaptiveLimit(8)
+        limit.decrease()
+        limit.decrease()
+        self.assertEqual(limit.limit, 2)
+        limit.increase()
+        self.assertEqual(limit.limit, 3)
+
+        self.llm.llm.errors = [ValueError('Bad request')]
+        results = self.answer(['Show me all albums'])
+        self.assertEqual(results[0]['status'], 'error')
+        self.assertEqual(results[0]['error'], 'Bad request')
+
+    def test_circuit_wait_leaves_the_slot(self):
+        self.llm.llm.errors = [ValueError('Bad request')]
+        with patch('terno.question_batch.circuit_wait', return_value=0.2), \
+                self.settings(BATCH_QUESTIONS_MAX_CONCURRENCY=1):
+            results = self.answer(['Show me all albums', 'List the albums'])
+        # The second question is answered while the first waits.
+        self.assertEqual([(result['index'], result['status']) for result in results],
+                         [(1, 'success'), (0, 'success')])
+
+    def test_management_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as questions:
+            questions.write('Show me all albums\n\nList the albums\n')
+        self.addCleanup(os.remove, questions.name)
+        output = io.StringIO()
+        call_command('ask_questions', questions.name, datasource=self.ds.id,
+                     user=self.user.username, stdout=output)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(sorted(result['question'] for result in results),
+                         ['List the albums', 'Show me all albums'])
+
+
+class QuestionBatchStreamTestCase(TransactionTestCase):
+    """The batch answered under WSGI, its ORM work runs in another thread."""
+
+    def setUp(self):
+        resilience.reset()
+        self.addCleanup(resilience.reset)
+        self.user = User.objects.create_user(username='testuser', password='12345')
+        self.ds = models.DataSource.objects.create(
+            display_name='test_db', type='default',
+            connection_str='sqlite:///../chinook.db', enabled=True)
+        self.client.force_login(self.user)
+        llm = llms.ResilientLLM(FlakyFakeLLM('fake', api_key='test_key',
+                                             response='SELECT * FROM Album'))
+        get_llms = patch('terno.question_batch.LLMFactory.get_llms',
+                         return_value={'default': llm})
+        get_llms.start()
+        self.addCleanup(get_llms.stop)
+
+    def test_streamed_under_wsgi(self):
+        questions = ['Show me all albums', 'List the albums']
+        response = self.client.post(
+            '/get-sql-batch/', content_type='application/json',
+            data={'questions': questions, 'datasourceId': self.ds.id})
+        self.assertFalse(response.is_async)
+        lines = iter(response)
+        first = json.loads(next(lines))
+        self.assertEqual(first['status'], 'success')
+        results = [first] + [json.loads(line) for line in lines]
+        self.assertEqual(sorted(result['index'] for result in results), [0, 1])
+        self.assertEqual(models.QueryHistory.objects.filter(data_type='generated_sql').count(), 2)
+
+
+class SimilarQuestionTestCase(BaseTestCase):
+    def setUp(self):
+        similarity.clear()
+        self.addCleanup(similarity.clear)
+        refresh_interval = self.settings(SIMILAR_QUESTION_REFRESH_INTERVAL=0)
+        refresh_interval.enable()
+        self.addCleanup(refresh_interval.disable)
+        self.user = super().create_user()
+        self.ds = super().create_datasource()
+        self.client.force_login(self.user)
+        self.llm = llms.OpenAILLM(api_key='test_key', temperature=0.5)
+
+    def ask(self, question, **data):
+        response = self.client.post(
+            '/get-sql/', content_type='application/json',
+            data={'prompt': question, 'datasourceId': self.ds.id, **data})
+        return response.json()
+
+    def execute(self, sql):
+        response = self.client.post(
+            '/execute-sql', content_type='application/json',
+            data={'sql': sql, 'datasourceId': self.ds.id})
+        return response.json()
+
+    def test_search(self):
+        index = similarity.SimilarityIndex(self.ds.id)
+        index.add(1, 'How many albums are there?', 'SELECT COUNT(*) FROM Album')
+        index.add(2, 'List all artists', 'SELECT * FROM Artist')
+        results = index.search('how many albums are there', limit=2)
+        self.assertEqual(results[0]['history_id'], 1)
+        self.assertGreater(results[0]['similarity'], 0.9)
+        self.assertLess(results[1]['similarity'], 0.5)
+
+    def test_oldest_questions_dropped(self):
+        index = similarity.SimilarityIndex(self.ds.id)
+        with self.settings(SIMILAR_QUESTION_INDEX_MAX_SIZE=2):
+            index.add(1, 'How many albums are there?', 'SELECT COUNT(*) FROM Album')
+            index.add(2, 'List all artists', 'SELECT * FROM Artist')
+            index.add(3, 'How many tracks are there?', 'SELECT COUNT(*) FROM Track')
+        self.assertEqual(len(index), 2)
+        results = index.search('how many albums are there', limit=3)
+        self.assertEqual(sorted(result['history_id'] for result in results), [2, 3])
+        self.assertNotIn('bum', index.document_frequency)
+
+    @patch('terno.utils.LLMFactory.create_llm')
+    def test_reuse_executed_sql(self, mock_create_llm):
+        mock_create_llm.return_value = self.llm
+        with patch.object(self.llm, 'get_response_async', return_value='SELECT * FROM Album') as get_response, \
+                self.settings(SIMILAR_QUESTION_REUSE_THRESHOLD=0.5,
+                              SIMILAR_QUESTION_SUGGEST_THRESHOLD=0.3):
+            self.assertEqual(self.ask('Show me all albums')['generated_sql'], 'SELECT * FROM Album')
+            # Not offered before the SQL ran successfully.
+            self.assertEqual(self.ask('Show me all the albums')['similar_questions'], [])
+            self.assertEqual(self.execute('SELECT * FROM Album')['status'], 'success')
+
+            response = self.ask('show me all albums please')
+            self.assertEqual(response['generated_sql'], 'SELECT * FROM Album')
+            self.assertTrue(response['similar_question']['reusable'])
+            self.assertEqual(get_response.call_count, 2)
+
+            response = self.ask('show me all albums please', reuse_similar=False)
+            self.assertNotIn('similar_question', response)
+            self.assertEqual(len(response['similar_questions']), 1)
+            self.assertEqual(get_response.call_count, 3)
+
+    @patch('terno.utils.LLMFactory.create_llm')
+    def test_index_updated_incrementally(self, mock_create_llm):
+        mock_create_llm.return_value = self.llm
+        index = similarity.get_index(self.ds.id)
+        for question, sql in [('Show me all albums', 'SELECT * FROM Album'),
+                              ('List every artist', 'SELECT * FROM Artist')]:
+            with patch.object(self.llm, 'get_response_async', return_value=sql):
+                self.ask(question)
+            self.execute(sql)
+            self.assertIs(similarity.get_index(self.ds.id), index)
+        self.assertEqual(len(index), 2)
+
+    def add_executed_question(self, question, sql):
+        for data_type, data in [('user_prompt', question), ('generated_sql', sql)]:
+            models.QueryHistory.objects.create(user=self.user, data_source=self.ds,
+                                               data_type=data_type, data=data)
+        models.QueryHistory.objects.create(user=self.user, data_source=self.ds,
+                                           data_type='user_executed_sql', data=sql,
+                                           succeeded=True)
+
+    def test_refresh_in_batches(self):
+        for table in ['Album', 'Artist', 'Genre']:
+            self.add_executed_question(f'Show me all {table}s', f'SELECT * FROM {table}')
+        with self.settings(SIMILAR_QUESTION_REFRESH_BATCH_SIZE=2,
+                           SIMILAR_QUESTION_REFRESH_INTERVAL=60):
+            index = similarity.get_index(self.ds.id)
+            self.assertEqual(len(index), 3)
+            # Not read again until the refresh interval is over.
+            self.add_executed_question('Show me all tracks', 'SELECT * FROM Track')
+            self.assertEqual(len(similarity.get_index(self.ds.id)), 3)
+        self.assertEqual(len(similarity.get_index(self.ds.id)), 4)
+
+    def test_hides_sql_the_roles_can_not_run(self):
+        self.add_executed_question('How many invoices are there?', 'SELECT COUNT(*) FROM Invoice')
+        self.add_executed_question('How many albums are there?', 'SELECT COUNT(*) FROM Album')
+        private_tables = models.PrivateTableSelector.objects.create(data_source=self.ds)
+        private_tables.tables.add(models.Table.objects.get(data_source=self.ds, name='Invoice'))
+
+        with self.settings(SIMILAR_QUESTION_SUGGEST_THRESHOLD=0):
+            similar_questions = similarity.find_similar_questions(
+                self.ds, self.user.groups.all(), 'How many invoices are there?')
+        self.assertEqual([similar['sql'] for similar in similar_questions],
+                         ['SELECT COUNT(*) FROM Album'])
+
+
 class SubstituteTestCase(BaseTestCase):
     def setUp(self) -> None:
         self.mdb = super().create_mdb()
@@ -8,12 +8,21 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('accounts/login/', views.login_page, name='login_page'),
     path('console/', views.console, name='console'),
+    path('console-stream/', views.console_stream, name='console_stream'),
     path('settings', views.settings, name='settings'),
     path('get-datasources', views.get_datasources, name='get_datasources'),
     path('get-sql/', views.get_sql, name='get_sql'),
+    path('get-sql-stream/', views.get_sql_stream, name='get_sql_stream'),
+    path('get-sql-batch/', views.get_sql_batch, name='get_sql_batch'),
     path('execute-sql', views.execute_sql, name='execute_sql'),
+    path('execute-sql-batch', views.execute_sql_batch, name='execute_sql_batch'),
+    path('sql-row-count/<str:count_token>', views.sql_row_count, name='sql_row_count'),
+    path('submit-sql-job', views.submit_sql_job, name='submit_sql_job'),
+    path('sql-job-status/<str:job_id>', views.sql_job_status, name='sql_job_status'),
+    path('sql-job-result/<str:job_id>', views.sql_job_result, name='sql_job_result'),
     path('export-sql-result', views.export_sql_result, name='export_sql_result'),
     path('get-tables/<int:datasource_id>', views.get_tables, name='get_tables'),
+    path('metrics', views.get_metrics, name='get_metrics'),
     path('get-user-details', views.get_user_details, name='get_user_details'),
     path('api/', views.create_org, name='create_org'),  # only for demo remove before commit
 ]
@@ -5,15 +5,33 @@ from sqlshield.shield import Session
 from sqlshield.models import MDatabase
 import sqlalchemy
 from terno.llm.base import LLMFactory
+from terno.llm import routing
+from terno.llm import response_cache
+from terno.llm import usage as llm_usage
 import math
 from django.template import Template, Context, Engine
 import logging
 from terno.pipeline.pipeline import Pipeline
+from terno.pipeline.candidate_pipeline import CandidatePipeline
+import terno.pipeline.candidate_pipeline as candidate_pipeline
 from terno.pipeline.step import Step
 from terno.prompt import query_generation, table_select
 import csv
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
+import terno.admission as admission
+import terno.cost_estimation as cost_estimation
+import terno.singleflight as singleflight
+import terno.replicas as replicas
+import terno.metrics as metrics
+import terno.sql_query as sql_query
+import terno.lru as lru
+import hashlib
+import json
+import time
+from django.conf import settings
+from django.db.models import F
+from asgiref.sync import sync_to_async
 
 logger = logging.getLogger(__name__)
 
@@ -183,35 +201,201 @@ def get_admin_config_object(datasource, roles):
     return all_group_tables, group_columns
 
 
+def generate_schema(datasource, roles):
+    return prepare_mdb(datasource, roles).generate_schema()
+
+
 def console_llm_response(user, messages):
+    usage = []
     try:
         llm = LLMFactory.create_llm()
-        response = llm.get_response(messages)
+        with llm_usage.collect() as usage:
+            response, cache_hit = response_cache.get_response(llm, messages)
         generated_sql = response
     except Exception as e:
         logger.exception(e)
+        llm_usage.save(usage, user=user)
         return {'status': 'error', 'error': str(e)}
 
-    return {'status': 'success', 'generated_sql': generated_sql}
+    return {'status': 'success', 'generated_sql': generated_sql,
+            'cache_hit': cache_hit, 'usage': usage}
+
+
+def save_failed_usage(user, datasource, pipeline):
+    """Saves the usage of the llm calls of a pipeline that failed."""
+    if pipeline is not None:
+        llm_usage.save(pipeline.usage, user=user, data_source=datasource,
+                       prompt_log=pipeline.prompt_log)
 
 
-def llm_response(user, user_query, db_schema, datasource):
+def llm_response(user, user_query, db_schema, datasource, role=None):
+    pipeline = None
     try:
-        llm = LLMFactory.create_llm()
-        pipeline = create_pipeline(llm, 'one_step_pipeline', user, db_schema, datasource, user_query)
+        llm = LLMFactory.create_llm(user_query, db_schema, role)
+        pipeline = create_pipeline(llm, pipeline_name(), user, db_schema, datasource, user_query)
         response = get_response_from_pipeline(pipeline)
-        generated_sql = response[0][0]
+        generated_sql = response.output('generated_sql')
+    except Exception as e:
+        logger.exception(e)
+        save_failed_usage(user, datasource, pipeline)
+        return {'status': 'error', 'error': str(e)}
+
+    return {'status': 'success', 'generated_sql': generated_sql,
+            'cache_hit': pipeline.cache_hit, 'role': llm.role,
+            'usage': pipeline.usage, 'prompt_log': pipeline.prompt_log}
+
+
+async def console_llm_response_async(user, messages):
+    usage = []
+    try:
+        llm = await sync_to_async(LLMFactory.create_llm)()
+        with llm_usage.collect() as usage:
+            response, cache_hit = await response_cache.get_response_async(llm, messages)
+        generated_sql = response
+    except Exception as e:
+        logger.exception(e)
+        await sync_to_async(llm_usage.save)(usage, user=user)
+        return {'status': 'error', 'error': str(e)}
+
+    return {'status': 'success', 'generated_sql': generated_sql,
+            'cache_hit': cache_hit, 'usage': usage}
+
+
+async def llm_response_async(user, user_query, db_schema, datasource, role=None,
+                             llm=None):
+    """
+    llm_response for async views. The llm is awaited without holding a
+    thread, only the ORM work runs in sync_to_async. Callers that already
+    picked the llm, like batches, pass it instead of the role.
+    """
+    pipeline = None
+    try:
+        if llm is None:
+            llm = await sync_to_async(LLMFactory.create_llm)(user_query, db_schema, role)
+        pipeline = await sync_to_async(create_pipeline)(
+            llm, pipeline_name(), user, db_schema, datasource, user_query)
+        response = await pipeline.run_async()
+        generated_sql = response.output('generated_sql')
+    except Exception as e:
+        logger.exception(e)
+        await sync_to_async(save_failed_usage)(user, datasource, pipeline)
+        return {'status': 'error', 'error': str(e)}
+
+    return {'status': 'success', 'generated_sql': generated_sql,
+            'cache_hit': pipeline.cache_hit, 'role': llm.role,
+            'usage': pipeline.usage, 'prompt_log': pipeline.prompt_log}
+
+
+def should_escalate(datasource, roles, response):
+    """
+    Whether the SQL generated by a weaker llm does not validate for the
+    user's roles while a strong llm is configured.
+    """
+    if response['status'] != 'success' or response.get('role', routing.STRONG) == routing.STRONG:
+        return False
+    validation = translate_sql(datasource, roles, response['generated_sql'])
+    if validation['status'] == 'success':
+        return False
+    try:
+        llms = LLMFactory.get_llms()
+    except ValueError:
+        return False
+    return routing.STRONG in llms
+
+
+def escalate_llm_response(user, user_query, db_schema, datasource, roles, response):
+    """
+    Asks the strong llm again when the SQL generated by a weaker one does
+    not validate for the user's roles. Returns the response to keep.
+    """
+    if not should_escalate(datasource, roles, response):
+        return response
+    metrics.incr('llm_escalations_total', role=response['role'])
+    strong_response = llm_response(
+        user, user_query, db_schema, datasource, role=routing.STRONG)
+    if strong_response['status'] != 'success':
+        return response
+    strong_response['usage'] = response['usage'] + strong_response['usage']
+    return strong_response
+
+
+async def escalate_llm_response_async(user, user_query, db_schema, datasource,
+                                     roles, response):
+    """escalate_llm_response for async views."""
+    if not await sync_to_async(should_escalate)(datasource, roles, response):
+        return response
+    metrics.incr('llm_escalations_total', role=response['role'])
+    strong_response = await llm_response_async(
+        user, user_query, db_schema, datasource, role=routing.STRONG)
+    if strong_response['status'] != 'success':
+        return response
+    strong_response['usage'] = response['usage'] + strong_response['usage']
+    return strong_response
+
+
+def log_generated_sql(user, datasource, llm_response):
+    """Logs the generated SQL with the usage of the llm calls made for it."""
+    history = models.QueryHistory.objects.create(
+        user=user, data_source=datasource,
+        data_type='generated_sql', data=llm_response['generated_sql'],
+        llm_cache_hit=llm_response['cache_hit'])
+    llm_usage.save(llm_response.get('usage'), prompt_log=llm_response.get('prompt_log'),
+                   query_history=history)
+    return history
+
+
+def _stream_step(step, user, datasource=None):
+    chunks = []
+    try:
+        for chunk in step.stream():
+            chunks.append(chunk)
+            yield chunk
+    except Exception:
+        llm_usage.save(step.usage, user=user, data_source=datasource,
+                       prompt_log=step.prompt_log)
+        raise
+    return {'status': 'success',
+            'generated_sql': step.llm.extract_sql(''.join(chunks)),
+            'cache_hit': step.cache_hit, 'role': getattr(step.llm, 'role', None),
+            'usage': step.usage, 'prompt_log': step.prompt_log}
+
+
+def stream_llm_response(user, user_query, db_schema, datasource, roles=None):
+    """
+    Generator version of llm_response, yielding the response in chunks
+    as they arrive. Returns what llm_response would once the stream ends.
+    When the streamed SQL does not validate, the strong llm is asked
+    again without streaming and its SQL is returned instead.
+    """
+    try:
+        if roles is None:
+            roles = user.groups.all()
+        llm = LLMFactory.create_llm(user_query, db_schema)
+        pipeline = create_pipeline(llm, 'one_step_pipeline', user, db_schema, datasource, user_query)
+        response = yield from _stream_step(pipeline.steps[-1], user, datasource)
+        return escalate_llm_response(user, user_query, db_schema, datasource, roles, response)
+    except Exception as e:
+        logger.exception(e)
+        return {'status': 'error', 'error': str(e)}
+
+
+def stream_console_llm_response(user, messages):
+    """Generator version of console_llm_response."""
+    try:
+        llm = LLMFactory.create_llm()
+        return (yield from _stream_step(Step(llm, messages), user))
     except Exception as e:
         logger.exception(e)
         return {'status': 'error', 'error': str(e)}
 
-    return {'status': 'success', 'generated_sql': generated_sql}
 
+def sse_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
 
-def create_pipeline(llm, name, user, db_schema, datasource, user_query):
+
+def create_pipeline(llm, name, user, db_schema, datasource, user_query, roles=None):
     steps = []
-    if name == 'one_step_pipeline':
-        pipeline = Pipeline()
+    if name in ('one_step_pipeline', 'multi_candidate_pipeline'):
         system_message = query_generation.query_generation_system_prompt\
             .format(dialect_name=datasource.dialect_name,
                     dialect_version=datasource.dialect_version)
@@ -226,12 +410,72 @@ def create_pipeline(llm, name, user, db_schema, datasource, user_query):
     else:
         raise Exception("Invalid Pipeline Name")
 
+    if name == 'multi_candidate_pipeline':
+        if roles is None:
+            roles = user.groups.all()
+        pipeline = CandidatePipeline(validate=lambda sql: validate_generated_sql(
+            datasource, roles, sql, settings.LLM_CANDIDATE_EXPLAIN),
+            candidate_tokens=candidate_tokens(llm, messages),
+            save_usage=lambda step: llm_usage.save(
+                step.usage, user=user, data_source=datasource, prompt_log=step.prompt_log))
+        # The other candidates are sampled so they differ from the first.
+        sampling_llm = llm.with_temperature(settings.LLM_CANDIDATE_TEMPERATURE)
+        for number in range(1, candidate_count(llm, messages)):
+            steps.append(Step(sampling_llm, messages, name=f'generate_sql_{number}'))
+    else:
+        pipeline = Pipeline()
+
+    prompt_logs = {}
     for step in steps:
         pipeline.add_step(step)
-        models.PromptLog.objects.create(user=user, llm_prompt=step.messages)
+        # Candidates of the same prompt share its log.
+        if id(step.messages) not in prompt_logs:
+            prompt_logs[id(step.messages)] = models.PromptLog.objects.create(
+                user=user, llm_prompt=step.messages)
+        step.prompt_log = prompt_logs[id(step.messages)]
     return pipeline
 
 
+def pipeline_name():
+    if settings.LLM_CANDIDATES > 1:
+        return 'multi_candidate_pipeline'
+    return 'one_step_pipeline'
+
+
+def candidate_tokens(llm, messages):
+    """Estimated tokens of a candidate, at 4 characters a token."""
+    prompt_tokens = len(json.dumps(messages, default=str)) // 4
+    return prompt_tokens + (getattr(llm, 'max_tokens', None) or 0)
+
+
+def candidate_count(llm, messages):
+    """
+    Number of candidates to generate: LLM_CANDIDATES, or fewer when their
+    estimated tokens would not fit in LLM_CANDIDATE_TOKEN_BUDGET. The
+    losing candidates of earlier requests that are still running count
+    against the budget.
+    """
+    budget = settings.LLM_CANDIDATE_TOKEN_BUDGET - candidate_pipeline.abandoned_tokens()
+    affordable = budget // max(candidate_tokens(llm, messages), 1)
+    return max(1, min(settings.LLM_CANDIDATES, affordable))
+
+
+def validate_generated_sql(datasource, roles, sql, explain=False):
+    """
+    Returns why the generated SQL can not be run with the roles, or None
+    when it can: it must parse and translate to the native SQL of the
+    datasource and, with explain, pass the query cost check.
+    """
+    translated = translate_sql(datasource, roles, sql)
+    if translated['status'] == 'error':
+        return translated['error']
+    if explain:
+        cost_response = cost_estimation.check_query_cost(datasource, translated['native_sql'])
+        if cost_response['status'] == 'error':
+            return cost_response['error']
+    return None
+
+
 def get_response_from_pipeline(pipeline):
     return pipeline.run()
 
@@ -277,10 +521,61 @@ def generate_mdb(datasource):
     return mdb
 
 
+translation_cache = None
+
+
+def get_translation_cache():
+    global translation_cache
+    if translation_cache is None:
+        translation_cache = lru.LRUCache('translation_cache',
+                                         settings.TRANSLATION_CACHE_SIZE)
+    return translation_cache
+
+
+def bump_schema_version(datasource_ids=None):
+    datasources = models.DataSource.objects.all()
+    if datasource_ids is not None:
+        datasources = datasources.filter(id__in=list(datasource_ids))
+    datasources.update(schema_version=F('schema_version') + 1)
+
+
+def translate_sql(datasource, roles, user_sql):
+    """
+    Returns generate_native_sql's response for the user's query, cached
+    per schema version of the datasource and set of roles so that paging
+    through a result does not translate the same query again.
+    """
+    return translate_sql_batch(datasource, roles, [user_sql])[0]
+
+
+def translate_sql_batch(datasource, roles, statements):
+    """
+    translate_sql for several statements. The MDatabase is prepared at
+    most once, and only when a statement is not in the cache yet.
+    """
+    role_ids = tuple(sorted(role.id for role in roles))
+    cache = get_translation_cache()
+    mDb = None
+    responses = []
+    for user_sql in statements:
+        sql_hash = hashlib.sha256(user_sql.encode('utf-8')).hexdigest()
+        key = (datasource.id, datasource.schema_version, role_ids, sql_hash)
+        response = cache.get(key)
+        if response is None:
+            if mDb is None:
+                mDb = prepare_mdb(datasource, roles)
+            response = generate_native_sql(mDb, user_sql)
+            cache.set(key, response)
+        responses.append(dict(response))
+    return responses
+
+
 def generate_native_sql(mDb, user_sql):
     sess = Session(mDb, '')
     try:
+        start_time = time.perf_counter()
         native_sql = sess.generateNativeSQL(user_sql)
+        sql_query.record_parse(time.perf_counter() - start_time)
         return {
             'status': 'success',
             'native_sql': native_sql
@@ -292,54 +587,113 @@ def generate_native_sql(mDb, user_sql):
         }
 
 
-def execute_native_sql(datasource, native_sql, page, per_page):
-    engine = create_db_engine(datasource.type, datasource.connection_str,
-                              credentials_info=datasource.connection_json)
-    with engine.connect() as con:
-        try:
-            execute_result = con.execute(sqlalchemy.text(native_sql))
-            table_data = prepare_table_data_from_execute(execute_result, page, per_page)
-            return {
-                'status': 'success',
-                'table_data': table_data
-            }
-        except Exception as e:
-            return {
-                'status': 'error',
-                'error': str(e)
-            }
-
-
-def export_native_sql_result(datasource, native_sql):
-    engine = sqlalchemy.create_engine(datasource.connection_str)
+def execute_native_sql(datasource, native_sql, page, per_page, user=None,
+                       defer_count=False):
+    """
+    Identical queries running at the same time on a datasource share
+    a single execution. With defer_count only the rows up to the
+    requested page are fetched and row_count is left as None when the
+    result goes on beyond that page.
+    """
+    key = singleflight.make_key(datasource.id, native_sql, page, per_page,
+                                defer_count)
+    return singleflight.do(key, lambda: _execute_native_sql(
+        datasource, native_sql, page, per_page, user, defer_count))
+
+
+def _execute_native_sql(datasource, native_sql, page, per_page, user, defer_count):
+    try:
+        with admission.admit(datasource, getattr(user, 'id', None)):
+            try:
+                with replicas.connect(datasource) as con:
+                    if defer_count:
+                        con = con.execution_options(stream_results=True)
+                        execute_result = con.execute(sqlalchemy.text(native_sql))
+                        table_data = prepare_first_page_from_execute(execute_result, page, per_page)
+                    else:
+                        execute_result = con.execute(sqlalchemy.text(native_sql))
+                        table_data = prepare_table_data_from_execute(execute_result, page, per_page)
+                return {
+                    'status': 'success',
+                    'table_data': table_data
+                }
+            except Exception as e:
+                return {
+                    'status': 'error',
+                    'error': str(e)
+                }
+    except admission.DatasourceBusy as e:
+        return {
+            'status': 'busy',
+            'error': str(e)
+        }
+
+
+def export_native_sql_result(datasource, native_sql, user=None):
     utc_time = timezone.now().strftime('%Y-%m-%d_%H-%M-%S')
     file_name = f'terno_{datasource.display_name}_{utc_time}.csv'
-    with engine.connect() as con:
-        execute_result = con.execute(sqlalchemy.text(native_sql))
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = f'attachment; filename={file_name}'
-        writer = csv.writer(response)
-        writer.writerow(execute_result.keys())  # Write the headers (column names)
-        writer.writerows(execute_result)  # Write all rows of data
-        return response
+    try:
+        with admission.admit(datasource, getattr(user, 'id', None)):
+            with replicas.connect(datasource, purpose='export') as con:
+                execute_result = con.execute(sqlalchemy.text(native_sql))
+                response = HttpResponse(content_type='text/csv')
+                response['Content-Disposition'] = f'attachment; filename={file_name}'
+                writer = csv.writer(response)
+                writer.writerow(execute_result.keys())  # Write the headers (column names)
+                writer.writerows(execute_result)  # Write all rows of data
+                return response
+    except admission.DatasourceBusy as e:
+        return JsonResponse({
+            'status': 'busy',
+            'error': str(e)
+        }, status=429)
 
 
-def prepare_table_data_from_execute(execute_result, page, per_page):
-    table_data = {}
-    table_data['columns'] = list(execute_result.keys())
+def get_total_pages(total_count, per_page):
+    if total_count is None:
+        return None
+    return math.ceil(total_count // per_page)
+
+
+def count_query(query):
+    count_expression = sqlglot.select(
+        sqlglot.exp.Count(this=sqlglot.exp.Star()).as_('row_count')
+    ).from_(query.expression.subquery('terno_count', copy=True))
+    return count_expression.sql(dialect=query.dialect)
 
+
+def prepare_table_data_from_execute(execute_result, page, per_page):
+    columns = list(execute_result.keys())
     fetch_result = execute_result.fetchall()
 
     total_count = execute_result.rowcount
     if total_count <= 0:
         total_count = len(fetch_result)
-    total_pages = math.ceil(total_count // per_page)
+    return prepare_table_data(columns, fetch_result, total_count, page, per_page)
+
+
+def prepare_first_page_from_execute(execute_result, page, per_page):
+    columns = list(execute_result.keys())
+    # One extra row tells whether the result goes on after this page.
+    fetch_result = execute_result.fetchmany(page * per_page + 1)
+
+    total_count = None
+    if len(fetch_result) <= page * per_page:
+        total_count = len(fetch_result)
+    return prepare_table_data(columns, fetch_result, total_count, page, per_page)
+
+
+def prepare_table_data(columns, rows, total_count, page, per_page):
+    table_data = {}
+    table_data['columns'] = columns
+
+    total_pages = get_total_pages(total_count, per_page)
     table_data['total_pages'] = total_pages
     table_data['row_count'] = total_count
     table_data['page'] = page
 
     offset = (page - 1) * per_page
-    paginated_results = fetch_result[offset:offset+per_page]
+    paginated_results = rows[offset:offset+per_page]
     table_data['data'] = []
 
     for row in paginated_results:
@@ -1,15 +1,26 @@
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 import terno.models as models
 import terno.utils as utils
+import terno.query_jobs as query_jobs
+import terno.cost_estimation as cost_estimation
+import terno.sampling as sampling
+import terno.sql_query as sql_query
+import terno.sql_batch as sql_batch
+import terno.question_batch as question_batch
+import terno.similarity as similarity
 import json
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login
 from django.contrib.admin.views.decorators import staff_member_required
+import terno.metrics as metrics
 from django.contrib import messages
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.core.exceptions import ObjectDoesNotExist
+from django.core.handlers.asgi import ASGIRequest
 import logging
+import time
+from asgiref.sync import sync_to_async
 
 logger = logging.getLogger(__name__)
 
@@ -38,57 +49,64 @@ def login_page(request):
     return render(request, 'frontend/index.html')
 
 
+def prepare_console_messages(user, data, datasource):
+    system_prompt = data.get('systemPrompt')
+    assistant_message = data.get('assistantMessage')
+    user_prompt = data.get('userPrompt')
+    roles = user.groups.all()
+
+    models.QueryHistory.objects.create(
+        user=user, data_source=datasource,
+        data_type='user_prompt', data=user_prompt)
+
+    mDB = utils.prepare_mdb(datasource, roles)
+    schema_generated = mDB.generate_schema()
+
+    context_dict = {
+        'db_schema': schema_generated,
+        'dialect_name': datasource.dialect_name,
+        'dialect_version': datasource.dialect_version,
+        'mdb': mDB,
+    }
+    system_prompt = utils.substitute_variables(template_str=system_prompt,
+                                               context_dict=context_dict)
+    assistant_message = utils.substitute_variables(template_str=assistant_message,
+                                                   context_dict=context_dict)
+    user_prompt = utils.substitute_variables(template_str=user_prompt,
+                                             context_dict=context_dict)
+
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "assistant", "content": assistant_message},
+        {"role": "user", "content": user_prompt},
+    ]
+
+    models.QueryHistory.objects.create(
+        user=user, data_source=datasource,
+        data_type='user_prompt', data=user_prompt)
+    return messages
+
+
 @staff_member_required
-def console(request):
+async def console(request):
     if request.method == 'POST':
         data = json.loads(request.body)
         datasource_id = data.get('datasourceId')
-        system_prompt = data.get('systemPrompt')
-        assistant_message = data.get('assistantMessage')
-        user_prompt = data.get('userPrompt')
+        user = await request.auser()
 
         try:
-            datasource = models.DataSource.objects.get(id=datasource_id,
-                                                       enabled=True)
+            datasource = await models.DataSource.objects.aget(id=datasource_id,
+                                                              enabled=True)
         except ObjectDoesNotExist:
             return JsonResponse({
                 'status': 'error',
                 'error': 'No Datasource found.'
             })
-        roles = request.user.groups.all()
 
-        models.QueryHistory.objects.create(
-            user=request.user, data_source=datasource,
-            data_type='user_prompt', data=user_prompt)
+        messages = await sync_to_async(prepare_console_messages)(user, data, datasource)
 
-        mDB = utils.prepare_mdb(datasource, roles)
-        schema_generated = mDB.generate_schema()
-
-        context_dict = {
-            'db_schema': schema_generated,
-            'dialect_name': datasource.dialect_name,
-            'dialect_version': datasource.dialect_version,
-            'mdb': mDB,
-        }
-        system_prompt = utils.substitute_variables(template_str=system_prompt,
-                                                   context_dict=context_dict)
-        assistant_message = utils.substitute_variables(template_str=assistant_message,
-                                                       context_dict=context_dict)
-        user_prompt = utils.substitute_variables(template_str=user_prompt,
-                                                 context_dict=context_dict)
-
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "assistant", "content": assistant_message},
-            {"role": "user", "content": user_prompt},
-        ]
-
-        models.QueryHistory.objects.create(
-            user=request.user, data_source=datasource,
-            data_type='user_prompt', data=user_prompt)
-
-        llm_response = utils.console_llm_response(
-            request.user, messages)
+        llm_response = await utils.console_llm_response_async(
+            user, messages)
 
         if llm_response['status'] == 'error':
             return JsonResponse({
@@ -96,9 +114,7 @@ def console(request):
                 'error': llm_response['error'],
             })
 
-        models.QueryHistory.objects.create(
-            user=request.user, data_source=datasource,
-            data_type='generated_sql', data=llm_response['generated_sql'])
+        await sync_to_async(utils.log_generated_sql)(user, datasource, llm_response)
 
         return JsonResponse({
             'status': llm_response['status'],
@@ -108,6 +124,65 @@ def console(request):
     return render(request, 'frontend/index.html')
 
 
+@staff_member_required
+def console_stream(request):
+    data = json.loads(request.body)
+    datasource_id = data.get('datasourceId')
+
+    try:
+        datasource = models.DataSource.objects.get(id=datasource_id,
+                                                   enabled=True)
+    except ObjectDoesNotExist:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'No Datasource found.'
+        })
+
+    messages = prepare_console_messages(request.user, data, datasource)
+
+    stream = utils.stream_console_llm_response(request.user, messages)
+    return sse_response(stream_generated_sql(
+        request.user, datasource, stream,
+        {'generated_prompt': str(messages)}))
+
+
+def stream_generated_sql(user, datasource, stream, response_data=None):
+    """
+    Forwards the chunks of the llm response as `token` events. When the
+    stream ends the generated SQL is logged and sent in a `done` event.
+    """
+    while True:
+        try:
+            chunk = next(stream)
+        except StopIteration as stop:
+            llm_response = stop.value
+            break
+        yield utils.sse_event('token', {'token': chunk})
+
+    if llm_response['status'] == 'error':
+        yield utils.sse_event('error', {
+            'status': llm_response['status'],
+            'error': llm_response['error'],
+        })
+        return
+
+    utils.log_generated_sql(user, datasource, llm_response)
+
+    yield utils.sse_event('done', {
+        'status': llm_response['status'],
+        'generated_sql': llm_response['generated_sql'],
+        **(response_data or {}),
+    })
+
+
+def sse_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep proxies from buffering the stream.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 def settings(request):
     return render(request, 'frontend/index.html')
 
@@ -121,30 +196,63 @@ def get_datasources(request):
     })
 
 
+def find_similar_sql(user, datasource, roles, question, reuse_similar=True):
+    """
+    Returns the similar earlier questions and the one whose SQL is reused
+    instead of asking the llm, if any. Reused SQL is logged as generated.
+    """
+    try:
+        similar_questions = similarity.find_similar_questions(datasource, roles, question)
+    except Exception as e:
+        logger.exception(e)
+        return [], None
+
+    for similar in similar_questions:
+        if reuse_similar and similar['reusable']:
+            models.QueryHistory.objects.create(
+                user=user, data_source=datasource,
+                data_type='generated_sql', data=similar['sql'])
+            return similar_questions, similar
+    return similar_questions, None
+
+
 @login_required
-def get_sql(request):
+async def get_sql(request):
     data = json.loads(request.body)
     datasource_id = data.get('datasourceId')
     question = data.get('prompt')
+    reuse_similar = data.get('reuse_similar', True)
+    user = await request.auser()
 
     try:
-        datasource = models.DataSource.objects.get(id=datasource_id,
-                                                   enabled=True)
+        datasource = await models.DataSource.objects.aget(id=datasource_id,
+                                                          enabled=True)
     except ObjectDoesNotExist:
         return JsonResponse({
             'status': 'error',
             'error': 'No Datasource found.'
         })
-    roles = request.user.groups.all()
+    roles = user.groups.all()
 
-    models.QueryHistory.objects.create(
-        user=request.user, data_source=datasource,
+    await models.QueryHistory.objects.acreate(
+        user=user, data_source=datasource,
         data_type='user_prompt', data=question)
 
-    mDB = utils.prepare_mdb(datasource, roles)
-    schema_generated = mDB.generate_schema()
-    llm_response = utils.llm_response(
-        request.user, question, schema_generated, datasource)
+    similar_questions, reused = await sync_to_async(find_similar_sql)(
+        user, datasource, roles, question, reuse_similar)
+    if reused is not None:
+        return JsonResponse({
+            'status': 'success',
+            'generated_sql': reused['sql'],
+            'similar_question': reused,
+            'similar_questions': similar_questions,
+        })
+
+    schema_generated = await sync_to_async(utils.generate_schema)(datasource, roles)
+    llm_response = await utils.llm_response_async(
+        user, question, schema_generated, datasource)
+    llm_response = await utils.escalate_llm_response_async(
+        user, question, schema_generated, datasource, roles, llm_response)
 
     if llm_response['status'] == 'error':
         return JsonResponse({
@@ -152,13 +260,98 @@ def get_sql(request):
             'error': llm_response['error'],
         })
 
-    models.QueryHistory.objects.create(
-        user=request.user, data_source=datasource,
-        data_type='generated_sql', data=llm_response['generated_sql'])
+    await sync_to_async(utils.log_generated_sql)(user, datasource, llm_response)
 
     return JsonResponse({
         'status': llm_response['status'],
         'generated_sql': llm_response['generated_sql'],
+        'similar_questions': similar_questions,
+    })
+
+
+@login_required
+async def get_sql_batch(request):
+    data = json.loads(request.body)
+    datasource_id = data.get('datasourceId')
+    questions = data.get('questions')
+    user = await request.auser()
+
+    error = question_batch.check_questions(questions)
+    if error:
+        return JsonResponse({
+            'status': 'error',
+            'error': error
+        })
+
+    try:
+        datasource = await models.DataSource.objects.aget(id=datasource_id,
+                                                          enabled=True)
+    except ObjectDoesNotExist:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'No Datasource found.'
+        })
+
+    results = question_batch.ndjson(
+        question_batch.answer_questions(user, datasource, questions))
+    if not isinstance(request, ASGIRequest):
+        # WSGI servers, like runserver, would not stream an async iterator.
+        results = question_batch.iterate(results)
+    return StreamingHttpResponse(results, content_type='application/x-ndjson')
+
+
+@login_required
+def get_sql_stream(request):
+    data = json.loads(request.body)
+    datasource_id = data.get('datasourceId')
+    question = data.get('prompt')
+    reuse_similar = data.get('reuse_similar', True)
+
+    try:
+        datasource = models.DataSource.objects.get(id=datasource_id,
+                                                   enabled=True)
+    except ObjectDoesNotExist:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'No Datasource found.'
+        })
+    roles = request.user.groups.all()
+
+    models.QueryHistory.objects.create(
+        user=request.user, data_source=datasource,
+        data_type='user_prompt', data=question)
+
+    similar_questions, reused = find_similar_sql(
+        request.user, datasource, roles, question, reuse_similar)
+    if reused is not None:
+        return sse_response([utils.sse_event('done', {
+            'status': 'success',
+            'generated_sql': reused['sql'],
+            'similar_question': reused,
+            'similar_questions': similar_questions,
+        })])
+
+    mDB = utils.prepare_mdb(datasource, roles)
+    schema_generated = mDB.generate_schema()
+    stream = utils.stream_llm_response(
+        request.user, question, schema_generated, datasource, roles)
+    return sse_response(stream_generated_sql(
+        request.user, datasource, stream,
+        {'similar_questions': similar_questions}))
+
+
+def check_query_cost(datasource, native_sql, user):
+    """
+    Checks the estimated cost of the query before it runs. Returns the
+    cost response and, when the query must not run, the response to send.
+    """
+    cost_response = cost_estimation.check_query_cost(datasource, native_sql, user)
+    if cost_response['status'] == 'success':
+        return cost_response, None
+    return cost_response, JsonResponse({
+        'status': cost_response['status'],
+        'error': cost_response['error'],
+        'cost_estimate': cost_response['cost_estimate'],
     })
 
 
@@ -169,6 +362,8 @@ def execute_sql(request):
     datasource_id = data.get('datasourceId')
     page = data.get('page', 1)
     per_page = data.get('per_page', 25)
+    preview = data.get('preview', False)
+    defer_count = data.get('defer_count', False)
 
     try:
         datasource = models.DataSource.objects.get(id=datasource_id,
@@ -180,13 +375,11 @@ def execute_sql(request):
         })
     roles = request.user.groups.all()
 
-    models.QueryHistory.objects.create(
+    user_history = models.QueryHistory.objects.create(
         user=request.user, data_source=datasource,
         data_type='user_executed_sql', data=user_sql)
 
-    mDB = utils.prepare_mdb(datasource, roles)
-
-    native_sql_response = utils.generate_native_sql(mDB, user_sql)
+    native_sql_response = utils.translate_sql(datasource, roles, user_sql)
 
     if native_sql_response['status'] == 'error':
         return JsonResponse({
@@ -194,30 +387,142 @@ def execute_sql(request):
             'error': native_sql_response['error'],
         })
 
-    models.QueryHistory.objects.create(
+    query = sql_query.ParsedQuery(native_sql_response['native_sql'],
+                                  datasource.dialect_name)
+
+    sampling_info = None
+    if preview:
+        preview_response = sampling.rewrite_for_preview(query)
+        if preview_response['status'] == 'error':
+            return JsonResponse({
+                'status': preview_response['status'],
+                'error': preview_response['error'],
+            })
+        sampling_info = preview_response['sampling']
+
+    native_sql = query.sql
+
+    history = models.QueryHistory(
         user=request.user,
         data_source=datasource,
         data_type='actual_executed_sql',
-        data=native_sql_response['native_sql'])
+        data=native_sql)
+    history.parsed_query = query
+    history.save()
+
+    cost_response, error_response = check_query_cost(datasource, native_sql, request.user)
+    if error_response is not None:
+        return error_response
 
+    start_time = time.perf_counter()
     execute_sql_response = utils.execute_native_sql(
-        datasource, native_sql_response['native_sql'],
-        page=page, per_page=per_page)
+        datasource, native_sql,
+        page=page, per_page=per_page, user=request.user,
+        defer_count=defer_count)
+    history.execution_time = time.perf_counter() - start_time
 
-    if execute_sql_response['status'] == 'error':
+    history.succeeded = execute_sql_response['status'] == 'success'
+    user_history.succeeded = history.succeeded
+    user_history.save(update_fields=['succeeded', 'updated_at'])
+
+    if execute_sql_response['status'] != 'success':
+        history.save(update_fields=['execution_time', 'succeeded'])
         return JsonResponse({
             'status': execute_sql_response['status'],
             'error': execute_sql_response['error'],
         })
 
+    history.row_count = execute_sql_response['table_data']['row_count']
+    history.save(update_fields=['execution_time', 'row_count', 'succeeded'])
+
+    count_token = None
+    if execute_sql_response['table_data']['row_count'] is None:
+        try:
+            count_job = query_jobs.submit_count_job(
+                request.user, datasource, utils.count_query(query))
+            count_token = count_job.id
+        except Exception as e:
+            logger.warning(e)
+
     return JsonResponse({
         'status': execute_sql_response['status'],
-        'table_data': execute_sql_response['table_data']
+        'table_data': execute_sql_response['table_data'],
+        'cost_estimate': cost_response['cost_estimate'],
+        'approximate': sampling_info is not None,
+        'sampling': sampling_info,
+        'count_token': count_token,
     })
 
 
 @login_required
-def export_sql_result(request):
+def execute_sql_batch(request):
+    data = json.loads(request.body)
+    statements = data.get('statements')
+    datasource_id = data.get('datasourceId')
+    page = data.get('page', 1)
+    per_page = data.get('per_page', 25)
+
+    error = sql_batch.check_statements(statements)
+    if error:
+        return JsonResponse({
+            'status': 'error',
+            'error': error
+        })
+
+    try:
+        datasource = models.DataSource.objects.get(id=datasource_id,
+                                                   enabled=True)
+    except ObjectDoesNotExist:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'No Datasource found.'
+        })
+    roles = request.user.groups.all()
+
+    user_histories = [
+        models.QueryHistory.objects.create(
+            user=request.user, data_source=datasource,
+            data_type='user_executed_sql', data=user_sql)
+        for user_sql in statements
+    ]
+
+    results = utils.translate_sql_batch(datasource, roles, statements)
+
+    histories = {}
+    for index, native_sql_response in enumerate(results):
+        if native_sql_response['status'] == 'success':
+            histories[index] = models.QueryHistory.objects.create(
+                user=request.user,
+                data_source=datasource,
+                data_type='actual_executed_sql',
+                data=native_sql_response['native_sql'])
+
+    execute_responses = sql_batch.run_statements(
+        datasource, [results[index]['native_sql'] for index in histories],
+        page=page, per_page=per_page, user=request.user)
+
+    for index, execute_sql_response in zip(histories, execute_responses):
+        history = histories[index]
+        history.execution_time = execute_sql_response.pop('execution_time', None)
+        history.succeeded = execute_sql_response['status'] == 'success'
+        if history.succeeded:
+            history.row_count = execute_sql_response['table_data']['row_count']
+        history.save(update_fields=['execution_time', 'row_count', 'succeeded'])
+        user_histories[index].succeeded = history.succeeded
+        user_histories[index].save(update_fields=['succeeded', 'updated_at'])
+        results[index] = execute_sql_response
+
+    return JsonResponse({
+        'status': 'success',
+        'results': [
+            {key: value for key, value in result.items() if key != 'native_sql'}
+            for result in results
+        ],
+    })
+
+
+@login_required
+def submit_sql_job(request):
     data = json.loads(request.body)
     user_sql = data.get('sql')
     datasource_id = data.get('datasourceId')
@@ -236,9 +541,131 @@ def export_sql_result(request):
         user=request.user, data_source=datasource,
         data_type='user_executed_sql', data=user_sql)
 
-    mDB = utils.prepare_mdb(datasource, roles)
+    native_sql_response = utils.translate_sql(datasource, roles, user_sql)
+
+    if native_sql_response['status'] == 'error':
+        return JsonResponse({
+            'status': native_sql_response['status'],
+            'error': native_sql_response['error'],
+        })
+
+    models.QueryHistory.objects.create(
+        user=request.user,
+        data_source=datasource,
+        data_type='actual_executed_sql',
+        data=native_sql_response['native_sql'])
 
-    native_sql_response = utils.generate_native_sql(mDB, user_sql)
+    cost_response, error_response = check_query_cost(
+        datasource, native_sql_response['native_sql'], request.user)
+    if error_response is not None:
+        return error_response
+
+    try:
+        job = query_jobs.submit_job(request.user, datasource,
+                                    native_sql_response['native_sql'])
+    except query_jobs.QueryJobError as e:
+        return JsonResponse({
+            'status': 'error',
+            'error': str(e),
+        }, status=429)
+
+    return JsonResponse({
+        'status': 'success',
+        'cost_estimate': cost_response['cost_estimate'],
+        **job.to_dict()
+    })
+
+
+@login_required
+def sql_job_status(request, job_id):
+    job = query_jobs.get_job(request.user, job_id)
+    if job is None:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'No query job found.'
+        })
+    return JsonResponse({
+        'status': 'success',
+        **job.to_dict()
+    })
+
+
+@login_required
+def sql_job_result(request, job_id):
+    page = int(request.GET.get('page', 1))
+    per_page = int(request.GET.get('per_page', 25))
+
+    job = query_jobs.get_job(request.user, job_id)
+    if job is None:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'No query job found.'
+        })
+    if job.status == query_jobs.QueryJob.ERROR:
+        return JsonResponse({
+            'status': 'error',
+            'error': job.error,
+        })
+    if not job.done:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'Query is still running.',
+            **job.to_dict()
+        })
+
+    return JsonResponse({
+        'status': 'success',
+        'table_data': query_jobs.get_job_page(job, page, per_page),
+        **job.to_dict()
+    })
+
+
+@login_required
+def sql_row_count(request, count_token):
+    per_page = int(request.GET.get('per_page', 25))
+
+    job = query_jobs.get_job(request.user, count_token)
+    if job is None:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'No row count found.'
+        })
+    if job.status == query_jobs.QueryJob.ERROR:
+        return JsonResponse({
+            'status': 'error',
+            'error': job.error,
+        })
+
+    row_count = job.rows[0][0] if job.done else None
+    return JsonResponse({
+        'status': 'success',
+        'pending': not job.done,
+        'row_count': row_count,
+        'total_pages': utils.get_total_pages(row_count, per_page),
+    })
+
+
+@login_required
+def export_sql_result(request):
+    data = json.loads(request.body)
+    user_sql = data.get('sql')
+    datasource_id = data.get('datasourceId')
+
+    try:
+        datasource = models.DataSource.objects.get(id=datasource_id,
+                                                   enabled=True)
+    except ObjectDoesNotExist:
+        return JsonResponse({
+            'status': 'error',
+            'error': 'No Datasource found.'
+        })
+    roles = request.user.groups.all()
+
+    models.QueryHistory.objects.create(
+        user=request.user, data_source=datasource,
+        data_type='user_executed_sql', data=user_sql)
+
+    native_sql_response = utils.translate_sql(datasource, roles, user_sql)
 
     if native_sql_response['status'] == 'error':
         return JsonResponse({
@@ -252,8 +679,13 @@ def export_sql_result(request):
         data_type='actual_executed_sql',
         data=native_sql_response['native_sql'])
 
+    cost_response, error_response = check_query_cost(
+        datasource, native_sql_response['native_sql'], request.user)
+    if error_response is not None:
+        return error_response
+
     execute_sql_response = utils.export_native_sql_result(
-        datasource, native_sql_response['native_sql'])
+        datasource, native_sql_response['native_sql'], user=request.user)
 
     return execute_sql_response
 
@@ -287,6 +719,14 @@ def get_tables(request, datasource_id):
     })
 
 
+@staff_member_required
+def get_metrics(request):
+    return JsonResponse({
+        'status': 'success',
+        'metrics': metrics.snapshot()
+    })
+
+
 @login_required
 def get_user_details(request):
     user = request.user